@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+
+from opensearchpy import OpenSearch, helpers
+
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "4"))
+
+
+@contextmanager
+def backfill_settings(client: OpenSearch, index: str) -> Iterator[None]:
+    """
+    大量匯入期間暫時關閉 refresh 與 replica，結束後還原並 refresh 一次
+    """
+    current = client.indices.get_settings(index=index)
+    index_settings = current.get(index, {}).get("settings", {}).get("index", {})
+    original = {
+        "refresh_interval": index_settings.get("refresh_interval", "1s"),
+        "number_of_replicas": index_settings.get("number_of_replicas", "1"),
+    }
+
+    client.indices.put_settings(
+        index=index,
+        body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}},
+    )
+    try:
+        yield
+    finally:
+        client.indices.put_settings(index=index, body={"index": original})
+        client.indices.refresh(index=index)
+
+
+def _to_action(index: str, doc: Dict[str, Any], id_field: Optional[str]) -> Dict[str, Any]:
+    # 已經是 bulk action 格式 (有 _source / _op_type) 就直接使用
+    if "_source" in doc or "_op_type" in doc:
+        action = dict(doc)
+        action.setdefault("_index", index)
+        return action
+
+    action = {"_index": index, "_source": doc}
+    if id_field and doc.get(id_field):
+        action["_id"] = doc[id_field]
+    return action
+
+
+def _send_chunk(client: OpenSearch, chunk: List[Dict[str, Any]]) -> Dict[str, Any]:
+    success, errors = helpers.bulk(
+        client,
+        chunk,
+        chunk_size=len(chunk),
+        raise_on_error=False,
+        raise_on_exception=False,
+        refresh=False,
+    )
+    return {"success": success, "errors": errors}
+
+
+def _drain(done: Set[Future], pending: Dict[Future, int], collect) -> None:
+    for fut in done:
+        collect(pending.pop(fut), fut)
+
+
+@contextmanager
+def _noop() -> Iterator[None]:
+    yield
+
+
+def bulk_index(client: OpenSearch, index: str, docs: Iterable[Dict[str, Any]],
+               chunk_size: int = BULK_CHUNK_SIZE, concurrency: int = BULK_CONCURRENCY,
+               id_field: Optional[str] = None, backfill: bool = False, refresh: bool = True) -> Dict[str, Any]:
+    """
+    透過 _bulk API 匯入任意文件
+
+    - docs 可以是 generator，最多只會有 concurrency * 2 個 chunk 在記憶體中
+    - id_field: 指定後以該欄位值當 _id (重複匯入會覆寫，達到 idempotent)
+    - backfill: 匯入期間關閉 refresh_interval 與 replicas
+    - refresh: 結束時強制 refresh；頻繁的小批次 (串流匯入) 應設為 False，交給 index 的 refresh_interval
+    回傳 indexed / failed / docs_per_sec 與每個失敗 chunk 的錯誤
+    """
+    stats: Dict[str, Any] = {
+        "index": index,
+        "indexed": 0,
+        "failed": 0,
+        "chunks": 0,
+        "seconds": 0.0,
+        "docs_per_sec": 0.0,
+        "chunk_failures": [],
+    }
+
+    def _collect(chunk_no: int, fut: Future) -> None:
+        size = pending_sizes.pop(chunk_no)
+        try:
+            res = fut.result()
+        except Exception as e:
+            stats["chunk_failures"].append({"chunk": chunk_no, "errors": [str(e)]})
+            stats["failed"] += size
+            return
+        stats["indexed"] += res["success"]
+        if res["errors"]:
+            stats["failed"] += len(res["errors"])
+            stats["chunk_failures"].append({"chunk": chunk_no, "errors": res["errors"][:20]})
+
+    start = time.perf_counter()
+    actions = (_to_action(index, d, id_field) for d in docs)
+    pending: Dict[Future, int] = {}
+    pending_sizes: Dict[int, int] = {}
+
+    with (backfill_settings(client, index) if backfill else _noop()):
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            while True:
+                chunk = list(islice(actions, chunk_size))
+                if not chunk:
+                    break
+
+                # backpressure: in-flight chunk 太多時先等完成
+                while len(pending) >= max(1, concurrency) * 2:
+                    done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                    _drain(done, pending, _collect)
+
+                chunk_no = stats["chunks"]
+                stats["chunks"] += 1
+                pending_sizes[chunk_no] = len(chunk)
+                pending[pool.submit(_send_chunk, client, chunk)] = chunk_no
+
+            done, _ = wait(list(pending))
+            _drain(done, pending, _collect)
+
+        if refresh and not backfill:
+            client.indices.refresh(index=index)
+
+    stats["seconds"] = round(time.perf_counter() - start, 3)
+    if stats["seconds"] > 0:
+        stats["docs_per_sec"] = round(stats["indexed"] / stats["seconds"], 1)
+    return stats
+
+
+def print_bulk_stats(stats: Dict[str, Any]) -> None:
+    print(f"  Bulk 匯入 '{stats['index']}': 成功 {stats['indexed']} 筆, 失敗 {stats['failed']} 筆, "
+          f"{stats['chunks']} chunks, {stats['seconds']}s ({stats['docs_per_sec']} docs/sec)")
+    for failure in stats["chunk_failures"]:
+        print(f"    chunk #{failure['chunk']} 失敗: {failure['errors'][:3]}")
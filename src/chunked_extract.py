@@ -0,0 +1,207 @@
+"""
+長篇 CTI 報告的 map-reduce 抽取
+
+- split_report: 依章節 / 段落切成不超過 token 預算的 chunk
+- extract_chunked: 每個 chunk 併發呼叫 LLMClient.extract_json
+- merge_extractions: 合併成一個符合 EXTRACTION_SCHEMA_DESCRIPTION 的物件
+  (indicators 去重、TTP 依 MITRE ID 聯集、confidence 依 chunk 長度加權)
+"""
+from __future__ import annotations
+
+import os
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from .llm_client import LLMClient
+
+# 報告估計 token 數超過 EXTRACT_CHUNK_TOKENS 才切塊 (0 = 關閉)
+DEFAULT_CHUNK_TOKENS = 8000
+DEFAULT_CHUNK_CONCURRENCY = 4
+SUMMARY_MAX_CHARS = 1500
+
+_HEADING_RE = re.compile(r"^(#{1,6}\s|\d+(\.\d+)*\.?\s+[A-Z]|[A-Z][A-Z0-9 ,&/-]{3,}$)")
+_INDICATOR_KEYS = ("ipv4", "ipv6", "domains", "urls")
+_HASH_KEYS = ("md5", "sha1", "sha256")
+
+_estimate_tokens = LLMClient._estimate_tokens
+
+
+def _sections(text: str) -> List[str]:
+    """
+    先以空行切段落，遇到標題就開新章節，讓同一章節盡量留在同一個 chunk
+    """
+    sections: List[str] = []
+    current: List[str] = []
+    for para in re.split(r"\n\s*\n", text):
+        para = para.strip()
+        if not para:
+            continue
+        if current and _HEADING_RE.match(para.splitlines()[0]):
+            sections.append("\n\n".join(current))
+            current = []
+        current.append(para)
+    if current:
+        sections.append("\n\n".join(current))
+    return sections
+
+
+def _split_oversized(block: str, max_tokens: int) -> List[str]:
+    """
+    單一章節就超過預算時依段落、行、最後依字元數切
+    """
+    if _estimate_tokens(block) <= max_tokens:
+        return [block]
+    for sep in ("\n\n", "\n"):
+        pieces = block.split(sep)
+        if len(pieces) > 1:
+            return _pack(pieces, max_tokens, sep)
+    step = max_tokens * 4
+    return [block[i:i + step] for i in range(0, len(block), step)]
+
+
+def _pack(pieces: Iterable[str], max_tokens: int, sep: str = "\n\n") -> List[str]:
+    chunks: List[str] = []
+    current: List[str] = []
+    tokens = 0
+    for piece in pieces:
+        t = _estimate_tokens(piece)
+        if t > max_tokens:
+            if current:
+                chunks.append(sep.join(current))
+                current, tokens = [], 0
+            chunks.extend(_split_oversized(piece, max_tokens))
+            continue
+        if current and tokens + t > max_tokens:
+            chunks.append(sep.join(current))
+            current, tokens = [], 0
+        current.append(piece)
+        tokens += t
+    if current:
+        chunks.append(sep.join(current))
+    return chunks
+
+
+def split_report(text: str, max_tokens: int = DEFAULT_CHUNK_TOKENS) -> List[str]:
+    if max_tokens <= 0 or _estimate_tokens(text) <= max_tokens:
+        return [text]
+    return _pack(_sections(text), max_tokens)
+
+
+def _unique(values: Iterable[Any], lower: bool = False, fold: bool = True) -> List[str]:
+    """
+    去重並保留順序；lower 把值轉小寫，fold 代表比對時不分大小寫 (URL 要區分)
+    """
+    seen = set()
+    out = []
+    for v in values:
+        if not isinstance(v, str):
+            continue
+        v = v.strip()
+        if lower:
+            v = v.lower()
+        key = v.lower() if fold else v
+        if v and key not in seen:
+            seen.add(key)
+            out.append(v)
+    return out
+
+
+def _merge_ttps(parts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    merged: Dict[str, Dict[str, Any]] = {}
+    for part in parts:
+        for ttp in part.get("ttps") or []:
+            if not isinstance(ttp, dict):
+                continue
+            mitre_id = (ttp.get("mitre_technique_id") or "").strip().upper() or None
+            key = mitre_id or (ttp.get("name") or "").strip().lower()
+            if not key:
+                continue
+            existing = merged.get(key)
+            if existing is None:
+                merged[key] = dict(ttp, mitre_technique_id=mitre_id)
+            elif len(ttp.get("description") or "") > len(existing.get("description") or ""):
+                # 保留描述最完整的那一份
+                existing["description"] = ttp["description"]
+    return list(merged.values())
+
+
+def _merge_log_suggestions(parts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    merged: Dict[str, Dict[str, Any]] = {}
+    for part in parts:
+        for sug in part.get("log_suggestions") or []:
+            if not isinstance(sug, dict) or not sug.get("log_type"):
+                continue
+            key = sug["log_type"].strip().lower()
+            existing = merged.get(key)
+            if existing is None:
+                merged[key] = dict(sug, fields=_unique(sug.get("fields") or []))
+            else:
+                existing["fields"] = _unique(list(existing["fields"]) + list(sug.get("fields") or []))
+    return list(merged.values())
+
+
+def merge_extractions(parts: List[Dict[str, Any]], weights: Optional[List[int]] = None) -> Dict[str, Any]:
+    """
+    把多個 chunk 的抽取結果合併成一個物件
+    """
+    weights = weights or [1] * len(parts)
+
+    indicators: Dict[str, Any] = {}
+    for key in _INDICATOR_KEYS:
+        values = (v for p in parts for v in ((p.get("indicators") or {}).get(key) or []))
+        indicators[key] = _unique(values, lower=key == "domains", fold=key != "urls")
+    indicators["hashes"] = {
+        key: _unique(
+            (v for p in parts for v in (((p.get("indicators") or {}).get("hashes") or {}).get(key) or [])),
+            lower=True,
+        )
+        for key in _HASH_KEYS
+    }
+
+    summaries = _unique(p.get("summary") for p in parts)
+    summary = " ".join(summaries)
+    if len(summary) > SUMMARY_MAX_CHARS:
+        summary = summary[:SUMMARY_MAX_CHARS].rsplit(" ", 1)[0] + " ..."
+
+    actors = Counter(a.strip() for a in (p.get("actor") for p in parts) if isinstance(a, str) and a.strip())
+
+    scored = [(p.get("confidence"), w) for p, w in zip(parts, weights) if isinstance(p.get("confidence"), (int, float))]
+    confidence = None
+    if scored:
+        confidence = round(sum(c * w for c, w in scored) / max(sum(w for _, w in scored), 1))
+
+    return {
+        "summary": summary,
+        "indicators": indicators,
+        "ttps": _merge_ttps(parts),
+        "actor": actors.most_common(1)[0][0] if actors else None,
+        "malware_or_tool": _unique(v for p in parts for v in (p.get("malware_or_tool") or [])),
+        "confidence": confidence,
+        "log_suggestions": _merge_log_suggestions(parts),
+    }
+
+
+def extract_chunked(llm: LLMClient, text: str, system_prompt: str,
+                    build_prompt: Callable[[str], str],
+                    max_tokens: Optional[int] = None,
+                    concurrency: Optional[int] = None) -> Dict[str, Any]:
+    """
+    報告夠短時直接呼叫一次 LLM；否則切塊併發抽取後合併，延遲取決於最長的 chunk
+    """
+    if max_tokens is None:
+        max_tokens = int(os.getenv("EXTRACT_CHUNK_TOKENS", str(DEFAULT_CHUNK_TOKENS)))
+    if concurrency is None:
+        concurrency = int(os.getenv("EXTRACT_CHUNK_CONCURRENCY", str(DEFAULT_CHUNK_CONCURRENCY)))
+    chunks = split_report(text, max_tokens)
+    if len(chunks) == 1:
+        return llm.extract_json(system_prompt=system_prompt, user_prompt=build_prompt(chunks[0]))
+
+    def _run(chunk: str) -> Dict[str, Any]:
+        return llm.extract_json(system_prompt=system_prompt, user_prompt=build_prompt(chunk))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(chunks)))) as pool:
+        parts = list(pool.map(_run, chunks))
+
+    return merge_extractions(parts, [_estimate_tokens(c) for c in chunks])
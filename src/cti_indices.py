@@ -0,0 +1,12 @@
+"""
+Layer 3 (stix_index) 的 OpenSearch index 名稱
+
+獨立成不依賴其他模組的小檔案：detect_anomaly / local_knn 只需要 index 名稱，
+不必為此載入 stix_index (stix2validator、ijson、validation cache)
+"""
+
+INDICATOR_INDEX = "cti-indicators"
+ATTACK_PATTERN_INDEX = "cti-attack-patterns"
+MALWARE_TOOL_INDEX = "cti-malware-tools"
+RELATIONSHIP_INDEX = "cti-relationships"
+TTP_VECTOR_INDEX = "cti-ttp-vectors"
@@ -1,10 +1,19 @@
 # src/detect_anomaly.py
+import argparse
+import contextlib
+import json
 import os
-import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from dotenv import load_dotenv
 from opensearchpy import OpenSearch
 from .llm_client import LLMClient
+from .local_knn import DEFAULT_LOCAL_KNN_DIR, DEFAULT_TTP_KNN_DIR, LocalKNNIndex, score_to_cosine
+from .log_source import infer_log_source
+from .threshold_store import DEFAULT_THRESHOLD_PATH, TDigest, ThresholdStore, threshold_key
+from .log_template import TemplateMiner, template_state_path, templates_enabled
+from .cti_indices import TTP_VECTOR_INDEX
 
 load_dotenv()
 llm = LLMClient()
@@ -20,6 +29,70 @@ index_name = "security-logs-knn"
 K = 5                  # 可調整 資料多時可改 20
 CALIB_SAMPLE_N = 200   # 校準 threshold 時抽樣數
 QUANTILE = 0.95        # P95 資料多可改P99
+CALIB_INCREMENTAL_MAX = int(os.getenv("CALIB_INCREMENTAL_MAX", "5000"))  # 增量校正一次最多處理的新文件數
+DEFAULT_THRESHOLD = 0.35
+
+# threshold 持久化，啟動時直接讀檔
+_threshold_store = ThresholdStore(os.getenv("THRESHOLD_STORE_PATH", DEFAULT_THRESHOLD_PATH))
+
+# ---- 批次查詢參數 ----
+MSEARCH_CHUNK = int(os.getenv("MSEARCH_CHUNK_SIZE", "100"))      # 每個 _msearch 包幾個 kNN 查詢
+MSEARCH_CONCURRENCY = int(os.getenv("MSEARCH_CONCURRENCY", "4"))  # 同時送出幾個 _msearch
+
+# ---- kNN 引擎: "opensearch" (預設) 或 "local" (in-process，先用 python -m src.local_knn export 匯出) ----
+KNN_ENGINE = os.getenv("KNN_ENGINE", "opensearch").lower()
+LOCAL_KNN_DIR = os.getenv("LOCAL_KNN_DIR", DEFAULT_LOCAL_KNN_DIR)
+_local_index = None
+
+
+def _get_local_index():
+    global _local_index
+    if _local_index is None:
+        _local_index = LocalKNNIndex.load(LOCAL_KNN_DIR)
+    return _local_index
+
+# ---- TTP 連結: 判定為異常的 Log 再對 TTP 向量 (stix_index 的 cti-ttp-vectors) 做一次 kNN ----
+# 直接沿用偵測時算好的 embedding，不會多打一次 API；TTP_LINK=0 關閉
+# TTP 向量不存在時 (還沒跑過 stix_index) 整個 stage 自動略過，只在第一次用到時檢查一次
+TTP_LINK = os.getenv("TTP_LINK", "1") != "0"
+TTP_LINK_K = int(os.getenv("TTP_LINK_K", "3"))
+TTP_KNN_DIR = os.getenv("TTP_KNN_DIR", DEFAULT_TTP_KNN_DIR)  # KNN_ENGINE=local 時使用 (python -m src.local_knn export-ttp)
+_local_ttp_index = None
+_local_ttp_loaded = False
+_ttp_index_exists = None
+
+
+def _get_local_ttp_index():
+    global _local_ttp_index, _local_ttp_loaded
+    if not _local_ttp_loaded:
+        _local_ttp_loaded = True
+        if os.path.isdir(TTP_KNN_DIR):
+            _local_ttp_index = LocalKNNIndex.load(TTP_KNN_DIR)
+    return _local_ttp_index
+
+
+def _ttp_link_available():
+    global _ttp_index_exists
+    if KNN_ENGINE == "local":
+        try:
+            return _get_local_ttp_index() is not None
+        except Exception:
+            return False
+    if _ttp_index_exists is None:
+        try:
+            _ttp_index_exists = bool(client.indices.exists(index=TTP_VECTOR_INDEX))
+        except Exception:
+            _ttp_index_exists = False
+    return _ttp_index_exists
+
+# 與 ingest 相同的 template 規則，讓新 Log 跟 baseline 用同一種文字做 embedding
+_miner = TemplateMiner.load(template_state_path()) if templates_enabled() else None
+
+
+def _embedding_text(log_text):
+    if _miner is None:
+        return log_text
+    return _miner.template_for(log_text)[1]
 
 
 def _build_knn_query(query_vector, k=K, size=K, filters=None, exclude_id=None):
@@ -90,35 +163,286 @@ def _anomaly_score_from_hits(hits, k=K, method="kth"):
     return 1.0 - sim  # 越大越異常
 
 
+def _msearch(queries, chunk_size=MSEARCH_CHUNK, concurrency=MSEARCH_CONCURRENCY, index=None):
+    """
+    用 _msearch 批次送出查詢，回傳與 queries 同順序的 hits list（失敗的位置為 None）
+    index 不給時查 baseline index
+    """
+    chunks = [queries[i:i + chunk_size] for i in range(0, len(queries), chunk_size)]
+    target = index or index_name
+
+    def _run(part):
+        body = []
+        for q in part:
+            body.append({"index": target})
+            body.append(q)
+        try:
+            resp = client.msearch(body=body)
+        except Exception:
+            return [None] * len(part)
+
+        out = []
+        for r in resp.get("responses", []):
+            out.append(None if "error" in r else r.get("hits", {}).get("hits", []))
+        # 回應數量異常時補齊，避免位置錯亂
+        out.extend([None] * (len(part) - len(out)))
+        return out[:len(part)]
+
+    if len(chunks) <= 1 or concurrency <= 1:
+        parts = [_run(c) for c in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks))) as pool:
+            parts = list(pool.map(_run, chunks))
+
+    results = []
+    for part in parts:
+        results.extend(part)
+    return results
+
+
+def _knn_search_batch(vectors, k=K, filters=None, exclude_ids=None, include_source=True):
+    """
+    批次 kNN，依 KNN_ENGINE 走 OpenSearch _msearch 或本地引擎；回傳每個向量的 hits（失敗為 None）
+    """
+    if KNN_ENGINE == "local":
+        try:
+            return _get_local_index().search_batch(
+                vectors, k, filters=filters, exclude_ids=exclude_ids, include_source=include_source
+            )
+        except Exception:
+            return [None] * len(vectors)
+
+    queries = []
+    for i, vector in enumerate(vectors):
+        exclude_id = exclude_ids[i] if exclude_ids else None
+        q = _build_knn_query(query_vector=vector, k=k, size=k, filters=filters, exclude_id=exclude_id)
+        q["_source"] = {"excludes": ["log_vector"]} if include_source else False
+        queries.append(q)
+    return _msearch(queries)
+
+
+def _ttp_matches_from_hits(hits, k=TTP_LINK_K):
+    """
+    TTP kNN hits -> 依 MITRE technique 去重後的前 k 筆 (沒有 technique ID 的以名稱去重)
+    sim 是 cosine：_score 是 cosinesimil 的 1/(2-cos)，先換算回來
+    """
+    matches = []
+    seen = set()
+    for h in hits:
+        src = h.get("_source", {})
+        names = src.get("mitre_names") or []
+        for j, mitre_id in enumerate(src.get("mitre_ids") or [None]):
+            key = mitre_id or src.get("name")
+            if key in seen:
+                continue
+            seen.add(key)
+            matches.append({
+                "mitre_id": mitre_id,
+                "name": names[j] if j < len(names) else src.get("name"),
+                "sim": score_to_cosine(h["_score"]),
+                "kind": src.get("kind"),
+                "text": src.get("text", ""),
+            })
+    return matches[:k]
+
+
+def _link_ttp_batch(vectors, k=TTP_LINK_K):
+    """
+    批次把向量對應到最相似的 TTP，回傳與 vectors 同順序的 match list（失敗或沒有 TTP 向量時為空）
+    多取幾個鄰居，去重後仍能湊到 k 個 technique
+    """
+    if not vectors:
+        return []
+    if not _ttp_link_available():
+        return [[] for _ in vectors]
+    fetch = k * 3
+    if KNN_ENGINE == "local":
+        try:
+            ttp_index = _get_local_ttp_index()
+            batch_hits = ttp_index.search_batch(vectors, fetch) if ttp_index is not None else []
+        except Exception:
+            batch_hits = []
+    else:
+        queries = [
+            {"size": fetch, "query": {"knn": {"ttp_vector": {"vector": v, "k": fetch}}},
+             "_source": {"excludes": ["ttp_vector"]}}
+            for v in vectors
+        ]
+        batch_hits = _msearch(queries, index=TTP_VECTOR_INDEX)
+
+    matches = [_ttp_matches_from_hits(hits or [], k=k) for hits in batch_hits]
+    matches.extend([[] for _ in range(len(vectors) - len(matches))])
+    return matches
+
+
+def _anomaly_scores_from_sims(sims, k=K, method="kth"):
+    """
+    向量化版本的 _anomaly_score_from_hits
+    sims: (n, k) 矩陣，不足 k 個鄰居的位置為 NaN；整列都是 NaN 的結果為 NaN
+    """
+    sims = np.asarray(sims, dtype=np.float64)
+    if sims.size == 0:
+        return np.empty(len(sims))
+
+    counts = np.sum(~np.isnan(sims), axis=1)
+    # 由大到小排序，NaN 排到最後
+    ordered = -np.sort(np.where(np.isnan(sims), np.inf, -sims), axis=1)
+    ordered[np.isinf(ordered)] = np.nan
+
+    with np.errstate(invalid="ignore"):
+        if method == "avg":
+            sim = np.nanmean(np.where(counts[:, None] > 0, ordered, 0.0), axis=1)
+        elif method == "max":
+            sim = ordered[:, 0]
+        else:  # "kth" (Default)
+            idx = np.clip(np.minimum(k - 1, counts - 1), 0, None)
+            sim = ordered[np.arange(len(ordered)), idx]
+
+    scores = 1.0 - sim
+    scores[counts == 0] = np.nan
+    return scores
+
+
+def _filter_query(filters=None, extra=None):
+    clauses = [{"term": {f: v}} for f, v in (filters or {}).items()]
+    clauses.extend(extra or [])
+    if not clauses:
+        return {"match_all": {}}
+    return {"bool": {"filter": clauses}}
+
+
+def _scroll_hits(body, limit, page_size=1000):
+    """
+    limit <= page_size 時單次查詢，否則用 scroll 一次拉完
+    """
+    body = dict(body, size=min(limit, page_size))
+    if limit <= page_size:
+        resp = client.search(index=index_name, body=body)
+        return resp.get("hits", {}).get("hits", [])
+
+    resp = client.search(index=index_name, body=body, scroll="2m")
+    scroll_id = resp.get("_scroll_id")
+    hits = list(resp.get("hits", {}).get("hits", []))
+    try:
+        while len(hits) < limit and scroll_id:
+            resp = client.scroll(scroll_id=scroll_id, scroll="2m")
+            scroll_id = resp.get("_scroll_id")
+            page = resp.get("hits", {}).get("hits", [])
+            if not page:
+                break
+            hits.extend(page)
+    finally:
+        if scroll_id:
+            try:
+                client.clear_scroll(scroll_id=scroll_id)
+            except Exception:
+                pass
+    return hits[:limit]
+
+
+def _sample_baseline(sample_n, filters=None, seed=42):
+    """
+    隨機抽樣 baseline 文件 (只取 ID 與向量)
+    """
+    body = {
+        "query": {
+            "function_score": {
+                "query": _filter_query(filters),
+                "random_score": {"seed": seed, "field": "_seq_no"},
+                "boost_mode": "replace"
+            }
+        },
+        "_source": ["log_vector"]
+    }
+    return _scroll_hits(body, sample_n)
+
+
+def _latest_baseline_timestamp(filters=None):
+    body = {
+        "size": 0,
+        "query": _filter_query(filters),
+        "aggs": {"latest": {"max": {"field": "timestamp"}}}
+    }
+    resp = client.search(index=index_name, body=body)
+    return resp.get("aggregations", {}).get("latest", {}).get("value_as_string")
+
+
+def _count_baseline(filters=None, until=None):
+    extra = [{"range": {"timestamp": {"lte": until}}}] if until else None
+    resp = client.count(index=index_name, body={"query": _filter_query(filters, extra)})
+    return int(resp.get("count", 0))
+
+
+def _fetch_baseline_since(since, filters=None, limit=CALIB_INCREMENTAL_MAX, after=None, page_size=1000):
+    """
+    依 (timestamp, _id) 順序取出上次校正之後的 baseline 文件 (增量校正用)，用 search_after 分頁
+
+    after: 上次最後一筆的 sort 值 [timestamp, _id]；有 after 時同一個 timestamp 的文件也不會漏掉或重複。
+    只有 since (完整校正後的第一次增量) 時從 since 本身開始 (gte)，寧可重算幾筆也不漏掉同時間的文件
+    """
+    extra = [{"range": {"timestamp": {"gte": since}}}] if since else None
+    body = {
+        "query": _filter_query(filters, extra),
+        "sort": [{"timestamp": "asc"}, {"_id": "asc"}],
+        "_source": ["log_vector", "timestamp"],
+    }
+    hits = []
+    while len(hits) < limit:
+        page_body = dict(body, size=min(page_size, limit - len(hits)))
+        if after:
+            page_body["search_after"] = after
+        page = client.search(index=index_name, body=page_body).get("hits", {}).get("hits", [])
+        if not page:
+            break
+        hits.extend(page)
+        after = page[-1].get("sort")
+        if len(page) < page_body["size"] or not after:
+            break
+    return hits
+
+
+def _score_baseline_hits(hits, k=K, filters=None, score_method="kth"):
+    """
+    對 baseline 樣本做 leave-one-out kNN（批次送出），回傳 (scores, 失敗數, 缺向量數, 無鄰居數)
+    """
+    samples = [(doc["_id"], doc.get("_source", {}).get("log_vector")) for doc in hits]
+    no_vector = sum(1 for _, v in samples if not v)
+    samples = [(doc_id, v) for doc_id, v in samples if v]
+
+    responses = _knn_search_batch(
+        [v for _, v in samples], k=k, filters=filters,
+        exclude_ids=[doc_id for doc_id, _ in samples], include_source=False
+    )
+
+    sims = np.full((len(samples), k), np.nan)
+    failed = 0
+    for row, neighbors in enumerate(responses):
+        if neighbors is None:
+            failed += 1
+            continue
+        vals = [h["_score"] for h in neighbors[:k]]
+        sims[row, :len(vals)] = vals
+
+    all_scores = _anomaly_scores_from_sims(sims, k=k, method=score_method)
+    scores = all_scores[~np.isnan(all_scores)]
+    empty = int(np.isnan(all_scores).sum()) - failed
+    return scores, failed, no_vector, empty
+
+
 def calibrate_threshold(sample_n=CALIB_SAMPLE_N, k=K, quantile=QUANTILE,
-                        filters=None, score_method="kth", seed=42):
+                        filters=None, score_method="kth", seed=42, return_details=False):
     """
     從 baseline 抽樣 N 筆，計算 threshold
+    return_details=True 時回傳 dict (threshold / scores / samples / failed)
     """
-    random.seed(seed)
     print(f"\n   正在進行自動校正 (Calibration)...")
 
     #    抓取 baseline 文件的 ID 和向量
     try:
-        random_query = {
-            "size": sample_n,
-            "query": {
-                "function_score": {
-                    "query": {"match_all": {}},
-                    "random_score": {}
-                }
-            },
-            "_source": ["log_vector"]
-        }
-        
-        if filters:
-            random_query["query"]["function_score"]["query"] = {
-                "bool": {"filter": [{"term": {k: v}} for k, v in filters.items()]}
-            }
-
-        resp = client.search(index=index_name, body=random_query)
-        hits = resp.get("hits", {}).get("hits", [])
-    
+        if KNN_ENGINE == "local":
+            hits = _get_local_index().sample(sample_n, filters=filters, seed=seed)
+        else:
+            hits = _sample_baseline(sample_n, filters=filters, seed=seed)
     except Exception as e:
         print(f"   校正失敗 (無法取得樣本): {e}")
         return None
@@ -127,94 +451,356 @@ def calibrate_threshold(sample_n=CALIB_SAMPLE_N, k=K, quantile=QUANTILE,
         print(f"   資料筆數不足 ({len(hits)} < {k+1})，無法進行統計校正。")
         return None
 
-    scores = []
+    scores, failed, no_vector, empty = _score_baseline_hits(hits, k=k, filters=filters, score_method=score_method)
 
-    # 對每個樣本做 kNN
-    for doc in hits:
-        doc_id = doc["_id"]
-        vector = doc["_source"].get("log_vector")
-        
-        if not vector: continue
+    if failed or no_vector or empty:
+        print(f"   注意: {failed} 筆查詢失敗, {no_vector} 筆缺少向量, {empty} 筆無鄰居 (共抽樣 {len(hits)} 筆)")
 
-        knn_query = _build_knn_query(
-            query_vector=vector,
-            k=k,
-            size=k,
-            filters=filters,
-            exclude_id=doc_id
-        )
-
-        try:
-            nn = client.search(index=index_name, body=knn_query)
-            neighbors = nn.get("hits", {}).get("hits", [])
-            
-            s = _anomaly_score_from_hits(neighbors, k=k, method=score_method)
-            if s is not None:
-                scores.append(s)
-        except Exception:
-            continue
-
-    if not scores:
+    if scores.size == 0:
         return None
 
     #    計算分位數
     threshold = float(np.quantile(scores, quantile))
     
     print(f"  校正完成: Method={score_method}, K={k}, P{int(quantile*100)}={threshold:.4f}, Samples={len(scores)}")
+    if return_details:
+        return {
+            "threshold": threshold,
+            "scores": scores.tolist(),
+            "samples": len(hits),
+            "failed": failed,
+            "missing_vector": no_vector,
+            "no_neighbors": empty,
+        }
     return threshold
 
 
-def detect(log_text, threshold, k=K, filters=None, score_method="kth", print_top=5):
-    print(f"\n  正在分析 Log: '{log_text}'")
+def load_threshold(k=K, quantile=QUANTILE, filters=None, score_method="kth",
+                   sample_n=CALIB_SAMPLE_N, refresh=False, incremental=False):
+    """
+    讀取已持久化的 threshold；沒有紀錄 (或 refresh=True) 時做完整校正並存檔
+    incremental=True 時只對上次校正後新進的 baseline 文件評分，更新 t-digest 後重算分位數
+    (只支援 OpenSearch；KNN_ENGINE=local 時會警告並改做完整校正)
+
+    完整校正的 t-digest 每個抽樣分數的權重是 (baseline 總筆數 / 抽樣數)，代表整個 baseline；
+    增量加入的文件每筆權重 1，新舊資料的比例才會與實際文件數一致
+    """
+    source = f"local:{LOCAL_KNN_DIR}" if KNN_ENGINE == "local" else index_name
+    key = threshold_key(source, filters, k, score_method, quantile, llm.embedding_cache_model)
+    entry = _threshold_store.get(key)
+
+    if entry and not refresh and not incremental:
+        print(f"   使用已儲存的 threshold: {entry['threshold']:.4f} (更新於 {entry.get('updated_at')})")
+        return entry["threshold"]
 
-    # 這裡 call LLM，因為是新進來的未知 Log
+    if entry and incremental and KNN_ENGINE == "local":
+        print("   注意: KNN_ENGINE=local 不支援增量校正，改為完整重新校正", file=sys.stderr)
+
+    if entry and incremental and KNN_ENGINE != "local":
+        print(f"\n   增量校正: 取出 {entry.get('last_timestamp')} 之後的 baseline...")
+        try:
+            hits = _fetch_baseline_since(entry.get("last_timestamp"), filters=filters, after=entry.get("cursor"))
+        except Exception as e:
+            print(f"   增量校正失敗 (無法取得新文件): {e}")
+            return entry["threshold"]
+
+        if not hits:
+            print("   沒有新的 baseline 文件，沿用既有 threshold")
+            return entry["threshold"]
+
+        scores, failed, no_vector, empty = _score_baseline_hits(hits, k=k, filters=filters, score_method=score_method)
+        if failed or no_vector or empty:
+            print(f"   注意: {failed} 筆查詢失敗, {no_vector} 筆缺少向量, {empty} 筆無鄰居 (共 {len(hits)} 筆)")
+
+        digest = TDigest.from_dict(entry["digest"])
+        if "population" not in entry:
+            # 舊版紀錄的抽樣分數權重都是 1：換算成校正當時的 baseline 筆數
+            try:
+                population = _count_baseline(filters, until=entry.get("last_timestamp"))
+            except Exception:
+                population = 0
+            if population > digest.count > 0:
+                digest.scale(population / digest.count)
+            entry["population"] = population
+        digest.update(scores.tolist())
+        entry["digest"] = digest.to_dict()
+        entry["threshold"] = digest.quantile(quantile)
+        entry["scored"] = entry.get("scored", 0) + int(scores.size)
+        entry["failed"] = entry.get("failed", 0) + failed
+        entry["last_timestamp"] = hits[-1].get("_source", {}).get("timestamp") or entry.get("last_timestamp")
+        entry["cursor"] = hits[-1].get("sort") or entry.get("cursor")
+        _threshold_store.put(key, entry)
+
+        print(f"  增量校正完成: 新增 {scores.size} 筆, P{int(quantile*100)}={entry['threshold']:.4f}")
+        return entry["threshold"]
+
+    # 先記下目前最新的 timestamp，校正期間新進的文件留給下次增量處理
+    last_ts = None
+    population = None
+    if KNN_ENGINE != "local":
+        try:
+            last_ts = _latest_baseline_timestamp(filters)
+            population = _count_baseline(filters, until=last_ts)
+        except Exception:
+            pass
+
+    details = calibrate_threshold(sample_n=sample_n, k=k, quantile=quantile, filters=filters,
+                                  score_method=score_method, return_details=True)
+    if details is None:
+        return None
+
+    digest = TDigest()
+    # 抽樣分數代表整個 baseline，之後增量加入的每筆文件權重才會是 1
+    weight = max(1.0, (population or 0) / max(1, len(details["scores"])))
+    digest.update(details["scores"], weight=weight)
+    _threshold_store.put(key, {
+        "params": {
+            "index": source,
+            "filters": filters or {},
+            "k": k,
+            "score_method": score_method,
+            "quantile": quantile,
+            "embedding_model": llm.embedding_cache_model,
+        },
+        "threshold": details["threshold"],
+        "scores": details["scores"],
+        "digest": digest.to_dict(),
+        "samples": details["samples"],
+        "scored": len(details["scores"]),
+        "failed": details["failed"],
+        "last_timestamp": last_ts,
+        "cursor": None,
+        "population": population,
+    })
+    return details["threshold"]
+
+
+def _list_log_sources():
+    if KNN_ENGINE == "local":
+        return sorted({src.get("log_source") for src in _get_local_index().sources if src.get("log_source")})
+    body = {"size": 0, "aggs": {"sources": {"terms": {"field": "log_source", "size": 1000}}}}
+    resp = client.search(index=index_name, body=body)
+    return [b["key"] for b in resp.get("aggregations", {}).get("sources", {}).get("buckets", [])]
+
+
+def calibrate_all_sources(k=K, quantile=QUANTILE, score_method="kth",
+                          refresh=False, incremental=False, concurrency=4):
+    """
+    對每個 log_source 平行校正 (或讀取已儲存的) threshold，回傳 {log_source: threshold}
+    資料不足而無法校正的 source 不會出現在結果中
+    """
     try:
-        vector = llm.get_embedding(log_text)
+        sources = _list_log_sources()
     except Exception as e:
-        print(f"  Embedding 失敗: {e}")
-        return
+        print(f"   無法取得 log_source 清單: {e}")
+        return {}
+
+    def _one(source):
+        try:
+            return source, load_threshold(k=k, quantile=quantile, filters={"log_source": source},
+                                          score_method=score_method, refresh=refresh, incremental=incremental)
+        except Exception as e:
+            print(f"   log_source={source} 校正失敗: {e}")
+            return source, None
+
+    if not sources:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(sources)))) as pool:
+        results = list(pool.map(_one, sources))
+
+    thresholds = {source: t for source, t in results if t is not None}
+    print(f"  各 log_source threshold: {thresholds}")
+    return thresholds
+
+
+def detect_batch(log_texts, threshold, k=K, filters=None, score_method="kth", link_ttps=None):
+    """
+    批次偵測：一次 embedding + _msearch，回傳每筆的結構化結果
+    verdict: "anomaly" / "benign" / "unknown"（embedding 或搜尋失敗、無可比對資料）
+    link_ttps (預設 TTP_LINK)：異常的 Log 用同一個 embedding 再查一次 TTP 向量，結果放在 ttp_matches
+    """
+    log_texts = list(log_texts)
+    results = [
+        {
+            "log_text": t,
+            "score": None,
+            "threshold": threshold,
+            "score_method": score_method,
+            "verdict": "unknown",
+            "neighbors": [],
+            "ttp_matches": [],
+        }
+        for t in log_texts
+    ]
+    if not log_texts:
+        return results
 
-    query = _build_knn_query(query_vector=vector, k=k, size=k, filters=filters)
-    
     try:
-        response = client.search(index=index_name, body=query)
+        vectors = llm.get_embeddings([_embedding_text(t) for t in log_texts])
     except Exception as e:
-        print(f"  搜尋失敗: {e}")
-        return
+        for r in results:
+            r["error"] = f"embedding failed: {e}"
+        return results
 
-    hits = response.get("hits", {}).get("hits", [])
+    for r, hits in zip(results, _knn_search_batch(vectors, k=k, filters=filters)):
+        if hits is None:
+            r["error"] = "search failed"
+            continue
+        if not hits:
+            r["error"] = "no baseline data"
+            continue
 
-    if not hits:
-        print("      無可比對資料（資料庫空或 filter 後無結果）。")
-        return
+        score = _anomaly_score_from_hits(hits, k=k, method=score_method)
+        r["score"] = score
+        r["verdict"] = "anomaly" if score > threshold else "benign"
+        r["neighbors"] = [
+            {"id": h["_id"], "sim": h["_score"], "log_text": h.get("_source", {}).get("log_text", "")}
+            for h in hits
+        ]
+
+    if TTP_LINK if link_ttps is None else link_ttps:
+        anomalous = [i for i, r in enumerate(results) if r["verdict"] == "anomaly"]
+        for i, matches in zip(anomalous, _link_ttp_batch([vectors[i] for i in anomalous])):
+            results[i]["ttp_matches"] = matches
+
+    return results
+
+
+def detect_partitioned(log_texts, thresholds, default_threshold, sources=None, k=K, score_method="kth"):
+    """
+    依 log_source 分流：每筆使用該 source 的 threshold 與 filtered kNN
+    sources 不給時用 infer_log_source 判斷；沒有 threshold 的 source 退回全域 baseline
+    """
+    log_texts = list(log_texts)
+    if sources is None:
+        sources = [infer_log_source(t) for t in log_texts]
+
+    groups = {}
+    for i, source in enumerate(sources):
+        groups.setdefault(source, []).append(i)
+
+    results = [None] * len(log_texts)
+    for source, idxs in groups.items():
+        if source in thresholds:
+            threshold, filters = thresholds[source], {"log_source": source}
+        else:
+            threshold, filters = default_threshold, None
+
+        batch = detect_batch([log_texts[i] for i in idxs], threshold, k=k, filters=filters, score_method=score_method)
+        for i, r in zip(idxs, batch):
+            r["log_source"] = source
+            r["partitioned"] = filters is not None
+            results[i] = r
+
+    return results
+
+
+def detect(log_text, threshold, k=K, filters=None, score_method="kth", print_top=5):
+    print(f"\n  正在分析 Log: '{log_text}'")
+
+    r = detect_batch([log_text], threshold, k=k, filters=filters, score_method=score_method)[0]
+
+    if r["verdict"] == "unknown":
+        if r.get("error") == "no baseline data":
+            print("      無可比對資料（資料庫空或 filter 後無結果）。")
+        else:
+            print(f"  偵測失敗: {r.get('error')}")
+        return r
+
+    anomaly_score = r["score"]
 
-    anomaly_score = _anomaly_score_from_hits(hits, k=k, method=score_method)
-    
     print("   -> Top neighbors:")
-    for i, h in enumerate(hits[:print_top], 1):
-        txt = h["_source"].get("log_text", "")
-        print(f"      {i}. sim={h['_score']:.4f} | {txt[:60]}...")
+    for i, n in enumerate(r["neighbors"][:print_top], 1):
+        print(f"      {i}. sim={n['sim']:.4f} | {n['log_text'][:60]}...")
 
     print(f"   -> anomaly_score ({score_method}) = {anomaly_score:.4f}")
     print(f"   -> threshold (P{int(QUANTILE*100)}) = {threshold:.4f}")
 
-    if anomaly_score > threshold:
+    if r["verdict"] == "anomaly":
         print(f"  [異常 DETECTED] Score {anomaly_score:.4f} > {threshold:.4f}")
+        for m in r["ttp_matches"]:
+            print(f"      ~ {m['mitre_id'] or '-'} {m['name']} (sim={m['sim']:.4f}, {m['kind']})")
     else:
         print(f"  [正常 BENIGN] Score {anomaly_score:.4f} <= {threshold:.4f}")
+    return r
+
+
+def _iter_batches(lines, batch_size):
+    batch = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Layer 5 semantic anomaly detection")
+    parser.add_argument("--file", help="要偵測的 log 檔 (一行一筆)")
+    parser.add_argument("--stdin", action="store_true", help="從 stdin 讀取 log")
+    parser.add_argument("--threshold", type=float, help="指定 threshold (不指定則自動校正)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--k", type=int, default=K)
+    parser.add_argument("--score-method", choices=["kth", "avg", "max"], default="kth")
+    parser.add_argument("--recalibrate", action="store_true", help="忽略已儲存的 threshold，重新完整校正")
+    parser.add_argument("--incremental", action="store_true", help="只對新進 baseline 做增量校正")
+    parser.add_argument("--per-source", action="store_true", help="依 log_source 使用各自的 threshold 與 kNN filter")
+    parser.add_argument("--calibrate-sources", action="store_true", help="只校正所有 log_source 的 threshold 後結束")
+    args = parser.parse_args()
+    if args.incremental and KNN_ENGINE == "local":
+        parser.error("--incremental 需要 OpenSearch (KNN_ENGINE=local 的索引沒有 timestamp 游標)，請改用 --recalibrate")
+
+    batch_mode = bool(args.file or args.stdin)
+
+    # 讀取 / 自動校正 threshold (批次模式下訊息改印到 stderr，stdout 只留 JSON 結果)
+    with contextlib.redirect_stdout(sys.stderr if batch_mode else sys.stdout):
+        threshold = args.threshold
+        if threshold is None:
+            threshold = load_threshold(k=args.k, score_method=args.score_method,
+                                       refresh=args.recalibrate, incremental=args.incremental)
+        if threshold is None:
+            threshold = DEFAULT_THRESHOLD
+            print(f"   使用預設閾值: {threshold}")
+
+        source_thresholds = {}
+        if args.per_source or args.calibrate_sources:
+            source_thresholds = calibrate_all_sources(k=args.k, score_method=args.score_method,
+                                                      refresh=args.recalibrate, incremental=args.incremental)
+
+    if args.calibrate_sources:
+        return
+
+    if not batch_mode:
+        # test case 1: 正常
+        normal_test = "User admin logged in successfully from 192.168.1.5"
+        detect(normal_test, threshold=threshold, k=args.k, score_method=args.score_method)
+
+        # test case 2: 攻擊
+        malicious_test = "Suspicious process mimikatz.exe dumping credentials from lsass.exe"
+        detect(malicious_test, threshold=threshold, k=args.k, score_method=args.score_method)
+        return
+
+    # 批次模式: 每筆結果輸出一行 JSON
+    source = open(args.file, encoding="utf-8", errors="ignore") if args.file else sys.stdin
+    try:
+        for batch in _iter_batches(source, args.batch_size):
+            if args.per_source:
+                results = detect_partitioned(batch, source_thresholds, threshold,
+                                             k=args.k, score_method=args.score_method)
+            else:
+                results = detect_batch(batch, threshold, k=args.k, score_method=args.score_method)
+            for r in results:
+                r["neighbors"] = [{"id": n["id"], "sim": n["sim"]} for n in r["neighbors"]]
+                print(json.dumps(r, ensure_ascii=False))
+    finally:
+        if args.file:
+            source.close()
 
 
 if __name__ == "__main__":
-    # 自動校正
-    threshold = calibrate_threshold(score_method="kth")
-    if threshold is None:
-        threshold = 0.35 
-        print(f"   使用預設閾值: {threshold}")
-
-    # test case 1: 正常
-    normal_test = "User admin logged in successfully from 192.168.1.5"
-    detect(normal_test, threshold=threshold)
-
-    # test case 2: 攻擊
-    malicious_test = "Suspicious process mimikatz.exe dumping credentials from lsass.exe"
-    detect(malicious_test, threshold=threshold)
\ No newline at end of file
+    main()
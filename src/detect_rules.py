@@ -1,60 +1,115 @@
 import json
+import logging
 import re
 import os
+import threading
+
+from .ioc_matcher import IOCMatcher
+from .stix_pattern import PatternError, compile_indicators, compile_pattern
+
+logger = logging.getLogger(__name__)
 
 # 設定檔案路徑
-STIX_FILE = "out/bundle_stix21.json" 
+STIX_DIR = "out"  # run_pipeline 產生的所有 *_bundle.json 都在這裡
+
+# 最近一次以 list 傳入的 IOC 清單與其編譯結果 (保留 list 的參照，id 不會被重複使用)
+_matcher_cache = None
+_matcher_cache_lock = threading.Lock()
+
+def iocs_from_bundle(bundle):
+    """
+    從已解析的 STIX bundle 取出 indicator 的值 (不印訊息，給 IOCStore 等批次流程使用)
+    pattern 先交給 stix_pattern 解析成有型別的 IOC (含 OR / AND 複合條件、CIDR、各種 hash)，
+    解析失敗的 pattern 才退回舊的單一 regex
+    """
+    iocs = []
+    
+    # 抓取 indicator
+    for obj in bundle.get("objects", []):
+        if obj.get("type") != "indicator":
+            continue
+        compiled = compile_indicators([obj])
+        if compiled:
+            iocs.extend(compiled)
+            continue
+        try:
+            compile_pattern(obj.get("pattern", ""))
+            continue  # 語法正確但沒有可比對的值 (例如只有 != 條件)
+        except PatternError:
+            pass
+        match = re.search(r"value\s*=\s*'([^']+)'", obj.get("pattern", ""))
+        if match:
+            iocs.append({
+                "value": match.group(1),
+                "name": obj.get("name"),
+                "id": obj.get("id")
+            })
+    return iocs
+
 def load_stix_indicators(filepath):
     """
     從 STIX 檔案中提取出黑名單
     """
     if not os.path.exists(filepath):
-        print(f"  找不到 STIX 檔案: {filepath}")
+        logger.warning(f"  找不到 STIX 檔案: {filepath}")
         return []
 
     with open(filepath, 'r', encoding='utf-8') as f:
         bundle = json.load(f)
 
-    iocs = []
+    iocs = iocs_from_bundle(bundle)
     
-    # 抓取 indicator
-    for obj in bundle.get("objects", []):
-        if obj.get("type") == "indicator":
-            pattern = obj.get("pattern", "")
-            match = re.search(r"value\s*=\s*'([^']+)'", pattern)
-            if match:
-                ioc_value = match.group(1)
-                iocs.append({
-                    "value": ioc_value,
-                    "name": obj.get("name"),
-                    "id": obj.get("id")
-                })
-    
-    print(f"  從 STIX 載入了 {len(iocs)} 個黑名單指標 (IOCs)")
+    logger.info(f"  從 STIX 載入了 {len(iocs)} 個黑名單指標 (IOCs)")
     return iocs
 
+def compile_matcher(iocs):
+    """
+    把 IOC 清單編譯成 IOCMatcher (hash lookup + Aho-Corasick)
+    同一個 list (且長度未變) 重複傳入時沿用上次的編譯結果，逐行呼叫也只編譯一次
+    """
+    global _matcher_cache
+    if isinstance(iocs, IOCMatcher):
+        return iocs
+    with _matcher_cache_lock:
+        cached = _matcher_cache
+        if cached is not None and cached[0] is iocs and cached[1] == len(iocs):
+            return cached[2]
+        matcher = IOCMatcher(iocs)
+        _matcher_cache = (iocs, len(iocs), matcher)
+        return matcher
+
 def check_logs_against_rules(log_text, iocs):
     """
-    規則比對：檢查 Log 裡面有沒有包含黑名單字串
+    規則比對：檢查 Log 裡面有沒有包含黑名單 (iocs 可以是清單或已編譯的 IOCMatcher)
+    回傳命中的結構化結果 (不輸出訊息，逐行呼叫的熱路徑)
     """
-    detected = False
+    return compile_matcher(iocs).match(log_text)
+
+def print_rule_hits(log_text, hits):
     print(f"\n  [Layer 4 規則掃描] 分析 Log: {log_text}")
-    
-    for ioc in iocs:
-        # 字串比對 如果黑名單 IP 出現在 Log 裡
-        if ioc["value"] in log_text:
-            print(f"     [命中規則] 發現已知威脅！")
-            print(f"      - 偵測對象: {ioc['value']}")
-            print(f"      - STIX 指標: {ioc['name']}")
-            detected = True
-            
-    if not detected:
+    for hit in hits:
+        print(f"     [命中規則] 發現已知威脅！")
+        print(f"      - 偵測對象: {hit['value']}")
+        print(f"      - STIX 指標: {hit['name']}")
+    if not hits:
         print("     未觸發靜態規則 (不在黑名單內)")
 
+def load_ioc_store(bundle_dir=STIX_DIR):
+    """
+    載入 bundle_dir 下所有 STIX bundle 的 IOC (使用持久化的 index，只解析新增 / 變更的檔案)
+    """
+    from .ioc_store import IOCStore
+
+    store = IOCStore(bundle_dir)
+    stats = store.refresh()
+    logger.info(f"  IOC 庫: {len(store)} 個指標 (新解析 {stats['added_files']} 份 bundle, 新增 {stats['new_iocs']} 個 IOC)")
+    return store
+
 def main():
-    iocs = load_stix_indicators(STIX_FILE)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    store = load_ioc_store()
     
-    if not iocs:
+    if not len(store):
         print("  沒有黑名單可以比對，請先執行 run_pipeline.py 產生 STIX 檔。")
         return
 
@@ -66,8 +121,9 @@ def main():
     # case B: 正常的 Log
     test_log_2 = "User admin logged in from 192.168.1.1."
     
-    check_logs_against_rules(test_log_1, iocs)
-    check_logs_against_rules(test_log_2, iocs)
+    matcher = store.matcher
+    for log_text in (test_log_1, test_log_2):
+        print_rule_hits(log_text, check_logs_against_rules(log_text, matcher))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
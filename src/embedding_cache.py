@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from .sqlite_cache import SQLiteLRUCache
+
+DEFAULT_CACHE_PATH = ".cache/embeddings.sqlite3"
+DEFAULT_MAX_ENTRIES = 500_000
+
+
+def normalize_text(text: str) -> str:
+    # 只壓縮空白，避免同一行 Log 因為換行/縮排不同而 cache miss
+    return " ".join(text.split())
+
+
+class EmbeddingCache(SQLiteLRUCache):
+    """
+    以 (model, normalized text) 的 hash 為 key 的持久化 Embedding cache
+
+    - 存在 SQLite (WAL 模式)，ingest 與 detect 兩個 process 可同時共用
+    - 向量以 float32 / float16 packed bytes 儲存
+    - 超過 max_entries 時依 last_used 做 LRU 淘汰
+    """
+
+    TABLE = "embeddings"
+    COLUMNS = ("dtype TEXT NOT NULL", "vector BLOB NOT NULL")
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 dtype: str = "float32") -> None:
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"Unsupported embedding cache dtype: {dtype}")
+        self.dtype = dtype
+        super().__init__(path, max_entries)
+
+    @classmethod
+    def from_env(cls) -> Optional["EmbeddingCache"]:
+        """
+        EMBEDDING_CACHE_PATH 設為空字串即可關閉 cache
+        """
+        path = os.getenv("EMBEDDING_CACHE_PATH", DEFAULT_CACHE_PATH)
+        if not path:
+            return None
+        return cls(
+            path=path,
+            max_entries=int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", str(DEFAULT_MAX_ENTRIES))),
+            dtype=os.getenv("EMBEDDING_CACHE_DTYPE", "float32"),
+        )
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        keys = [self.make_key(model, t) for t in texts]
+        found = {
+            key: np.frombuffer(blob, dtype=dtype).astype(np.float32).tolist()
+            for key, (dtype, blob) in self._get_rows(keys).items()
+        }
+        return [found.get(k) for k in keys]
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        return self.get_many(model, [text])[0]
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        self._put_rows({
+            self.make_key(model, t): (self.dtype, np.asarray(v, dtype=self.dtype).tobytes())
+            for t, v in zip(texts, vectors)
+        })
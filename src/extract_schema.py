@@ -30,6 +30,29 @@ Rules:
 - If unknown, use null or empty arrays.
 """
 
+# IOC 已由 ioc_extract 以 regex 抽出時使用: LLM 只需處理摘要、TTP、actor 與 log 建議
+EXTRACTION_SCHEMA_DESCRIPTION_NO_INDICATORS = """
+Return a JSON object with these keys:
+
+- summary: string, short summary of the CTI report
+- ttps: array of objects:
+    - name: string (e.g., "PowerShell")
+    - mitre_technique_id: string | null (e.g., "T1059.001") if confidently mapped
+    - description: string
+- actor: string | null
+- malware_or_tool: string[]  (names if present)
+- confidence: integer 0-100 (your confidence in extraction)
+- log_suggestions: array of objects:
+    - log_type: string (e.g., "windows_security", "dns", "proxy", "edr_process")
+    - fields: string[] (suggested fields, e.g., "process.command_line")
+    - rationale: string (why this log_type/fields relates to the TTP/indicator)
+
+Rules:
+- Only output valid JSON (no markdown).
+- Do not list IPs, domains, URLs or hashes; they are extracted separately.
+- If unknown, use null or empty arrays.
+"""
+
 DEFAULT_SYSTEM_PROMPT = """You are a cybersecurity threat intelligence extraction engine.
 You must strictly output VALID JSON only. Do not include markdown, comments, or trailing commas.
 """
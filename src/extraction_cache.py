@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, Optional
+
+from .sqlite_cache import SQLiteLRUCache
+
+DEFAULT_CACHE_PATH = ".cache/extractions.sqlite3"
+DEFAULT_MAX_ENTRIES = 50_000
+
+
+class ExtractionCache(SQLiteLRUCache):
+    """
+    LLM 抽取結果的持久化 cache，key 是 (報告內容, system prompt, schema, model, 切塊設定) 的 hash
+
+    - 同一份報告重新丟進 data/input，或 STIX 轉換修正後 --reprocess，都不必再呼叫 LLM
+    - prompt / schema / model / 切塊大小任何一個改變都會自然 cache miss
+    - 只存 LLM 的輸出；本地 regex 抽出的 IOC 每次重算，修正 ioc_extract 後 --reprocess 就會生效
+    - 超過 max_entries 時依 last_used 做 LRU 淘汰
+    """
+
+    TABLE = "extractions"
+    COLUMNS = ("model TEXT NOT NULL", "report_sha256 TEXT NOT NULL", "extracted TEXT NOT NULL",
+               "created_at REAL NOT NULL")
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        super().__init__(path, max_entries)
+
+    @classmethod
+    def from_env(cls) -> Optional["ExtractionCache"]:
+        """
+        EXTRACTION_CACHE_PATH 設為空字串即可關閉 cache
+        """
+        path = os.getenv("EXTRACTION_CACHE_PATH", DEFAULT_CACHE_PATH)
+        if not path:
+            return None
+        return cls(path, max_entries=int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", str(DEFAULT_MAX_ENTRIES))))
+
+    @staticmethod
+    def report_hash(report_text: str) -> str:
+        return hashlib.sha256(report_text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def make_key(report_text: str, system_prompt: str, schema: str, model: str, settings: str = "") -> str:
+        h = hashlib.sha256()
+        for part in (model, system_prompt, schema, settings, report_text):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._get_rows([key]).get(key)
+        return json.loads(row[2]) if row else None
+
+    def put(self, key: str, model: str, report_text: str, extracted: Dict[str, Any]) -> None:
+        self._put_rows({key: (model, self.report_hash(report_text), json.dumps(extracted, ensure_ascii=False),
+                              time.time())})
@@ -0,0 +1,223 @@
+"""
+LLM / Embedding API 共用的 HTTP transport
+
+- 一個 process 共用一組長駐的 httpx.Client / httpx.AsyncClient (keep-alive 連線池，有 h2 時開 HTTP/2)；
+  AsyncClient 每個 event loop 各一個，asyncio.run 結束前請 await aclose()，close() 會關掉其餘仍可關的 client
+- 429 / 5xx / timeout 以 exponential backoff + jitter 重試，優先採用 Retry-After (retry-after-ms)
+- 每個 request 送出前先通過呼叫端指定的 RateLimiter (token bucket)
+"""
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+from .rate_limit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+RETRY_EXCEPTIONS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _retry_after(resp: httpx.Response) -> Optional[float]:
+    """
+    Azure / OpenAI 會回 retry-after-ms 或 Retry-After (秒數或 HTTP-date)
+    """
+    ms = resp.headers.get("retry-after-ms")
+    if ms:
+        try:
+            return float(ms) / 1000.0
+        except ValueError:
+            pass
+
+    value = resp.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HTTPTransport:
+    def __init__(self, timeout: float = 60.0, max_connections: int = 20, http2: Optional[bool] = None,
+                 max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 30.0) -> None:
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.http2 = http2_available() if http2 is None else http2
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._client: Optional[httpx.Client] = None
+        self._async_clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "HTTPTransport":
+        http2 = os.getenv("HTTP2", "auto").lower()
+        if http2 in ("1", "true", "yes") and not http2_available():
+            logger.warning("HTTP2=%s 但未安裝 h2 (pip install 'httpx[http2]')，改用 HTTP/1.1", http2)
+            http2 = "0"
+        return cls(
+            timeout=float(os.getenv("OPENAI_TIMEOUT", "60")),
+            max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "20")),
+            http2=None if http2 == "auto" else http2 in ("1", "true", "yes"),
+            max_retries=int(os.getenv("HTTP_MAX_RETRIES", "5")),
+            backoff_base=float(os.getenv("HTTP_BACKOFF_BASE", "0.5")),
+            backoff_max=float(os.getenv("HTTP_BACKOFF_MAX", "30")),
+        )
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.max_connections,
+                            max_keepalive_connections=self.max_connections)
+
+    @property
+    def client(self) -> httpx.Client:
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(timeout=self.timeout, limits=self._limits(), http2=self.http2)
+            return self._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        # AsyncClient 綁定建立它的 event loop，每個 loop 各一個；已關閉的 loop 留下的 client 無法再 await，直接丟掉
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                for old in [l for l in self._async_clients if l.is_closed()]:
+                    del self._async_clients[old]
+                client = httpx.AsyncClient(timeout=self.timeout, limits=self._limits(), http2=self.http2)
+                self._async_clients[loop] = client
+            return client
+
+    def _delay(self, attempt: int, resp: Optional[httpx.Response]) -> float:
+        if resp is not None:
+            hinted = _retry_after(resp)
+            if hinted is not None:
+                return min(hinted, self.backoff_max)
+        # full jitter，避免所有 worker 同時重試
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _should_retry(self, attempt: int, resp: Optional[httpx.Response]) -> bool:
+        if attempt >= self.max_retries:
+            return False
+        return resp is None or resp.status_code in RETRY_STATUSES
+
+    def post(self, url: str, *, json: Any = None, params: Optional[Dict[str, str]] = None,
+             headers: Optional[Dict[str, str]] = None, limiter: Optional[RateLimiter] = None,
+             tokens: int = 0) -> httpx.Response:
+        """
+        POST 並在可重試的錯誤時 backoff 重試；最後仍失敗就 raise (httpx.HTTPStatusError / TransportError)
+        """
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire(tokens)
+            resp: Optional[httpx.Response] = None
+            try:
+                resp = self.client.post(url, json=json, params=params, headers=headers)
+            except RETRY_EXCEPTIONS:
+                if not self._should_retry(attempt, None):
+                    raise
+            else:
+                if not self._should_retry(attempt, resp):
+                    resp.raise_for_status()
+                    return resp
+            time.sleep(self._delay(attempt, resp))
+            attempt += 1
+
+    async def apost(self, url: str, *, json: Any = None, params: Optional[Dict[str, str]] = None,
+                    headers: Optional[Dict[str, str]] = None, limiter: Optional[RateLimiter] = None,
+                    tokens: int = 0) -> httpx.Response:
+        attempt = 0
+        while True:
+            if limiter is not None:
+                wait = limiter.reserve(tokens)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            resp: Optional[httpx.Response] = None
+            try:
+                resp = await self.async_client.post(url, json=json, params=params, headers=headers)
+            except RETRY_EXCEPTIONS:
+                if not self._should_retry(attempt, None):
+                    raise
+            else:
+                if not self._should_retry(attempt, resp):
+                    resp.raise_for_status()
+                    return resp
+            await asyncio.sleep(self._delay(attempt, resp))
+            attempt += 1
+
+    @staticmethod
+    def _close_on_loop(loop: asyncio.AbstractEventLoop, client: httpx.AsyncClient, timeout: float = 5.0) -> None:
+        """
+        在 client 所屬的 loop 上關閉它 (loop 在別的 thread 執行中，或尚未關閉且閒置)；loop 已關閉就只能放掉
+        """
+        try:
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop).result(timeout)
+            elif not loop.is_closed():
+                loop.run_until_complete(client.aclose())
+        except Exception:
+            pass
+
+    def close(self) -> None:
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+            clients, self._async_clients = list(self._async_clients.items()), {}
+        for loop, client in clients:
+            self._close_on_loop(loop, client)
+
+    async def aclose(self) -> None:
+        """
+        關閉目前 loop 的 AsyncClient；其他仍在執行的 loop 上的 client 也一併關閉
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.pop(loop, None)
+            others = [(l, c) for l, c in self._async_clients.items() if l.is_running()]
+            for other_loop, _ in others:
+                del self._async_clients[other_loop]
+        if client is not None:
+            await client.aclose()
+        for other_loop, other in others:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(other.aclose(), other_loop))
+
+
+_transport: Optional[HTTPTransport] = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> HTTPTransport:
+    """
+    process 內共用的 transport (第一次呼叫時依環境變數建立)
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = HTTPTransport.from_env()
+        return _transport
@@ -1,10 +1,11 @@
-import time
-import os
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 load_dotenv()
 from opensearchpy import OpenSearch
+from .bulk_index import bulk_index, print_bulk_stats
 from .llm_client import LLMClient
+from .log_source import infer_log_source
+from .log_template import TemplateMiner, template_state_path, templates_enabled
 
 llm = LLMClient()
 client = OpenSearch(
@@ -51,26 +52,66 @@ normal_logs = [
     "System integrity check passed. No changes detected.",
 ] * 2
 
+def build_log_docs(log_texts, miner=None, extra_fields=None):
+    """
+    Log 文字 -> OpenSearch 文件 (含向量)
+    miner 不為 None 時同一個 template 只向量化一次；extra_fields 為每筆額外欄位 (可為 None)
+    extra_fields 沒有給 log_source 時用 infer_log_source 自動標記
+    """
+    # Template 模式: 同一個 template 只向量化一次，每行 Log 仍各自存一筆文件
+    if miner is not None:
+        clusters = [miner.add_log(t) for t in log_texts]
+        templates = {c.cluster_id: c.template for c in clusters}
+        vectors = llm.get_embeddings(list(templates.values()))
+        by_template = dict(zip(templates, vectors))
+        embeddings = [by_template[c.cluster_id] for c in clusters]
+    else:
+        clusters = None
+        # LLMClient 會自動切 batch 並併發送出
+        embeddings = llm.get_embeddings(log_texts)
+
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    docs = []
+    for i, (log_text, embedding) in enumerate(zip(log_texts, embeddings)):
+        doc = {
+            "timestamp": now,
+            "log_text": log_text,
+            "log_vector": embedding
+        }
+        if clusters is not None:
+            doc["template_id"] = clusters[i].cluster_id
+            doc["log_template"] = clusters[i].template
+        if extra_fields and extra_fields[i]:
+            doc.update(extra_fields[i])
+        if not doc.get("log_source"):
+            doc["log_source"] = infer_log_source(log_text)
+        docs.append(doc)
+    return docs
+
+
 def ingest_data():
     print(f"  開始匯入 {len(normal_logs)} 筆正常 Log 作為基準...")
-    
-    for log_text in normal_logs:
-        try:
-            print(f"正在向量化: {log_text[:30]}...")
-            embedding = llm.get_embedding(log_text)
 
-            doc = {
-                "timestamp": datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
-                "log_text": log_text,
-                "log_vector": embedding
-            }
-            
-            client.index(index=index_name, body=doc)
-            
-        except Exception as e:
-            print(f"  錯誤: {e}")
-            
-    client.indices.refresh(index=index_name)
+    miner = TemplateMiner.load(template_state_path()) if templates_enabled() else None
+
+    try:
+        print(f"正在批次向量化 {len(normal_logs)} 筆 Log...")
+        docs = build_log_docs(normal_logs, miner)
+    except Exception as e:
+        print(f"  Embedding 失敗: {e}")
+        return
+
+    if miner is not None:
+        print(f"  目前共 {len(miner.clusters)} 個 template")
+        miner.save(template_state_path())
+
+    try:
+        stats = bulk_index(client, index_name, docs, backfill=True)
+    except Exception as e:
+        print(f"  錯誤: {e}")
+        return
+
+    print_bulk_stats(stats)
     print("  所有 Log 匯入完成！")
 
 if __name__ == "__main__":
@@ -0,0 +1,301 @@
+"""
+監看 data/input：Linux 上用 inotify (ctypes，不需額外套件)，其他平台退回 polling
+
+- 只在檔案寫完後才回報: inotify 的 IN_CLOSE_WRITE / IN_MOVED_TO (atomic rename)，
+  polling 則要求連續兩次掃描的 size / mtime 不變
+- WorkJournal 以每個 process 一份的 append-only JSONL 記錄 claimed / done / failed，process crash 後
+  可以找回它處理中的檔案，並避免會讓 process 掛掉的檔案無限重試
+"""
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+DEFAULT_JOURNAL_DIR = "data/.pipeline_journal"
+
+
+class PollingWatcher:
+    """
+    定期 listdir；size / mtime 連續兩次相同才視為寫入完成
+    """
+
+    def __init__(self, path: str, accept: Callable[[str], bool], interval: float = 5.0) -> None:
+        self.path = path
+        self.accept = accept
+        self.interval = interval
+        self._last: Dict[str, Tuple[int, float]] = {}
+        self._reported: Set[str] = set()
+        self._first = True
+        self._unsettled = False
+
+    def _scan(self) -> List[str]:
+        current: Dict[str, Tuple[int, float]] = {}
+        for name in os.listdir(self.path):
+            if not self.accept(name):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            current[name] = (st.st_size, st.st_mtime)
+
+        ready = []
+        for name, sig in current.items():
+            # 啟動時已存在的檔案直接處理
+            if name not in self._reported and (self._first or self._last.get(name) == sig):
+                ready.append(name)
+        self._reported = {n for n in self._reported if n in current} | set(ready)
+        self._unsettled = any(n not in self._reported for n in current)
+        self._last = current
+        self._first = False
+        return sorted(ready)
+
+    def poll(self, timeout: float) -> List[str]:
+        if not self._first:
+            # 有還在寫入中的檔案時 1 秒後再確認一次，不必等完整個 interval
+            time.sleep(min(timeout, 1.0 if self._unsettled else self.interval))
+        return self._scan()
+
+    def rescan(self) -> List[str]:
+        self._reported.clear()
+        self._first = True
+        return self._scan()
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    """
+    inotify (透過 ctypes 呼叫 libc)；poll() 以 select 等待事件，沒有事件時不耗 CPU
+    """
+
+    def __init__(self, path: str, accept: Callable[[str], bool]) -> None:
+        self.path = path
+        self.accept = accept
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"inotify_add_watch failed: {path}")
+        self._pending_scan = True
+
+    def rescan(self) -> List[str]:
+        self._pending_scan = False
+        return sorted(n for n in os.listdir(self.path) if self.accept(n))
+
+    def poll(self, timeout: float) -> List[str]:
+        if self._pending_scan:
+            # 啟動時 (或 event queue overflow 後) 已存在的檔案
+            return self.rescan()
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        names: List[str] = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(buf):
+                _, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                raw = buf[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    self._pending_scan = True
+                    continue
+                if mask & IN_ISDIR or not raw:
+                    continue
+                name = os.fsdecode(raw)
+                if self.accept(name) and name not in names:
+                    names.append(name)
+
+        if self._pending_scan:
+            names = sorted(set(names) | set(self.rescan()))
+        return names
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def create_watcher(path: str, accept: Callable[[str], bool], poll_interval: float = 5.0):
+    """
+    INPUT_WATCHER=poll 強制使用 polling；否則在 Linux 上優先用 inotify
+    """
+    if os.getenv("INPUT_WATCHER", "auto").lower() != "poll" and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(path, accept)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(path, accept, interval=poll_interval)
+
+
+def _owner_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _try_lock(f) -> bool:
+    """
+    對 journal 檔取得 non-blocking exclusive flock；owner 在整個生命週期都持有自己檔案的鎖，
+    因此拿得到鎖就代表 owner 已經結束。沒有 fcntl (Windows) 時一律視為 owner 還活著
+    """
+    if fcntl is None:
+        return False
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def _replay_lines(f, attempts: Dict[str, int]) -> None:
+    for line in f:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue  # crash 時寫到一半的最後一行
+        name = entry.get("file")
+        if entry.get("event") == "claimed":
+            attempts[name] = entry.get("attempt", attempts.get(name, 0) + 1)
+        elif entry.get("event") in ("done", "failed", "forgotten"):
+            attempts.pop(name, None)
+
+
+class WorkJournal:
+    """
+    每個 pipeline process 一個 append-only JSONL (<dir>/<host>-<pid>.jsonl)：
+    {"event": "claimed" | "done" | "failed" | "forgotten", "file": ..., "ts": ...}，每筆 fsync
+
+    - process 執行期間持有自己 journal 的 flock；啟動時只接手拿得到鎖 (owner 已結束) 的 journal，
+      其他 process 處理中的檔案不會被搶走或計入嘗試次數
+    - 接手的 claimed 紀錄併入自己的 journal 後才刪除原檔，crash 在中間也不會遺失
+    """
+
+    def __init__(self, path: str = DEFAULT_JOURNAL_DIR) -> None:
+        self.dir = path
+        self.owner = _owner_id()
+        self.path = os.path.join(path, f"{self.owner}.jsonl")
+        self._lock = threading.Lock()
+        # 檔名 -> 嘗試次數 (尚未完成的檔案)
+        self.in_flight: Dict[str, int] = {}
+        Path(path).mkdir(parents=True, exist_ok=True)
+
+        self._f = open(self.path, "a+", encoding="utf-8")
+        if fcntl is not None:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+        # 同名檔案是之前同 pid (已結束) 的 process 留下的
+        self._f.seek(0)
+        _replay_lines(self._f, self.in_flight)
+        adopted = self._adopt_dead()
+        self._compact()
+        for f, dead_path in adopted:
+            os.unlink(dead_path)
+            f.close()
+
+    def _adopt_dead(self) -> List[Tuple[object, str]]:
+        """
+        讀入 owner 已結束的 journal；回傳仍持有鎖的檔案，等自己的 journal 寫好後再刪
+        """
+        adopted = []
+        for name in sorted(os.listdir(self.dir)):
+            other = os.path.join(self.dir, name)
+            if not name.endswith(".jsonl") or other == self.path:
+                continue
+            try:
+                f = open(other, "r", encoding="utf-8")
+            except FileNotFoundError:
+                continue
+            try:
+                # 拿到鎖之前檔案可能已被別的 process 接手刪掉
+                if not _try_lock(f) or os.fstat(f.fileno()).st_ino != os.stat(other).st_ino:
+                    f.close()
+                    continue
+            except FileNotFoundError:
+                f.close()
+                continue
+            attempts: Dict[str, int] = {}
+            _replay_lines(f, attempts)
+            for file_name, attempt in attempts.items():
+                self.in_flight[file_name] = max(attempt, self.in_flight.get(file_name, 0))
+            adopted.append((f, other))
+        return adopted
+
+    def _compact(self) -> None:
+        # 鎖在同一個 inode 上，所以原地 truncate 而不是 rename
+        self._f.seek(0)
+        self._f.truncate()
+        for name, attempt in self.in_flight.items():
+            self._f.write(json.dumps({"event": "claimed", "file": name, "attempt": attempt}, ensure_ascii=False) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def _write(self, entry: Dict[str, object]) -> None:
+        # 呼叫端需持有 self._lock
+        entry["ts"] = time.time()
+        self._f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def claimed(self, name: str) -> None:
+        with self._lock:
+            attempt = self.in_flight.get(name, 0) + 1
+            self.in_flight[name] = attempt
+            self._write({"event": "claimed", "file": name, "attempt": attempt})
+
+    def finished(self, name: str, ok: bool) -> None:
+        with self._lock:
+            self.in_flight.pop(name, None)
+            self._write({"event": "done" if ok else "failed", "file": name})
+
+    def forget(self, name: str) -> None:
+        """
+        不再追蹤這個檔案 (已不存在，或 claim 時被別的 process 搶走)
+        """
+        with self._lock:
+            if self.in_flight.pop(name, None) is not None:
+                self._write({"event": "forgotten", "file": name})
+
+    def attempts(self, name: str) -> int:
+        with self._lock:
+            return self.in_flight.get(name, 0)
+
+    def close(self) -> None:
+        with self._lock:
+            # 沒有未完成的檔案就不留 journal；否則留給下一個啟動的 process 接手
+            if not self.in_flight:
+                os.unlink(self.path)
+            self._f.close()
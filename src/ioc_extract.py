@@ -0,0 +1,175 @@
+"""
+在呼叫 LLM 之前先用 regex 抽出 IOC (IP / domain / URL / MD5 / SHA1 / SHA256)
+
+- 支援常見的 defang 寫法: hxxp://, [.], (.), {.}, [dot], [:]，抽取前先還原
+- 輸出格式與 EXTRACTION_SCHEMA_DESCRIPTION 的 indicators 區塊相同
+- 先切 token 去重，只對可能是 IOC 的 token 跑 regex，多 MB 的報告也很快
+- IPv6 至少要有 3 個明確的 group，"::" 這類程式碼片段不算
+- domain 的結尾必須是已知的 TLD，並排除 System.Management.Automation 這類程式命名空間；
+  前面是 version / build 等字樣的 a.b.c.d 是版本號，不當成 IPv4
+"""
+from __future__ import annotations
+
+import ipaddress
+import os
+import re
+from typing import Any, Dict, List
+
+_REFANG_RE = re.compile(
+    r"h[xX]{2}p(s?)(?=\[?:)|\[\.\]|\(\.\)|\{\.\}|\[dot\]|\(dot\)|\[:\]|\[/\]|\[://\]",
+    re.IGNORECASE,
+)
+
+_URL_RE = re.compile(r"\b(?:https?|ftp)://[^\s<>\"'`\]\)]+", re.IGNORECASE)
+_IPV4_RE = re.compile(r"(?<![A-Za-z\d.])(?:(?:25[0-5]|2[0-4]\d|1?\d?\d)\.){3}(?:25[0-5]|2[0-4]\d|1?\d?\d)(?![\d.]*\d)")
+_IPV6_RE = re.compile(r"(?<![0-9A-Fa-f:])(?:[0-9A-Fa-f]{0,4}:){2,7}[0-9A-Fa-f]{0,4}(?![0-9A-Fa-f:])")
+_DOMAIN_RE = re.compile(r"\b(?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+[A-Za-z]{2,63}\b")
+_HASH_RE = re.compile(r"\b(?:[0-9A-Fa-f]{64}|[0-9A-Fa-f]{40}|[0-9A-Fa-f]{32})\b")
+
+_HASH_LEN_KEYS = {32: "md5", 40: "sha1", 64: "sha256"}
+
+# 版本號: "version 1.2.3.4"、"v 10.0.19041.1"、"build: 6.1.7601.17514"
+_VERSION_RE = re.compile(r"\b(?:v|ver|version|build|release|rev|revision)\b[\s.:=#]*((?:\d+\.){3}\d+)", re.IGNORECASE)
+
+# 看起來像網域、其實是檔名的結尾
+_FILE_EXTENSIONS = {
+    "exe", "dll", "sys", "bat", "cmd", "ps1", "psm1", "vbs", "js", "jar", "py", "sh", "lnk", "scr",
+    "msi", "hta", "doc", "docx", "docm", "xls", "xlsx", "xlsm", "ppt", "pptx", "pdf", "rtf", "txt",
+    "log", "csv", "json", "xml", "yaml", "yml", "ini", "cfg", "conf", "dat", "bin", "tmp", "zip",
+    "rar", "gz", "tar", "iso", "img", "png", "jpg", "jpeg", "gif", "html", "htm", "php", "asp",
+    "aspx", "jsp", "md", "so", "elf", "apk", "db", "sqlite",
+}
+
+
+# 有效的 TLD：所有 ccTLD、傳統 gTLD，以及威脅情資中常見的新 gTLD (IOC_EXTRA_TLDS 可再補充，逗號分隔)
+_CC_TLDS = (
+    "ac ad ae af ag ai al am ao aq ar as at au aw ax az ba bb bd be bf bg bh bi bj bm bn bo br bs bt bw by bz "
+    "ca cc cd cf cg ch ci ck cl cm cn co cr cu cv cw cx cy cz de dj dk dm do dz ec ee eg er es et eu fi fj fk "
+    "fm fo fr ga gb gd ge gf gg gh gi gl gm gn gp gq gr gs gt gu gw gy hk hm hn hr ht hu id ie il im in io iq "
+    "ir is it je jm jo jp ke kg kh ki km kn kp kr kw ky kz la lb lc li lk lr ls lt lu lv ly ma mc md me mg mh "
+    "mk ml mm mn mo mp mq mr ms mt mu mv mw mx my mz na nc ne nf ng ni nl no np nr nu nz om pa pe pf pg ph pk "
+    "pl pm pn pr ps pt pw py qa re ro rs ru rw sa sb sc sd se sg sh si sk sl sm sn so sr ss st su sv sx sy sz "
+    "tc td tf tg th tj tk tl tm tn to tr tt tv tw tz ua ug uk us uy uz va vc ve vg vi vn vu wf ws ye yt za zm zw"
+)
+_G_TLDS = (
+    "com net org info biz gov edu mil int arpa name pro aero asia cat coop jobs mobi museum tel travel post xxx "
+    "app dev xyz top online site club shop store tech live icu vip work space website fun buzz cloud link click "
+    "email host press blog page art ink wiki zone today world life news agency digital network services "
+    "solutions systems support center company group media studio global city one win bid loan download review "
+    "stream party science trade date faith racing cricket accountant men kim country gdn rest bar cyou monster "
+    "sbs cfd quest lol mom best bond beauty hair skin makeup autos boats homes yachts cam casa pics photo photos "
+    "gallery games guru help land lat ltd llc ninja plus run social software team tips tools wtf red blue pink "
+    "black green gold money cash finance fund capital exchange market trading bank chat cyber security "
+    "tokyo moscow berlin london nyc paris africa "
+    "google microsoft windows azure office youtube apple amazon"
+)
+_TLDS = frozenset((_CC_TLDS + " " + _G_TLDS).split())
+
+# 程式碼 / 設定檔的命名空間，第一段是這些字時不是網域 (System.IO、Microsoft.Win32.Registry、user.name ...)
+_NAMESPACE_ROOTS = frozenset({
+    "system", "microsoft", "mscorlib", "windows", "java", "javax", "android", "androidx", "kotlin",
+    "newtonsoft", "self", "this", "document", "window", "console", "process", "os", "sys", "math",
+    "user", "config", "settings", "request", "response", "wscript", "shell", "object",
+})
+
+
+def _valid_tlds() -> frozenset:
+    extra = os.getenv("IOC_EXTRA_TLDS", "")
+    if not extra:
+        return _TLDS
+    return _TLDS | {t.strip().lower().lstrip(".") for t in extra.split(",") if t.strip()}
+
+
+def _is_domain(cand: str, tlds: frozenset) -> bool:
+    labels = cand.split(".")
+    return labels[-1] in tlds and labels[-1] not in _FILE_EXTENSIONS and labels[0] not in _NAMESPACE_ROOTS
+
+
+def _is_ipv6(cand: str) -> bool:
+    # "::"、"a::b"、"dead::beef" 是 PowerShell [Type]::Method / C++ std:: 之類的程式碼；
+    # 至少要 3 個明確的 group 且含數字，並排除 :: / ::1
+    groups = [g for g in cand.split(":") if g]
+    if len(groups) < 3 or not any(c.isdigit() for c in cand):
+        return False
+    try:
+        addr = ipaddress.IPv6Address(cand)
+    except ValueError:
+        return False
+    return not (addr.is_unspecified or addr.is_loopback)
+
+
+_REFANG_MAP = {"[:]": ":", "[/]": "/", "[://]": "://"}
+
+
+def _refang_match(m: re.Match) -> str:
+    token = m.group(0)
+    if token[0] in "hH":
+        return "http" + m.group(1)
+    return _REFANG_MAP.get(token, ".")
+
+
+def refang(text: str) -> str:
+    """
+    hxxp[:]//evil[.]com -> http://evil.com
+    """
+    return _REFANG_RE.sub(_refang_match, text)
+
+
+def _unique(values: List[str]) -> List[str]:
+    return list(dict.fromkeys(values))
+
+
+def extract_iocs(text: str) -> Dict[str, Any]:
+    """
+    回傳 {"ipv4", "ipv6", "domains", "urls", "hashes": {"md5", "sha1", "sha256"}}
+
+    IOC 不會含空白，所以先用 str.split 切 token 並去重 (C 速度)，
+    只有含 "." / ":" 或長度夠當 hash 的 token 才進 regex
+    """
+    urls: List[str] = []
+    ipv4: List[str] = []
+    ipv6: List[str] = []
+    domains: List[str] = []
+    hashes: Dict[str, List[str]] = {"md5": [], "sha1": [], "sha256": []}
+    tlds = _valid_tlds()
+
+    for tok in dict.fromkeys(text.split()):
+        if "." not in tok and ":" not in tok and len(tok) < 32:
+            continue
+        if "[" in tok or "(" in tok or "{" in tok or tok[:4].lower() == "hxxp":
+            tok = refang(tok)
+
+        if "://" in tok:
+            urls.extend(u.rstrip(".,;:!?") for u in _URL_RE.findall(tok))
+            # URL 內的 host / path 不重複當成 domain 或 IP
+            tok = _URL_RE.sub(" ", tok)
+
+        if len(tok) >= 32:
+            for h in _HASH_RE.findall(tok):
+                hashes[_HASH_LEN_KEYS[len(h)]].append(h.lower())
+
+        if tok.count(":") >= 2:
+            for cand in _IPV6_RE.findall(tok):
+                if _is_ipv6(cand):
+                    ipv6.append(str(ipaddress.IPv6Address(cand)))
+
+        if "." in tok:
+            ipv4.extend(_IPV4_RE.findall(tok))
+            for cand in _DOMAIN_RE.findall(tok):
+                cand = cand.lower()
+                if _is_domain(cand, tlds):
+                    domains.append(cand)
+
+    if ipv4:
+        # 版本號要看前一個字，token 化後看不到，只有真的抽到 IPv4 時才掃一次全文
+        versions = set(_VERSION_RE.findall(text))
+        if versions:
+            ipv4 = [ip for ip in ipv4 if ip not in versions]
+
+    return {
+        "ipv4": _unique(ipv4),
+        "ipv6": _unique(ipv6),
+        "domains": _unique(domains),
+        "urls": _unique(urls),
+        "hashes": {k: _unique(v) for k, v in hashes.items()},
+    }
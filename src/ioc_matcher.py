@@ -0,0 +1,330 @@
+from __future__ import annotations
+
+import ipaddress
+import re
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .stix_pattern import CompiledPattern, PatternError, compile_pattern
+
+# Log 內可能是 IOC 的 token
+_IPV4_RE = re.compile(r"(?<![\d.])(?:\d{1,3}\.){3}\d{1,3}(?![\d.]*\d)")
+_IPV6_RE = re.compile(r"(?<![0-9A-Fa-f:])(?:[0-9A-Fa-f]{0,4}:){2,7}[0-9A-Fa-f]{0,4}(?![0-9A-Fa-f:])")
+_HASH_RE = re.compile(r"\b(?:[0-9A-Fa-f]{128}|[0-9A-Fa-f]{64}|[0-9A-Fa-f]{40}|[0-9A-Fa-f]{32})\b")
+_DOMAIN_RE = re.compile(r"\b(?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+[A-Za-z]{2,63}\b")
+
+_HASH_LEN_TYPES = {32: "md5", 40: "sha1", 64: "sha256", 128: "sha512"}
+
+# IOCMatcher.to_dict 保存的 IOC 欄位
+_PERSISTED_FIELDS = ("value", "type", "name", "id", "conjunction", "pattern")
+
+
+def guess_ioc_type(value: str) -> str:
+    """
+    依值的格式猜 IOC 類型: ipv4 / ipv6 / hash / url / domain / substring
+    """
+    v = value.strip()
+    try:
+        ip = ipaddress.ip_address(v)
+        return "ipv4" if ip.version == 4 else "ipv6"
+    except ValueError:
+        pass
+    if re.fullmatch(r"[0-9A-Fa-f]+", v) and len(v) in _HASH_LEN_TYPES:
+        return "hash"
+    if "://" in v:
+        return "url"
+    if _DOMAIN_RE.fullmatch(v):
+        return "domain"
+    return "substring"
+
+
+class AhoCorasick:
+    """
+    純 Python 的 Aho-Corasick automaton，一次掃描找出所有 pattern
+    """
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[str]] = [[]]
+        for p in patterns:
+            if p:
+                self._add(p)
+        self._build()
+
+    def _add(self, pattern: str) -> None:
+        node = 0
+        for ch in pattern:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        if pattern not in self._out[node]:
+            self._out[node].append(pattern)
+
+    def _build(self) -> None:
+        q = deque(self._goto[0].values())
+        while q:
+            node = q.popleft()
+            for ch, nxt in self._goto[node].items():
+                q.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                # 根節點的子節點 fail 一律指回根
+                self._fail[nxt] = self._goto[f].get(ch, 0) if node else 0
+                self._out[nxt].extend(self._out[self._fail[nxt]])
+
+    def __bool__(self) -> bool:
+        return len(self._goto) > 1
+
+    def find(self, text: str) -> List[Tuple[int, str]]:
+        """
+        回傳 (結束位置, pattern)
+        """
+        found: List[Tuple[int, str]] = []
+        node = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                for p in out[node]:
+                    found.append((i, p))
+        return found
+
+
+class IOCMatcher:
+    """
+    由 load_stix_indicators 的結果編譯出來的 IOC 比對器
+
+    - IP / hash: 從 Log 抽 token 後做 hash lookup
+    - CIDR: 依 prefix length 分組，每組是 network address 的 hash set；
+      查詢時對每個出現過的 prefix length 做一次 mask + lookup (最多 32 / 128 次)
+    - domain: 同上，另外比對所有上層網域 (suffix match，a.evil.com 命中 evil.com)
+    - URL 與其他字串: Aho-Corasick 一次掃描 (不分大小寫)
+    - AND pattern 內的 IOC (conjunction=True) 只是候選：命中後用 Log 內抽出的值 evaluate 整個 pattern，
+      其他條件不成立就不算命中
+    """
+
+    def __init__(self, iocs: Sequence[Dict[str, Any]] = ()) -> None:
+        self.ips: Dict[str, List[Dict[str, Any]]] = {}
+        # (ip version, prefix length) -> {int(network address): iocs}
+        self.networks: Dict[Tuple[int, int], Dict[int, List[Dict[str, Any]]]] = {}
+        self.hashes: Dict[str, List[Dict[str, Any]]] = {}
+        self.domains: Dict[str, List[Dict[str, Any]]] = {}
+        self.substrings: Dict[str, List[Dict[str, Any]]] = {}
+        self.size = 0
+        self._automaton = AhoCorasick(())
+        # conjunction IOC 的 pattern -> 編譯結果 (無法解析時為 None)
+        self._patterns: Dict[str, Optional[CompiledPattern]] = {}
+        self.add(iocs)
+
+    def add(self, iocs: Iterable[Dict[str, Any]]) -> None:
+        """
+        增量加入 IOC；只有新增 URL / 字串類 IOC 時才重建 Aho-Corasick
+        """
+        new_substrings = False
+        for ioc in iocs:
+            value = (ioc.get("value") or "").strip()
+            if not value:
+                continue
+            ioc_type = ioc.get("type") or guess_ioc_type(value)
+            if ioc.get("conjunction") and ioc.get("pattern") not in self._patterns:
+                try:
+                    self._patterns[ioc["pattern"]] = compile_pattern(ioc["pattern"])
+                except PatternError:
+                    self._patterns[ioc["pattern"]] = None
+            if ioc_type in ("ipv4", "ipv6"):
+                try:
+                    net = ipaddress.ip_network(value, strict=False)
+                except ValueError:
+                    continue
+                if net.prefixlen == net.max_prefixlen:
+                    self.ips.setdefault(str(net.network_address), []).append(ioc)
+                else:
+                    table = self.networks.setdefault((net.version, net.prefixlen), {})
+                    table.setdefault(int(net.network_address), []).append(ioc)
+            elif ioc_type == "hash" or ioc_type in _HASH_LEN_TYPES.values():
+                self.hashes.setdefault(value.lower(), []).append(ioc)
+            elif ioc_type == "domain":
+                self.domains.setdefault(value.lower().rstrip("."), []).append(ioc)
+            else:
+                self.substrings.setdefault(value.lower(), []).append(ioc)
+                new_substrings = True
+            self.size += 1
+
+        if new_substrings:
+            self._automaton = AhoCorasick(self.substrings.keys())
+
+    def __len__(self) -> int:
+        return self.size
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        可 JSON 序列化的比對表；IOC 只存一份，各表以 index 參照 (只保留比對與 hit 需要的欄位)
+        """
+        iocs: List[Dict[str, Any]] = []
+        index: Dict[int, int] = {}
+
+        def _refs(items: List[Dict[str, Any]]) -> List[int]:
+            refs = []
+            for ioc in items:
+                i = index.get(id(ioc))
+                if i is None:
+                    i = index[id(ioc)] = len(iocs)
+                    iocs.append({k: ioc[k] for k in _PERSISTED_FIELDS if k in ioc})
+                refs.append(i)
+            return refs
+
+        def _table(table: Dict[Any, List[Dict[str, Any]]]) -> Dict[str, List[int]]:
+            return {str(k): _refs(v) for k, v in table.items()}
+
+        return {
+            "ips": _table(self.ips),
+            "networks": [[version, prefixlen, _table(table)]
+                         for (version, prefixlen), table in self.networks.items()],
+            "hashes": _table(self.hashes),
+            "domains": _table(self.domains),
+            "substrings": _table(self.substrings),
+            "size": self.size,
+            "iocs": iocs,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "IOCMatcher":
+        """
+        由 to_dict 的結果還原；Aho-Corasick 與 AND pattern 重新編譯
+        """
+        matcher = cls()
+        iocs = data["iocs"]
+
+        def _table(table: Dict[str, List[int]]) -> Dict[str, List[Dict[str, Any]]]:
+            return {k: [iocs[i] for i in refs] for k, refs in table.items()}
+
+        matcher.ips = _table(data["ips"])
+        matcher.networks = {
+            (version, prefixlen): {int(k): v for k, v in _table(table).items()}
+            for version, prefixlen, table in data["networks"]
+        }
+        matcher.hashes = _table(data["hashes"])
+        matcher.domains = _table(data["domains"])
+        matcher.substrings = _table(data["substrings"])
+        matcher.size = data["size"]
+        matcher._automaton = AhoCorasick(matcher.substrings.keys())
+        for ioc in iocs:
+            if ioc.get("conjunction") and ioc.get("pattern") not in matcher._patterns:
+                try:
+                    matcher._patterns[ioc["pattern"]] = compile_pattern(ioc["pattern"])
+                except PatternError:
+                    matcher._patterns[ioc["pattern"]] = None
+        return matcher
+
+    @staticmethod
+    def _hit(ioc: Dict[str, Any], matched: str, kind: str) -> Dict[str, Any]:
+        return {
+            "value": ioc.get("value"),
+            "type": ioc.get("type") or kind,
+            "matched": matched,
+            "name": ioc.get("name"),
+            "id": ioc.get("id"),
+        }
+
+    @staticmethod
+    def _observations(line: str, compiled: CompiledPattern) -> Dict[str, List[str]]:
+        """
+        從 Log 抽出 pattern 內各欄位可能的值，給 CompiledPattern.evaluate 使用
+        """
+        ips = _IPV4_RE.findall(line) + _IPV6_RE.findall(line)
+        domains = []
+        for tok in _DOMAIN_RE.findall(line):
+            labels = tok.lower().split(".")
+            domains.extend(".".join(labels[i:]) for i in range(len(labels) - 1))
+        lowered = line.lower()
+        observed: Dict[str, List[str]] = {}
+        for pred in compiled.predicates:
+            if pred.kind == "ipv4":
+                values = [t for t in ips if ":" not in t]
+            elif pred.kind == "ipv6":
+                values = [t for t in ips if ":" in t]
+            elif pred.kind == "hash":
+                values = [t.lower() for t in _HASH_RE.findall(line)]
+            elif pred.kind == "domain":
+                values = domains
+            elif pred.kind == "url":
+                values = [str(v) for v in pred.values if str(v).lower() in lowered]
+            else:
+                values = []
+            observed.setdefault(pred.key, []).extend(values)
+        return observed
+
+    def _confirmed(self, ioc: Dict[str, Any], line: str, cache: Dict[str, bool]) -> bool:
+        if not ioc.get("conjunction"):
+            return True
+        pattern = ioc.get("pattern")
+        if pattern not in cache:
+            compiled = self._patterns.get(pattern)
+            cache[pattern] = compiled is not None and compiled.evaluate(self._observations(line, compiled))
+        return cache[pattern]
+
+    def match(self, line: str) -> List[Dict[str, Any]]:
+        hits: List[Dict[str, Any]] = []
+        seen = set()
+        evaluated: Dict[str, bool] = {}
+
+        def _emit(iocs: List[Dict[str, Any]], matched: str, kind: str) -> None:
+            for ioc in iocs:
+                key = (ioc.get("id"), ioc.get("value"))
+                if key not in seen and self._confirmed(ioc, line, evaluated):
+                    seen.add(key)
+                    hits.append(self._hit(ioc, matched, kind))
+
+        if self.ips or self.networks:
+            for tok in _IPV4_RE.findall(line) + _IPV6_RE.findall(line):
+                try:
+                    ip = ipaddress.ip_address(tok)
+                except ValueError:
+                    continue
+                found = self.ips.get(str(ip))
+                if found:
+                    _emit(found, tok, "ip")
+                if self.networks:
+                    ip_int, bits = int(ip), ip.max_prefixlen
+                    for (version, prefixlen), table in self.networks.items():
+                        if version != ip.version:
+                            continue
+                        shift = bits - prefixlen
+                        found = table.get((ip_int >> shift) << shift)
+                        if found:
+                            _emit(found, tok, "cidr")
+
+        if self.hashes:
+            for tok in _HASH_RE.findall(line):
+                found = self.hashes.get(tok.lower())
+                if found:
+                    _emit(found, tok, "hash")
+
+        if self.domains:
+            for tok in _DOMAIN_RE.findall(line):
+                labels = tok.lower().split(".")
+                for i in range(len(labels) - 1):
+                    found = self.domains.get(".".join(labels[i:]))
+                    if found:
+                        _emit(found, tok, "domain")
+
+        if self._automaton:
+            for _, pattern in self._automaton.find(line.lower()):
+                _emit(self.substrings[pattern], pattern, "substring")
+
+        return hits
+
+    def match_many(self, lines: Iterable[str]) -> List[List[Dict[str, Any]]]:
+        """
+        批次比對，回傳與輸入同順序的 hits
+        """
+        return [self.match(line) for line in lines]
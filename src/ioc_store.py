@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .detect_rules import iocs_from_bundle
+from .ioc_matcher import IOCMatcher, guess_ioc_type
+
+DEFAULT_BUNDLE_DIR = "out"
+BUNDLE_GLOB = "*bundle*.json"
+INDEX_FILENAME = ".ioc_index.json"
+MATCHER_FILENAME = ".ioc_matcher.json"
+# IOC 抽取邏輯改變時遞增，舊 index 會被丟棄並重新解析所有 bundle
+INDEX_VERSION = 3
+
+logger = logging.getLogger(__name__)
+
+
+def _ioc_key(ioc: Dict[str, Any]) -> str:
+    ioc_type = ioc.get("type") or guess_ioc_type(ioc["value"])
+    value = ioc["value"].strip()
+    if ioc_type != "url":
+        value = value.lower()
+    # AND pattern 的候選 IOC 各自帶自己的 pattern，不能與單獨成立的同值 IOC 合併
+    if ioc.get("conjunction"):
+        return f"{ioc_type}|{value}|{ioc.get('pattern')}"
+    return f"{ioc_type}|{value}"
+
+
+class IOCStore:
+    """
+    合併 out/ 下所有 STIX bundle 的 IOC 庫
+
+    - 以 (type, value) 去重，同一個 IOC 出現在多份報告時保留所有來源 indicator id
+    - 依檔案 mtime/size 判斷，只重新解析新增或變更的 bundle
+    - 合併結果存到 out/.ioc_index.json，process 重啟時不必重新解析所有 bundle
+    - IOCMatcher 的比對表 (IP / CIDR / hash / domain / 字串表與 AND pattern) 以 JSON 存到 out/.ioc_matcher.json，
+      記錄對應的 index 內容 hash；相符時直接載入並重建 automaton，不必重新分類所有 IOC。
+      只存資料不用 pickle，out/ 被寫入任意檔案也不會變成程式碼執行
+    """
+
+    def __init__(self, bundle_dir: str = DEFAULT_BUNDLE_DIR, index_path: Optional[str] = None) -> None:
+        self.bundle_dir = bundle_dir
+        self.index_path = index_path or os.path.join(bundle_dir, INDEX_FILENAME)
+        self.matcher_path = os.path.join(os.path.dirname(self.index_path) or ".", MATCHER_FILENAME)
+        # 檔名 -> {"mtime", "size", "keys"}
+        self.manifest: Dict[str, Dict[str, Any]] = {}
+        # IOC key -> {"value", "type", "name", "id", "ids", "sources"}
+        self.iocs: Dict[str, Dict[str, Any]] = {}
+        self._matcher: Optional[IOCMatcher] = None
+        # 目前 index 檔內容的 hash，pickle 的 matcher 要與它相符才能用
+        self._content_hash: Optional[str] = None
+
+        if os.path.exists(self.index_path):
+            try:
+                raw = Path(self.index_path).read_bytes()
+                data = json.loads(raw)
+                if data.get("version") == INDEX_VERSION:
+                    self.manifest = data.get("manifest", {})
+                    self.iocs = data.get("iocs", {})
+                    self._content_hash = hashlib.sha256(raw).hexdigest()
+            except (json.JSONDecodeError, OSError):
+                self.manifest, self.iocs = {}, {}
+
+    def __len__(self) -> int:
+        return len(self.iocs)
+
+    @property
+    def matcher(self) -> IOCMatcher:
+        if self._matcher is None:
+            self._matcher = self._load_matcher()
+        if self._matcher is None:
+            self._matcher = IOCMatcher(list(self.iocs.values()))
+            self._save_matcher()
+        return self._matcher
+
+    def _load_matcher(self) -> Optional[IOCMatcher]:
+        if self._content_hash is None or not os.path.exists(self.matcher_path):
+            return None
+        try:
+            data = json.loads(Path(self.matcher_path).read_text(encoding="utf-8"))
+            if data.get("version") != INDEX_VERSION or data.get("hash") != self._content_hash:
+                return None
+            return IOCMatcher.from_dict(data["matcher"])
+        except (json.JSONDecodeError, OSError, KeyError, TypeError, ValueError, IndexError, AttributeError):
+            return None
+
+    def _save_matcher(self) -> None:
+        # index 還沒存過 (或剛被改寫) 時沒有 hash，等下次 save 再寫
+        if self._content_hash is None or self._matcher is None:
+            return
+        tmp = f"{self.matcher_path}.tmp"
+        Path(tmp).write_text(
+            json.dumps({"version": INDEX_VERSION, "hash": self._content_hash, "matcher": self._matcher.to_dict()},
+                       ensure_ascii=False),
+            encoding="utf-8",
+        )
+        os.replace(tmp, self.matcher_path)
+
+    def _bundle_files(self) -> Dict[str, Tuple[float, int]]:
+        files = {}
+        for path in glob.glob(os.path.join(self.bundle_dir, BUNDLE_GLOB)):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files[os.path.basename(path)] = (st.st_mtime, st.st_size)
+        return files
+
+    def _remove_file(self, name: str) -> None:
+        for key in self.manifest.pop(name, {}).get("keys", []):
+            entry = self.iocs.get(key)
+            if entry is None:
+                continue
+            entry["sources"] = [s for s in entry["sources"] if s != name]
+            if not entry["sources"]:
+                del self.iocs[key]
+
+    def _add_file(self, name: str, mtime: float, size: int) -> List[Dict[str, Any]]:
+        path = os.path.join(self.bundle_dir, name)
+        with open(path, "r", encoding="utf-8") as f:
+            bundle = json.load(f)
+
+        added: List[Dict[str, Any]] = []
+        keys = []
+        for ioc in iocs_from_bundle(bundle):
+            key = _ioc_key(ioc)
+            keys.append(key)
+            entry = self.iocs.get(key)
+            if entry is None:
+                entry = dict(ioc, ids=[], sources=[])
+                entry.setdefault("type", key.split("|", 1)[0])
+                self.iocs[key] = entry
+                added.append(entry)
+            if ioc.get("id") and ioc["id"] not in entry["ids"]:
+                entry["ids"].append(ioc["id"])
+            if name not in entry["sources"]:
+                entry["sources"].append(name)
+
+        self.manifest[name] = {"mtime": mtime, "size": size, "keys": sorted(set(keys))}
+        return added
+
+    def refresh(self) -> Dict[str, int]:
+        """
+        掃描資料夾，只處理新增 / 變更 / 刪除的 bundle，回傳變動統計
+        """
+        files = self._bundle_files()
+        stats = {"added_files": 0, "removed_files": 0, "new_iocs": 0, "errors": 0}
+        removed_any = False
+        added: List[Dict[str, Any]] = []
+
+        for name in list(self.manifest):
+            if name not in files:
+                self._remove_file(name)
+                stats["removed_files"] += 1
+                removed_any = True
+
+        for name, (mtime, size) in sorted(files.items()):
+            known = self.manifest.get(name)
+            if known and known.get("mtime") == mtime and known.get("size") == size:
+                continue
+            if known:
+                # 檔案被改寫: 先移除舊內容再重新解析
+                self._remove_file(name)
+                removed_any = True
+            try:
+                added.extend(self._add_file(name, mtime, size))
+                stats["added_files"] += 1
+            except (json.JSONDecodeError, OSError) as e:
+                # 可能還在寫入中，下次 refresh 再試
+                logger.warning(f"  無法讀取 bundle {name}: {e}")
+                stats["errors"] += 1
+
+        stats["new_iocs"] = len(added)
+        if removed_any:
+            self._matcher = None
+        elif added and self._matcher is not None:
+            self._matcher.add(added)
+
+        if stats["added_files"] or stats["removed_files"]:
+            self.save()
+        return stats
+
+    def save(self) -> None:
+        Path(self.index_path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = f"{self.index_path}.tmp"
+        raw = json.dumps({"version": INDEX_VERSION, "manifest": self.manifest, "iocs": self.iocs},
+                         ensure_ascii=False).encode("utf-8")
+        Path(tmp).write_bytes(raw)
+        os.replace(tmp, self.index_path)
+        self._content_hash = hashlib.sha256(raw).hexdigest()
+        # matcher 已經建好 (或已增量更新) 就一起存；否則舊 pickle 的 hash 對不上，下次使用時重建
+        self._save_matcher()
+
+    def watch(self, interval: float = 5.0,
+              on_change: Optional[Callable[["IOCStore", Dict[str, int]], None]] = None) -> None:
+        """
+        持續監看資料夾，有新 bundle 時增量合併 (Ctrl+C 停止)
+        """
+        try:
+            while True:
+                stats = self.refresh()
+                if (stats["added_files"] or stats["removed_files"]) and on_change:
+                    on_change(self, stats)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Merge all STIX bundles into a persisted IOC index")
+    parser.add_argument("--dir", default=DEFAULT_BUNDLE_DIR, help="STIX bundle 資料夾")
+    parser.add_argument("--watch", action="store_true", help="持續監看資料夾並增量合併")
+    parser.add_argument("--interval", type=float, default=5.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    store = IOCStore(args.dir)
+    stats = store.refresh()
+    print(f"  IOC 庫: {len(store)} 個指標 {stats}")
+
+    if args.watch:
+        print(f"  監看 {args.dir} 中 (Ctrl+C 停止)...")
+        store.watch(args.interval, on_change=lambda s, st: print(f"  IOC 庫更新: {len(s)} 個指標 {st}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
 from __future__ import annotations
 import json
 import os
-from typing import Any, Dict, List
-import httpx
-from .utils import env
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from .embedding_cache import EmbeddingCache, normalize_text
+from .http_transport import get_transport
+from .rate_limit import shared_limiter
 
 class LLMClient:
     def __init__(self) -> None:
@@ -15,11 +17,27 @@ class LLMClient:
         self.timeout = float(os.getenv("OPENAI_TIMEOUT", "60"))
         self.base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
         self.model = os.getenv("OPENAI_MODEL", "gpt-4o")
+        self.embedding_model = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+
+        # 批次 embedding 參數 (單次 request 的筆數 / 估計 token 上限 / 同時送出的 request 數)
+        self.embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+        self.embedding_batch_tokens = int(os.getenv("EMBEDDING_BATCH_TOKENS", "100000"))
+        self.embedding_concurrency = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+
+        # 持久化 Embedding cache (EMBEDDING_CACHE_PATH="" 可關閉)
+        self.embedding_cache = EmbeddingCache.from_env()
+
+        # RPM / TPM 限制 (LLM_* 給 chat、EMBEDDING_* 給 embeddings，0 = 不限)，整個 process 共用
+        self.rate_limiter = shared_limiter("LLM")
+        self.embedding_rate_limiter = shared_limiter("EMBEDDING")
+
+        # 共用的連線池 + 重試 (429 / 5xx / timeout)
+        self.transport = get_transport()
 
         if not self.api_key:
             raise RuntimeError("Missing API Key! Please set AZURE_OPENAI_API_KEY in .env")
 
-    def extract_json(self, system_prompt: str, user_prompt: str) -> Dict[str, Any]:
+    def _chat_request(self, system_prompt: str, user_prompt: str) -> Tuple[str, Dict[str, str], Dict[str, str], Dict[str, Any]]:
         """
         判斷是 Azure 還是 OpenAI
         """
@@ -54,22 +72,44 @@ class LLMClient:
                 "temperature": 0,
                 "response_format": {"type": "json_object"},
             }
+        return url, params, headers, payload
 
-        with httpx.Client(timeout=self.timeout) as client:
-            resp = client.post(url, headers=headers, json=payload, params=params)
-            resp.raise_for_status()
-            data = resp.json()
-
+    @staticmethod
+    def _parse_chat(data: Dict[str, Any]) -> Dict[str, Any]:
         content = data["choices"][0]["message"]["content"]
         try:
             return json.loads(content)
         except json.JSONDecodeError as e:
             raise RuntimeError(f"LLM returned non-JSON output: {content[:2000]}") from e
 
-    def get_embedding(self, text: str) -> List[float]:
+    def extract_json(self, system_prompt: str, user_prompt: str) -> Dict[str, Any]:
+        url, params, headers, payload = self._chat_request(system_prompt, user_prompt)
+        resp = self.transport.post(
+            url, headers=headers, json=payload, params=params,
+            limiter=self.rate_limiter,
+            tokens=self._estimate_tokens(system_prompt) + self._estimate_tokens(user_prompt),
+        )
+        return self._parse_chat(resp.json())
+
+    async def aextract_json(self, system_prompt: str, user_prompt: str) -> Dict[str, Any]:
         """
-        跑Embedding看是Azure還是OpenAI
+        extract_json 的 async 版本 (httpx.AsyncClient)，可在 asyncio 裡併發大量報告
         """
+        url, params, headers, payload = self._chat_request(system_prompt, user_prompt)
+        resp = await self.transport.apost(
+            url, headers=headers, json=payload, params=params,
+            limiter=self.rate_limiter,
+            tokens=self._estimate_tokens(system_prompt) + self._estimate_tokens(user_prompt),
+        )
+        return self._parse_chat(resp.json())
+
+    def close(self) -> None:
+        self.transport.close()
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+    def _embedding_request(self) -> Tuple[str, Dict[str, str], Dict[str, str], Dict[str, Any]]:
         if self.azure_endpoint:
             base = self.azure_endpoint.rstrip('/')
             url = f"{base}/openai/deployments/{self.embedding_deployment}/embeddings"
@@ -78,9 +118,7 @@ class LLMClient:
                 "api-key": self.api_key,
                 "Content-Type": "application/json"
             }
-            payload = {
-                "input": text
-            }
+            payload: Dict[str, Any] = {}
         else:
             url = f"{self.base_url}/embeddings"
             params = {}
@@ -88,14 +126,114 @@ class LLMClient:
                 "Authorization": f"Bearer {self.api_key}",
                 "Content-Type": "application/json",
             }
-            payload = {
-                "model": "text-embedding-3-small",
-                "input": text
-            }
+            payload = {"model": self.embedding_model}
+        return url, params, headers, payload
+
+    def _post_embeddings(self, texts: Sequence[str]) -> List[List[float]]:
+        url, params, headers, payload = self._embedding_request()
+        payload["input"] = list(texts)
 
-        with httpx.Client(timeout=self.timeout) as client:
-            resp = client.post(url, headers=headers, json=payload, params=params)
-            resp.raise_for_status()
-            data = resp.json()
+        resp = self.transport.post(
+            url, headers=headers, json=payload, params=params,
+            limiter=self.embedding_rate_limiter,
+            tokens=sum(self._estimate_tokens(t) for t in texts),
+        )
+        data = resp.json()
 
-        return data["data"][0]["embedding"]
\ No newline at end of file
+        # API 不保證回傳順序，依 index 排回輸入順序
+        items = sorted(data["data"], key=lambda d: d.get("index", 0))
+        if len(items) != len(texts):
+            raise RuntimeError(f"Embedding API returned {len(items)} vectors for {len(texts)} inputs")
+        return [d["embedding"] for d in items]
+
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        # 粗估: 英文約 4 chars / token
+        return len(text) // 4 + 1
+
+    def _embedding_batches(self, texts: Sequence[str]) -> List[Tuple[int, int]]:
+        """
+        依筆數與估計 token 上限切成多個 [start, end) 區段
+        """
+        batches: List[Tuple[int, int]] = []
+        start, tokens = 0, 0
+        for i, text in enumerate(texts):
+            t = self._estimate_tokens(text)
+            if i > start and (i - start >= self.embedding_batch_size or tokens + t > self.embedding_batch_tokens):
+                batches.append((start, i))
+                start, tokens = i, 0
+            tokens += t
+        if start < len(texts):
+            batches.append((start, len(texts)))
+        return batches
+
+    @property
+    def chat_cache_model(self) -> str:
+        # extraction cache key 要區分 Azure deployment 與 OpenAI model
+        if self.azure_endpoint:
+            return f"azure:{self.chat_deployment}"
+        return f"openai:{self.model}"
+
+    @property
+    def embedding_cache_model(self) -> str:
+        # cache key 要區分 Azure deployment 與 OpenAI model
+        if self.azure_endpoint:
+            return f"azure:{self.embedding_deployment}"
+        return f"openai:{self.embedding_model}"
+
+    def _fetch_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        實際打 API: 多筆打包成一個 request，多個 batch 併發送出
+        """
+        batches = self._embedding_batches(texts)
+        workers = min(max(1, self.embedding_concurrency), len(batches))
+
+        if workers == 1:
+            results = [self._post_embeddings(texts[s:e]) for s, e in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(lambda b: self._post_embeddings(texts[b[0]:b[1]]), batches))
+
+        vectors: List[List[float]] = []
+        for chunk in results:
+            vectors.extend(chunk)
+        return vectors
+
+    def get_embeddings(self, texts: Sequence[str]) -> List[List[float]]:
+        """
+        批次 Embedding: 先查 cache，重複的文字只送一次 API，回傳順序與輸入相同
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+
+        model = self.embedding_cache_model
+        if self.embedding_cache is not None:
+            vectors: List[Optional[List[float]]] = self.embedding_cache.get_many(model, texts)
+        else:
+            vectors = [None] * len(texts)
+
+        # 未命中的文字依正規化後內容去重
+        pending: Dict[str, List[int]] = {}
+        for i, (text, vec) in enumerate(zip(texts, vectors)):
+            if vec is None:
+                pending.setdefault(normalize_text(text), []).append(i)
+
+        if pending:
+            unique_texts = [texts[idxs[0]] for idxs in pending.values()]
+            fetched = self._fetch_embeddings(unique_texts)
+
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_many(model, unique_texts, fetched)
+
+            for idxs, vec in zip(pending.values(), fetched):
+                for i in idxs:
+                    vectors[i] = vec
+
+        return vectors  # type: ignore[return-value]
+
+    def get_embedding(self, text: str) -> List[float]:
+        """
+        跑Embedding看是Azure還是OpenAI
+        """
+        return self.get_embeddings([text])[0]
@@ -0,0 +1,217 @@
+"""
+In-process exact kNN 引擎 (cosine)，介面與 detect_anomaly 的 OpenSearch kNN 路徑相同
+
+baseline 向量存成 L2 正規化後的 float32 .npy (memory-mapped)，一批查詢用一次矩陣乘法
++ argpartition 取 top-k。適合幾十萬筆以內的 baseline，也能在沒有 OpenSearch 的 CI 中跑。
+
+    python -m src.local_knn export --out .cache/local_knn
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+DEFAULT_LOCAL_KNN_DIR = ".cache/local_knn"
+VECTORS_FILE = "vectors.npy"
+META_FILE = "meta.json"
+
+# 一次矩陣乘法的最大元素數 (查詢數 x baseline 數)，避免大批次吃光記憶體
+_MAX_BLOCK_ELEMENTS = 16_000_000
+
+
+def cosinesimil_score(cos: float) -> float:
+    """
+    OpenSearch (nmslib, space_type=cosinesimil) 的 kNN _score: 1 / (1 + (1 - cos))
+    """
+    return 1.0 / (2.0 - cos)
+
+
+def score_to_cosine(score: float) -> float:
+    """
+    cosinesimil_score 的反函數，把 kNN _score 還原成 cosine similarity
+    """
+    return 2.0 - 1.0 / score
+
+
+def _normalize(mat: np.ndarray) -> np.ndarray:
+    mat = np.asarray(mat, dtype=np.float32)
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
+
+
+class LocalKNNIndex:
+    def __init__(self, vectors: np.ndarray, ids: Sequence[str], sources: Sequence[Dict[str, Any]]) -> None:
+        if len(vectors) != len(ids) or len(ids) != len(sources):
+            raise ValueError("vectors / ids / sources length mismatch")
+        self.vectors = vectors  # 已正規化的 (n, d) float32
+        self.ids = list(ids)
+        self.sources = list(sources)
+        self._row_of = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        self._filter_cache: Dict[tuple, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, path: str, vectors: Iterable[Sequence[float]], ids: Sequence[str],
+              sources: Sequence[Dict[str, Any]]) -> "LocalKNNIndex":
+        """
+        寫入正規化後的向量與 metadata，回傳 memory-mapped 的 index
+        """
+        Path(path).mkdir(parents=True, exist_ok=True)
+        mat = _normalize(np.asarray(list(vectors), dtype=np.float32))
+        np.save(os.path.join(path, VECTORS_FILE), mat)
+        Path(os.path.join(path, META_FILE)).write_text(
+            json.dumps({"ids": list(ids), "sources": list(sources)}, ensure_ascii=False),
+            encoding="utf-8",
+        )
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_LOCAL_KNN_DIR) -> "LocalKNNIndex":
+        vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+        meta = json.loads(Path(os.path.join(path, META_FILE)).read_text(encoding="utf-8"))
+        return cls(vectors, meta["ids"], meta["sources"])
+
+    def _filter_mask(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        if not filters:
+            return None
+        key = tuple(sorted(filters.items()))
+        mask = self._filter_cache.get(key)
+        if mask is None:
+            mask = np.array(
+                [all(src.get(f) == v for f, v in filters.items()) for src in self.sources],
+                dtype=bool,
+            )
+            self._filter_cache[key] = mask
+        return mask
+
+    def search_batch(self, queries: Sequence[Sequence[float]], k: int,
+                     filters: Optional[Dict[str, Any]] = None,
+                     exclude_ids: Optional[Sequence[Optional[str]]] = None,
+                     include_source: bool = True) -> List[List[Dict[str, Any]]]:
+        """
+        回傳格式與 OpenSearch hits 相同: [{"_id", "_score", "_source"}]
+        _score 沿用 OpenSearch cosinesimil 的計分 1 / (2 - cos)，讓 _anomaly_score_from_hits 與 threshold 結果一致
+        """
+        if len(queries) == 0:
+            return []
+        if len(self) == 0:
+            return [[] for _ in queries]
+
+        q = _normalize(np.asarray(queries, dtype=np.float32))
+        mask = self._filter_mask(filters)
+        k_eff = min(k, len(self) if mask is None else int(mask.sum()))
+        if k_eff <= 0:
+            return [[] for _ in queries]
+
+        block = max(1, _MAX_BLOCK_ELEMENTS // len(self))
+        results: List[List[Dict[str, Any]]] = []
+
+        for start in range(0, len(q), block):
+            sims = q[start:start + block] @ self.vectors.T  # (m, n)
+            if mask is not None:
+                sims[:, ~mask] = -np.inf
+            if exclude_ids:
+                for row, doc_id in enumerate(exclude_ids[start:start + block]):
+                    col = self._row_of.get(doc_id) if doc_id else None
+                    if col is not None:
+                        sims[row, col] = -np.inf
+
+            if k_eff < sims.shape[1]:
+                top = np.argpartition(-sims, k_eff - 1, axis=1)[:, :k_eff]
+            else:
+                top = np.tile(np.arange(sims.shape[1]), (sims.shape[0], 1))
+            top_sims = np.take_along_axis(sims, top, axis=1)
+            order = np.argsort(-top_sims, axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_sims = np.take_along_axis(top_sims, order, axis=1)
+
+            for cols, vals in zip(top, top_sims):
+                hits = []
+                for col, sim in zip(cols, vals):
+                    if not np.isfinite(sim):
+                        continue
+                    hit = {"_id": self.ids[col], "_score": cosinesimil_score(float(sim))}
+                    if include_source:
+                        hit["_source"] = self.sources[col]
+                    hits.append(hit)
+                results.append(hits)
+
+        return results
+
+    def sample(self, n: int, filters: Optional[Dict[str, Any]] = None, seed: int = 42) -> List[Dict[str, Any]]:
+        """
+        隨機抽樣，格式同 OpenSearch hits (含 log_vector)
+        """
+        rows = np.arange(len(self))
+        mask = self._filter_mask(filters)
+        if mask is not None:
+            rows = rows[mask]
+        rng = np.random.default_rng(seed)
+        picked = rng.choice(rows, size=min(n, len(rows)), replace=False) if len(rows) else rows
+        return [
+            {"_id": self.ids[r], "_source": {"log_vector": self.vectors[r].tolist()}}
+            for r in picked
+        ]
+
+
+# TTP 向量 (stix_index 的 cti-ttp-vectors) 匯出時用的預設值
+DEFAULT_TTP_KNN_DIR = ".cache/ttp_knn"
+TTP_SOURCE_FIELDS = ("kind", "name", "text", "mitre_ids", "mitre_names", "log_type", "report")
+
+
+def export_from_opensearch(client, index: str, path: str = DEFAULT_LOCAL_KNN_DIR,
+                           source_fields: Sequence[str] = ("log_text", "log_source", "template_id"),
+                           vector_field: str = "log_vector") -> LocalKNNIndex:
+    """
+    從 OpenSearch scan 出所有 baseline 向量，寫成本地 index
+    """
+    from opensearchpy import helpers
+
+    ids: List[str] = []
+    sources: List[Dict[str, Any]] = []
+    vectors: List[np.ndarray] = []
+    for doc in helpers.scan(client, index=index, query={"_source": [vector_field, *source_fields]}):
+        src = doc.get("_source", {})
+        vec = src.pop(vector_field, None)
+        if not vec:
+            continue
+        ids.append(doc["_id"])
+        sources.append(src)
+        vectors.append(np.asarray(vec, dtype=np.float32))
+
+    return LocalKNNIndex.build(path, vectors, ids, sources)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local in-process kNN engine")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    exp = sub.add_parser("export", help="從 OpenSearch 匯出 baseline 向量")
+    exp.add_argument("--index", default="security-logs-knn")
+    exp.add_argument("--out", default=os.getenv("LOCAL_KNN_DIR", DEFAULT_LOCAL_KNN_DIR))
+    exp_ttp = sub.add_parser("export-ttp", help="從 OpenSearch 匯出 TTP 向量 (cti-ttp-vectors)")
+    exp_ttp.add_argument("--out", default=os.getenv("TTP_KNN_DIR", DEFAULT_TTP_KNN_DIR))
+    args = parser.parse_args()
+
+    from .setup_opensearch import get_opensearch_client
+
+    if args.cmd == "export":
+        idx = export_from_opensearch(get_opensearch_client(), args.index, args.out)
+        print(f"  已匯出 {len(idx)} 筆 baseline 向量至 {args.out}")
+    elif args.cmd == "export-ttp":
+        from .cti_indices import TTP_VECTOR_INDEX
+
+        idx = export_from_opensearch(get_opensearch_client(), TTP_VECTOR_INDEX, args.out,
+                                     source_fields=TTP_SOURCE_FIELDS, vector_field="ttp_vector")
+        print(f"  已匯出 {len(idx)} 筆 TTP 向量至 {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+from __future__ import annotations
+
+import re
+from typing import List, Optional, Tuple
+
+UNKNOWN_SOURCE = "other"
+
+# 依序比對，第一個命中的規則決定 log_source
+_SOURCE_RULES: List[Tuple[str, re.Pattern]] = [
+    ("ssh", re.compile(r"\bssh2?\b|\bsshd\b|accepted (password|publickey)|logged in|\blogin\b|\bvpn\b", re.IGNORECASE)),
+    ("dns", re.compile(r"\bdns\b|\bquery\b.*\b(A|AAAA|CNAME|MX|TXT)\b|\bnxdomain\b", re.IGNORECASE)),
+    ("backup", re.compile(r"\bbackup\b|\bsynced\b|\bsnapshot\b|\brsync\b", re.IGNORECASE)),
+    ("database", re.compile(r"\bdatabase\b|\bpostgres(ql)?\b|\bmysql\b|\bvacuum\b|\bDB_\w+", re.IGNORECASE)),
+    ("network", re.compile(r"\binterface\b|\bdhcp\b|\bfirewall\b|\bssid\b|\beth\d\b|\bwlan\d\b", re.IGNORECASE)),
+    ("security", re.compile(r"\bantivirus\b|\bdefender\b|\bintegrity\b|\bmalware\b|\bthreats?\b", re.IGNORECASE)),
+    ("service", re.compile(r"\bservice\b|\bcron\b|\brestarted\b|\bnginx\b|\bapache2?\b|\bdocker\b|\bsystemd\b", re.IGNORECASE)),
+]
+
+
+def infer_log_source(log_text: str, default: Optional[str] = UNKNOWN_SOURCE) -> Optional[str]:
+    """
+    用簡單的關鍵字規則替 Log 標上 log_source (ingest 與 detect 使用同一套規則)
+    """
+    for source, pattern in _SOURCE_RULES:
+        if pattern.search(log_text):
+            return source
+    return default
@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_STATE_PATH = ".cache/log_templates.json"
+WILDCARD = "<*>"
+
+# 變數遮罩 (順序很重要: 先遮長的 pattern，避免 timestamp 被拆成數字)
+_MASKS: List[Tuple[re.Pattern, str]] = [
+    (re.compile(r"\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?\b"), "<TS>"),
+    (re.compile(r"\b(?:[0-9A-Fa-f]{2}[:-]){5}[0-9A-Fa-f]{2}\b"), "<MAC>"),
+    (re.compile(r"\b\d{1,2}:\d{2}(?::\d{2})?(?:\s?[AP]M)?\b", re.IGNORECASE), "<TS>"),
+    (re.compile(r"\b(?:\d{1,3}\.){3}\d{1,3}(?::\d{1,5})?\b"), "<IP>"),
+    (re.compile(r"\b(?:[0-9A-Fa-f]{1,4}:){2,7}[0-9A-Fa-f]{1,4}\b"), "<IP>"),
+    (re.compile(r"\b0x[0-9A-Fa-f]+\b"), "<HEX>"),
+    (re.compile(r"\b(?=[0-9A-Fa-f]*\d)(?=[0-9A-Fa-f]*[A-Fa-f])[0-9A-Fa-f]{8,}\b"), "<HEX>"),
+    (re.compile(r"(?<![\w.])[-+]?\d+(?:\.\d+)*(?![\w])"), "<NUM>"),
+]
+
+
+def mask_variables(line: str) -> str:
+    """
+    把 Log 內的變數 (IP / MAC / timestamp / hex ID / 數字) 換成固定 token
+    """
+    for pattern, token in _MASKS:
+        line = pattern.sub(token, line)
+    return " ".join(line.split())
+
+
+def _template_id(tokens: List[str]) -> str:
+    return hashlib.sha1(" ".join(tokens).encode("utf-8")).hexdigest()[:12]
+
+
+class LogCluster:
+    def __init__(self, cluster_id: str, tokens: List[str], size: int = 0) -> None:
+        self.cluster_id = cluster_id
+        self.tokens = tokens
+        self.size = size
+
+    @property
+    def template(self) -> str:
+        return " ".join(self.tokens)
+
+
+class TemplateMiner:
+    """
+    Drain 風格的 Log template miner
+
+    以 (token 數, 前 depth 個 token) 建固定深度的 prefix tree，葉節點內用
+    token 相似度挑 cluster；相似度 >= sim_threshold 就合併，不同的位置變成 <*>。
+    cluster_id 取自第一次出現時的 template，之後 template 被泛化也不會變。
+    """
+
+    def __init__(self, depth: int = 1, sim_threshold: float = 0.5, max_clusters_per_leaf: int = 100) -> None:
+        self.depth = depth
+        self.sim_threshold = sim_threshold
+        self.max_clusters_per_leaf = max_clusters_per_leaf
+        self.clusters: Dict[str, LogCluster] = {}
+        self._tree: Dict[Tuple[Any, ...], List[str]] = {}
+
+    def _leaf_key(self, tokens: List[str]) -> Tuple[Any, ...]:
+        prefix = []
+        for tok in tokens[:self.depth]:
+            # 含數字或已遮罩的 token 不適合當分支
+            prefix.append(WILDCARD if (tok.startswith("<") or any(c.isdigit() for c in tok)) else tok)
+        return (len(tokens), *prefix)
+
+    @staticmethod
+    def _similarity(template: List[str], tokens: List[str]) -> Tuple[float, int]:
+        same, wildcards = 0, 0
+        for a, b in zip(template, tokens):
+            if a == WILDCARD:
+                wildcards += 1
+            elif a == b:
+                same += 1
+        return same / max(1, len(tokens)), wildcards
+
+    def _best_cluster(self, leaf: List[str], tokens: List[str]) -> Tuple[Optional[LogCluster], float]:
+        best, best_sim, best_wild = None, -1.0, -1
+        for cid in leaf:
+            cluster = self.clusters[cid]
+            sim, wild = self._similarity(cluster.tokens, tokens)
+            if sim > best_sim or (sim == best_sim and wild > best_wild):
+                best, best_sim, best_wild = cluster, sim, wild
+        return best, best_sim
+
+    def add_log(self, line: str) -> LogCluster:
+        """
+        加入一行 Log，回傳所屬 cluster (必要時會泛化既有 template)
+        """
+        tokens = mask_variables(line).split(" ")
+        key = self._leaf_key(tokens)
+        leaf = self._tree.setdefault(key, [])
+
+        cluster, sim = self._best_cluster(leaf, tokens)
+        if cluster is not None and sim >= self.sim_threshold:
+            cluster.tokens = [a if a == b else WILDCARD for a, b in zip(cluster.tokens, tokens)]
+            cluster.size += 1
+            return cluster
+
+        cluster = LogCluster(_template_id(tokens), tokens, size=1)
+        # 同 template 重複 (例如 leaf 被截斷後) 直接沿用
+        existing = self.clusters.get(cluster.cluster_id)
+        if existing is not None:
+            existing.size += 1
+            return existing
+
+        if len(leaf) >= self.max_clusters_per_leaf:
+            leaf.pop(0)
+        leaf.append(cluster.cluster_id)
+        self.clusters[cluster.cluster_id] = cluster
+        return cluster
+
+    def match(self, line: str) -> Optional[LogCluster]:
+        """
+        只查詢不更新 (偵測時使用)
+        """
+        tokens = mask_variables(line).split(" ")
+        leaf = self._tree.get(self._leaf_key(tokens), [])
+        cluster, sim = self._best_cluster(leaf, tokens)
+        if cluster is None or sim < self.sim_threshold:
+            return None
+        # 非 wildcard 的位置必須完全相同
+        if any(a != WILDCARD and a != b for a, b in zip(cluster.tokens, tokens)):
+            return None
+        return cluster
+
+    def template_for(self, line: str) -> Tuple[str, str]:
+        """
+        回傳 (template_id, template)；沒有對應 cluster 時用遮罩後的文字
+        """
+        cluster = self.match(line)
+        if cluster is not None:
+            return cluster.cluster_id, cluster.template
+        tokens = mask_variables(line).split(" ")
+        return _template_id(tokens), " ".join(tokens)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "depth": self.depth,
+            "sim_threshold": self.sim_threshold,
+            "max_clusters_per_leaf": self.max_clusters_per_leaf,
+            "clusters": [
+                {"id": c.cluster_id, "tokens": c.tokens, "size": c.size}
+                for c in self.clusters.values()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "TemplateMiner":
+        miner = cls(
+            depth=data.get("depth", 1),
+            sim_threshold=data.get("sim_threshold", 0.5),
+            max_clusters_per_leaf=data.get("max_clusters_per_leaf", 100),
+        )
+        for c in data.get("clusters", []):
+            cluster = LogCluster(c["id"], c["tokens"], c.get("size", 0))
+            miner.clusters[cluster.cluster_id] = cluster
+            miner._tree.setdefault(miner._leaf_key(cluster.tokens), []).append(cluster.cluster_id)
+        return miner
+
+    def save(self, path: str = DEFAULT_STATE_PATH) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = f"{path}.tmp"
+        Path(tmp).write_text(json.dumps(self.to_dict(), ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_STATE_PATH) -> "TemplateMiner":
+        """
+        讀取已存的 template 狀態；有設定 LOG_TEMPLATE_SIM 時以環境變數為準 (覆蓋狀態檔內的值)
+        """
+        if not os.path.exists(path):
+            return cls(sim_threshold=float(os.getenv("LOG_TEMPLATE_SIM", "0.5")))
+        miner = cls.from_dict(json.loads(Path(path).read_text(encoding="utf-8")))
+        sim = os.getenv("LOG_TEMPLATE_SIM")
+        if sim:
+            miner.sim_threshold = float(sim)
+        return miner
+
+
+def templates_enabled() -> bool:
+    """
+    預設關閉：開啟後寫入的向量來自遮罩後的 template，與既有 index 裡的原始 log 向量不同，
+    需要明確設定 LOG_TEMPLATES=1 (並重新匯入) 才啟用
+    """
+    return os.getenv("LOG_TEMPLATES", "0").lower() in ("1", "true", "yes")
+
+
+def template_state_path() -> str:
+    return os.getenv("LOG_TEMPLATE_STATE", DEFAULT_STATE_PATH)
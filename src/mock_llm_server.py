@@ -0,0 +1,234 @@
+"""
+離線的 OpenAI 相容 mock server，用來做 run_pipeline / ingest_logs / detect_anomaly 的壓測與回歸測試
+
+    python -m src.mock_llm_server --port 8089 --latency-ms 300 --error-rate 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=mock python -m src.run_pipeline
+
+- POST /v1/chat/completions、/v1/embeddings (也接受 Azure 的 /openai/deployments/<name>/... 路徑)
+- Embedding: 以文字的 sha256 當 seed 產生固定的 1536 維單位向量，同樣的文字永遠得到同樣的向量
+- Chat: 回傳固定格式的抽取結果 (IOC 由 ioc_extract 從報告內容抽出，TTP 依關鍵字對應)
+- 可設定延遲、5xx 錯誤率與 429 比例 (附 Retry-After)，用來驗證重試與限速
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .ioc_extract import extract_iocs
+
+DEFAULT_DIM = 1536
+
+# 報告內出現關鍵字時回傳的 TTP
+_CANNED_TTPS = [
+    ("powershell", "PowerShell", "T1059.001"),
+    ("phishing", "Phishing", "T1566"),
+    ("scheduled task", "Scheduled Task", "T1053.005"),
+    ("credential", "OS Credential Dumping", "T1003"),
+    ("ransom", "Data Encrypted for Impact", "T1486"),
+    ("exfiltrat", "Exfiltration Over C2 Channel", "T1041"),
+    ("lateral", "Remote Services", "T1021"),
+    ("dns", "Application Layer Protocol: DNS", "T1071.004"),
+]
+
+
+def mock_embedding(text: str, dim: int = DEFAULT_DIM) -> List[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vec = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    vec /= np.linalg.norm(vec)
+    return vec.tolist()
+
+
+def mock_extraction(user_prompt: str) -> Dict[str, Any]:
+    """
+    依報告內容產生固定的抽取結果 (同樣的輸入永遠得到同樣的輸出)
+    """
+    report = user_prompt.split("CTI_REPORT_TEXT:", 1)[-1]
+    lowered = report.lower()
+    ttps = [
+        {"name": name, "mitre_technique_id": tid, "description": f"Report mentions {keyword}."}
+        for keyword, name, tid in _CANNED_TTPS
+        if keyword in lowered
+    ]
+    first_sentence = re.split(r"(?<=[.!?])\s", report.strip(), maxsplit=1)[0]
+    return {
+        "summary": first_sentence[:300],
+        "indicators": extract_iocs(report),
+        "ttps": ttps,
+        "actor": None,
+        "malware_or_tool": [],
+        "confidence": 50 + len(ttps) * 5,
+        "log_suggestions": [
+            {
+                "log_type": "edr_process",
+                "fields": ["process.command_line", "process.parent.name"],
+                "rationale": "Mock suggestion for benchmarking.",
+            }
+        ] if ttps else [],
+    }
+
+
+class MockConfig:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after: float = 1.0, dim: int = DEFAULT_DIM,
+                 seed: Optional[int] = None) -> None:
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.dim = dim
+        self.rng = random.Random(seed)
+        self.stats = {"chat": 0, "embeddings": 0, "embedding_inputs": 0, "errors": 0, "rate_limited": 0}
+        self.lock = threading.Lock()
+
+
+def _make_handler(config: MockConfig):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+        def _send(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _fault(self) -> Optional[Tuple[int, Dict[str, Any], Dict[str, str]]]:
+            with config.lock:
+                roll = config.rng.random()
+                if roll < config.rate_limit_rate:
+                    config.stats["rate_limited"] += 1
+                    return 429, {"error": {"message": "Rate limit (mock)"}}, {"Retry-After": str(config.retry_after)}
+                if roll < config.rate_limit_rate + config.error_rate:
+                    config.stats["errors"] += 1
+                    return 500, {"error": {"message": "Internal error (mock)"}}, {}
+                delay = max(0.0, config.latency_ms + config.rng.uniform(-config.jitter_ms, config.jitter_ms))
+            time.sleep(delay / 1000.0)
+            return None
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length", "0"))
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}")
+            except json.JSONDecodeError:
+                self._send(400, {"error": {"message": "Invalid JSON"}})
+                return
+
+            path = self.path.split("?", 1)[0].rstrip("/")
+            if path.endswith("/chat/completions"):
+                kind = "chat"
+            elif path.endswith("/embeddings"):
+                kind = "embeddings"
+            else:
+                self._send(404, {"error": {"message": f"Unknown path {path}"}})
+                return
+
+            fault = self._fault()
+            if fault:
+                self._send(*fault)
+                return
+
+            if kind == "chat":
+                user = next((m.get("content", "") for m in reversed(body.get("messages", []))
+                             if m.get("role") == "user"), "")
+                content = json.dumps(mock_extraction(user))
+                with config.lock:
+                    config.stats["chat"] += 1
+                self._send(200, {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "model": body.get("model", "mock"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                    "usage": {"prompt_tokens": len(user) // 4 + 1, "completion_tokens": len(content) // 4 + 1},
+                })
+                return
+
+            inputs = body.get("input", [])
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            with config.lock:
+                config.stats["embeddings"] += 1
+                config.stats["embedding_inputs"] += len(inputs)
+            self._send(200, {
+                "object": "list",
+                "model": body.get("model", "mock"),
+                "data": [{"object": "embedding", "index": i, "embedding": mock_embedding(t, config.dim)}
+                         for i, t in enumerate(inputs)],
+                "usage": {"prompt_tokens": sum(len(t) // 4 + 1 for t in inputs)},
+            })
+
+        def do_GET(self) -> None:
+            if self.path.rstrip("/").endswith("/stats"):
+                with config.lock:
+                    self._send(200, dict(config.stats))
+            else:
+                self._send(404, {"error": {"message": "Not found"}})
+
+    return Handler
+
+
+def start_server(host: str = "127.0.0.1", port: int = 0,
+                 config: Optional[MockConfig] = None) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    在背景 thread 啟動 server，回傳 (server, base_url)；port=0 代表自動挑選
+    結束時呼叫 server.shutdown()
+    """
+    config = config or MockConfig()
+    server = ThreadingHTTPServer((host, port), _make_handler(config))
+    server.daemon_threads = True
+    server.config = config  # type: ignore[attr-defined]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}/v1"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline OpenAI-compatible mock server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="每個 request 的平均延遲")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="延遲的隨機浮動範圍")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="回傳 500 的比例")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="回傳 429 的比例")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429 的 Retry-After 秒數")
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM, help="Embedding 維度")
+    parser.add_argument("--seed", type=int, default=None, help="錯誤注入的亂數 seed")
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        dim=args.dim,
+        seed=args.seed,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), _make_handler(config))
+    server.daemon_threads = True
+    print(f"  Mock LLM server: OPENAI_BASE_URL=http://{args.host}:{args.port}/v1 (Ctrl+C 停止)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n  Mock server 已停止: {config.stats}")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
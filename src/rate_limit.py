@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: capacity 個 token，每分鐘補滿 capacity 個
+    capacity <= 0 代表不限制
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """
+        預先扣掉 amount 個 token，回傳需要等待的秒數 (token 可以暫時為負，後面的呼叫者會等更久)
+        單次超過 capacity 的請求以 capacity 計，避免永遠等不到
+        """
+        if self.unlimited:
+            return 0.0
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self, amount: float = 1.0) -> None:
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """
+    同時限制每分鐘 request 數 (RPM) 與 token 數 (TPM)，供多個 worker 共用
+    """
+
+    def __init__(self, rpm: float = 0, tpm: float = 0) -> None:
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    @classmethod
+    def from_env(cls, prefix: str = "LLM") -> "RateLimiter":
+        return cls(
+            rpm=float(os.getenv(f"{prefix}_RPM", "0")),
+            tpm=float(os.getenv(f"{prefix}_TPM", "0")),
+        )
+
+    @property
+    def unlimited(self) -> bool:
+        return self.requests.unlimited and self.tokens.unlimited
+
+    def reserve(self, tokens: Optional[int] = None) -> float:
+        """
+        預約一個估計用掉 tokens 個 token 的 request，回傳需要等待的秒數 (async 呼叫端自行 await sleep)
+        """
+        return max(self.requests.reserve(1), self.tokens.reserve(tokens or 0))
+
+    def acquire(self, tokens: Optional[int] = None) -> None:
+        """
+        等到可以送出一個估計用掉 tokens 個 token 的 request
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+
+_shared: Dict[str, RateLimiter] = {}
+_shared_lock = threading.Lock()
+
+
+def shared_limiter(prefix: str = "LLM") -> RateLimiter:
+    """
+    同一個 process 內、同一個 prefix 共用一個 limiter (例如多個 LLMClient 實例)
+    """
+    with _shared_lock:
+        limiter = _shared.get(prefix)
+        if limiter is None:
+            limiter = _shared[prefix] = RateLimiter.from_env(prefix)
+        return limiter
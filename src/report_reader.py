@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import json
+import os
+from html.parser import HTMLParser
+from typing import List
+
+from .utils import read_text_file
+
+# run_pipeline 會處理的報告格式
+SUPPORTED_EXTENSIONS = (".txt", ".md", ".log", ".csv", ".json", ".html", ".htm", ".pdf")
+
+
+class _TextExtractor(HTMLParser):
+    _SKIP = {"script", "style", "noscript"}
+    _BLOCK = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "pre", "table"}
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.parts: List[str] = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIP:
+            self._skip += 1
+        elif tag in self._BLOCK:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIP and self._skip:
+            self._skip -= 1
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def _read_html(path: str) -> str:
+    parser = _TextExtractor()
+    parser.feed(read_text_file(path))
+    lines = (line.strip() for line in "".join(parser.parts).splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def _read_pdf(path: str) -> str:
+    try:
+        from pypdf import PdfReader
+    except ImportError as e:
+        raise RuntimeError("讀取 PDF 需要 pypdf: pip install pypdf") from e
+    reader = PdfReader(path)
+    return "\n".join((page.extract_text() or "") for page in reader.pages)
+
+
+def _read_json(path: str) -> str:
+    # JSON 報告原樣送給 LLM，只是先確認格式正確
+    text = read_text_file(path)
+    json.loads(text)
+    return text
+
+
+def is_supported(filename: str) -> bool:
+    return not filename.startswith(".") and filename.lower().endswith(SUPPORTED_EXTENSIONS)
+
+
+def read_report(path: str) -> str:
+    """
+    依副檔名把 CTI 報告轉成純文字
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        text = _read_pdf(path)
+    elif ext in (".html", ".htm"):
+        text = _read_html(path)
+    elif ext == ".json":
+        text = _read_json(path)
+    else:
+        text = read_text_file(path)
+
+    if not text.strip():
+        raise RuntimeError(f"報告內容為空或無法擷取文字: {os.path.basename(path)}")
+    return text
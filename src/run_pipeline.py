@@ -1,19 +1,35 @@
 from __future__ import annotations
 
+import argparse
 import json
 import os
-import time
+import re
 import shutil
 import logging
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from typing import Any, Deque, Dict, Optional, Set, Tuple
 
 from dotenv import load_dotenv
 
-from .extract_schema import DEFAULT_SYSTEM_PROMPT, EXTRACTION_SCHEMA_DESCRIPTION
+from .chunked_extract import DEFAULT_CHUNK_TOKENS, extract_chunked
+from .extract_schema import (
+    DEFAULT_SYSTEM_PROMPT,
+    EXTRACTION_SCHEMA_DESCRIPTION,
+    EXTRACTION_SCHEMA_DESCRIPTION_NO_INDICATORS,
+)
+from .extraction_cache import ExtractionCache
+from .input_watcher import DEFAULT_JOURNAL_DIR, WorkJournal, create_watcher
+from .ioc_extract import extract_iocs
 from .llm_client import LLMClient
-from .to_stix import build_stix_bundle
-from .validate_stix import validate_stix_json
-from .utils import ensure_dir, read_text_file, write_json, write_text
+from .to_stix import write_stix_bundle
+from .validate_stix import validate_stix_file
+from .report_reader import is_supported, read_report
+from .stix_index import create_stix_indices, get_opensearch_client, index_stix_bundle
+from .utils import ensure_dir, write_json
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,52 +39,175 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 INPUT_DIR = "data/input"
+PROCESSING_DIR = "data/processing"  # 已被 worker claim、處理中的檔案
 PROCESSED_DIR = "data/processed"
 ERROR_DIR = "data/error"
 OUT_DIR = "out"
+# crash 後重新排入超過 PIPELINE_MAX_ATTEMPTS 次的檔案直接移到 error
+DEFAULT_MAX_ATTEMPTS = 3
+
+# 所有 worker 共用一個 extraction cache (EXTRACTION_CACHE_PATH="" 可關閉)
+_extraction_cache: Optional[ExtractionCache] = None
+_extraction_cache_loaded = False
+_extraction_cache_lock = threading.Lock()
+
+# STIX_INDEX=1 時把 bundle 匯入 OpenSearch (Layer 3)，所有 worker 共用一個 client
+_stix_index_client = None
+_stix_index_lock = threading.Lock()
 
-def build_user_prompt(cti_text: str) -> str:
-    return f"""{EXTRACTION_SCHEMA_DESCRIPTION}
+def build_user_prompt(cti_text: str, schema: str = EXTRACTION_SCHEMA_DESCRIPTION) -> str:
+    return f"""{schema}
 
 CTI_REPORT_TEXT:
 {cti_text}
 """
 
-def process_single_file(file_path: str, filename: str, llm: LLMClient) -> None:
+def _get_extraction_cache() -> Optional[ExtractionCache]:
+    global _extraction_cache, _extraction_cache_loaded
+    with _extraction_cache_lock:
+        if not _extraction_cache_loaded:
+            _extraction_cache = ExtractionCache.from_env()
+            _extraction_cache_loaded = True
+        return _extraction_cache
+
+def _get_stix_index_client():
+    global _stix_index_client
+    with _stix_index_lock:
+        if _stix_index_client is None:
+            client = get_opensearch_client()
+            create_stix_indices(client)
+            _stix_index_client = client
+        return _stix_index_client
+
+def index_bundle(stix_out_path: str, llm: LLMClient, extracted: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    把 bundle 匯入 OpenSearch；失敗只記錄 log，不影響報告處理結果 (bundle 仍在 out/，可用 src.stix_index 補匯)
+    """
+    if os.getenv("STIX_INDEX", "0") != "1":
+        return None
+    try:
+        stats = index_stix_bundle(_get_stix_index_client(), stix_out_path, llm, extracted=extracted)
+    except Exception as e:
+        logger.warning(f"  STIX 匯入 OpenSearch 失敗: {str(e)}")
+        return {"error": str(e)}
+    return {index: {"indexed": s["indexed"], "failed": s["failed"]} for index, s in stats.items()}
+
+def extract_report(cti_text: str, llm: LLMClient) -> Tuple[Dict[str, Any], bool]:
+    """
+    呼叫 LLM 抽取 (先查 extraction cache)，回傳 (extracted, 是否命中 cache)
+    cache 只存 LLM 的輸出，regex IOC 不論是否命中都重新抽
+    """
+    # IOC 先用 regex 抽 (IOC_PREEXTRACT=0 關閉)，LLM 只負責摘要 / TTP / actor / log 建議
+    pre_extract = os.getenv("IOC_PREEXTRACT", "1") != "0"
+    schema = EXTRACTION_SCHEMA_DESCRIPTION_NO_INDICATORS if pre_extract else EXTRACTION_SCHEMA_DESCRIPTION
+    # 切塊大小會改變 LLM 看到的內容，所以也是 cache key 的一部分
+    chunk_tokens = int(os.getenv("EXTRACT_CHUNK_TOKENS", str(DEFAULT_CHUNK_TOKENS)))
+
+    cache = _get_extraction_cache()
+    key = None
+    extracted = None
+    if cache is not None:
+        key = cache.make_key(cti_text, DEFAULT_SYSTEM_PROMPT, schema, llm.chat_cache_model,
+                             settings=f"chunk_tokens={chunk_tokens}")
+        extracted = cache.get(key)
+    cached = extracted is not None
+
+    if cached:
+        logger.info(f"  使用 extraction cache，略過 LLM 呼叫")
+    else:
+        logger.info(f"  正在呼叫 LLM 進行分析...")
+        # 長篇報告會切塊併發抽取再合併 (EXTRACT_CHUNK_TOKENS)
+        extracted = extract_chunked(
+            llm,
+            cti_text,
+            system_prompt=DEFAULT_SYSTEM_PROMPT,
+            build_prompt=lambda text: build_user_prompt(text, schema),
+            max_tokens=chunk_tokens,
+        )
+        if cache is not None:
+            cache.put(key, llm.chat_cache_model, cti_text, extracted)
+
+    if pre_extract:
+        extracted["indicators"] = extract_iocs(cti_text)
+    return extracted, cached
+
+def _output_run_pattern(prefix: str) -> re.Pattern:
+    return re.compile(rf"^{re.escape(prefix)}_(\d{{8}}_\d{{6}})_(extracted|bundle|validation|report)\.json$")
+
+def _legacy_run_source(timestamp_prefix: str) -> Optional[str]:
+    # 舊版輸出檔名不含副檔名，只能從該次的 report.json 讀出來源檔名
+    try:
+        with open(os.path.join(OUT_DIR, f"{timestamp_prefix}_report.json"), "r", encoding="utf-8") as f:
+            return json.load(f).get("input_file")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def remove_superseded_outputs(filename: str, keep_timestamp: str) -> int:
+    """
+    刪除同一份報告較舊的輸出 (<filename>_<timestamp>_{extracted,bundle,validation,report}.json)，回傳刪除的檔案數
+
+    輸出檔名包含來源副檔名，report.txt 與 report.pdf 不會互相刪到；舊版以去掉副檔名命名的輸出，
+    只有 report.json 記錄的 input_file 是同一個檔案時才刪除
+    """
+    current = _output_run_pattern(filename)
+    legacy_prefix = os.path.splitext(filename)[0]
+    legacy = _output_run_pattern(legacy_prefix) if legacy_prefix != filename else None
+    legacy_sources: Dict[str, Optional[str]] = {}
+    removed = 0
+    for name in os.listdir(OUT_DIR):
+        m = current.match(name)
+        if m is None and legacy is not None:
+            m = legacy.match(name)
+            if m is not None:
+                ts = m.group(1)
+                if ts not in legacy_sources:
+                    legacy_sources[ts] = _legacy_run_source(f"{legacy_prefix}_{ts}")
+                if legacy_sources[ts] != filename:
+                    continue
+        if m and m.group(1) != keep_timestamp:
+            try:
+                os.remove(os.path.join(OUT_DIR, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+def process_single_file(file_path: str, filename: str, llm: LLMClient,
+                        replace_previous: bool = False) -> Dict[str, Any]:
+    """
+    replace_previous: 成功後刪除同一份報告之前產生的輸出 (--reprocess 用)
+    """
 
     logger.info(f"  開始處理檔案: {filename}")
     
-    cti_text = read_text_file(file_path)
+    cti_text = read_report(file_path)
     
-    # 移除副檔名
-    base_name = os.path.splitext(filename)[0]
+    # 保留副檔名：report.txt 與 report.pdf 的輸出 (以及 OpenSearch 內的 report 名稱) 不會混在一起
+    base_name = filename
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
-    logger.info(f"  正在呼叫 LLM 進行分析...")
-    extracted = llm.extract_json(
-        system_prompt=DEFAULT_SYSTEM_PROMPT,
-        user_prompt=build_user_prompt(cti_text),
-    )
+    extracted, cached = extract_report(cti_text, llm)
     
     # 輸出
     extract_out_path = f"{OUT_DIR}/{base_name}_{timestamp}_extracted.json"
     write_json(extract_out_path, extracted)
 
     # 轉換 STIX 2.1
+    # 邊產生邊寫入 STIX Bundle，驗證時再逐物件從檔案串流讀回，不在記憶體保留整個 bundle
     logger.info(f"  正在轉換為 STIX 2.1 格式...")
-    stix_json_str = build_stix_bundle(extracted)
-    
-    # 輸出 STIX Bundle
     stix_out_path = f"{OUT_DIR}/{base_name}_{timestamp}_bundle.json"
-    write_text(stix_out_path, stix_json_str)
+    write_stix_bundle(extracted, stix_out_path)
 
     # 驗證 STIX 
-    ok, val_payload = validate_stix_json(stix_json_str)
+    ok, val_payload = validate_stix_file(stix_out_path)
     
     # 驗證報告
     val_out_path = f"{OUT_DIR}/{base_name}_{timestamp}_validation.json"
     write_json(val_out_path, val_payload)
 
+    # 匯入 OpenSearch (STIX_INDEX=1)
+    indexed = index_bundle(stix_out_path, llm, extracted)
+
     num_indicators = sum(
         len((extracted.get("indicators", {}) or {}).get(k, []))
         for k in ["ipv4", "ipv6", "domains", "urls"]
@@ -79,6 +218,8 @@ def process_single_file(file_path: str, filename: str, llm: LLMClient) -> None:
         "processed_at": timestamp,
         "status": "Success",
         "validator_pass": ok,
+        "extraction_cached": cached,
+        "opensearch_indexed": indexed,
         "confidence": extracted.get("confidence"),
         "metrics": {
             "indicators": num_indicators,
@@ -94,55 +235,199 @@ def process_single_file(file_path: str, filename: str, llm: LLMClient) -> None:
     # 輸出: 總結報告
     report_out_path = f"{OUT_DIR}/{base_name}_{timestamp}_report.json"
     write_json(report_out_path, report)
+
+    if replace_previous:
+        removed = remove_superseded_outputs(filename, timestamp)
+        if removed:
+            logger.info(f"  已刪除 {removed} 個舊的輸出檔")
     
     logger.info(f"  處理完成! STIX Bundle 已儲存至: {stix_out_path}")
     logger.info(f"  提取統計: IOCs={num_indicators}, TTPs={report['metrics']['ttps']}")
+    return report
+
+def reprocess_archived(llm: LLMClient, concurrency: int) -> Dict[str, int]:
+    """
+    重新產生 data/processed 內所有報告的 STIX bundle；抽取結果走 extraction cache，
+    只有 cache miss (例如 prompt 改過) 的報告才會呼叫 LLM。報告檔案不會被移動，
+    out/ 內同一份報告舊的 bundle / 驗證結果會被新的取代
+    """
+    files = sorted(f for f in os.listdir(PROCESSED_DIR) if is_supported(f))
+    stats = {"files": len(files), "rebuilt": 0, "cache_hits": 0, "failed": 0}
+    logger.info(f"  重新處理 {len(files)} 份已歸檔報告 (concurrency={concurrency})")
+
+    def _run(filename: str) -> Optional[Dict[str, Any]]:
+        try:
+            return process_single_file(os.path.join(PROCESSED_DIR, filename), filename, llm, replace_previous=True)
+        except Exception as e:
+            logger.error(f"  重新處理 {filename} 時發生錯誤: {str(e)}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for report in pool.map(_run, files):
+            if report is None:
+                stats["failed"] += 1
+                continue
+            stats["rebuilt"] += 1
+            stats["cache_hits"] += int(report["extraction_cached"])
+
+    logger.info(f"  重新處理完成: {stats}")
+    return stats
+
+def _collision_name(filename: str) -> str:
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}_{uuid.uuid4().hex[:8]}{ext}"
+
+def claim_file(filename: str, journal: Optional[WorkJournal] = None) -> Optional[str]:
+    """
+    把檔案從 input 移到 processing 資料夾，回傳 claim 後的路徑；搶輸 (檔案已被別人 claim) 回傳 None
+
+    - 用 os.link 建立目標再 unlink 來源：目標已存在時 link 一定失敗 (rename 會直接覆蓋)，
+      同一個檔案只會被一個 worker (或一個 pipeline process) 搶到
+    - processing 內已有同名但不同的檔案 (同名報告再次放入) 時改名 claim，不會把新檔案留在 input
+    - 先記 journal 再 link：crash 在兩者之間時 processing 內的檔案一定找得到 owner
+    """
+    src_path = os.path.join(INPUT_DIR, filename)
+    name = filename
+    while True:
+        claimed_path = os.path.join(PROCESSING_DIR, name)
+        if journal is not None:
+            journal.claimed(name)
+        try:
+            os.link(src_path, claimed_path)
+        except FileNotFoundError:
+            # 來源已被其他 worker claim 走
+            if journal is not None:
+                journal.forget(name)
+            return None
+        except FileExistsError:
+            if journal is not None:
+                journal.forget(name)
+            try:
+                if os.path.samefile(src_path, claimed_path):
+                    # 其他 worker 剛 link 完、還沒 unlink 來源
+                    return None
+            except FileNotFoundError:
+                if not os.path.exists(src_path):
+                    return None
+                # 同名的舊檔剛處理完離開 processing，用原名再試一次
+                continue
+            name = _collision_name(filename)
+            logger.warning(f"  processing 內已有同名檔案 {filename}，改名為 {name} 處理")
+            continue
+        try:
+            os.unlink(src_path)
+        except FileNotFoundError:
+            pass
+        return claimed_path
+
+def recover_claimed_files(journal: WorkJournal) -> None:
+    """
+    已結束的 process (包含這個 process 上次的執行) 留在 processing 的檔案放回 input 重新處理；
+    只處理 journal 內的檔案，其他還在執行的 pipeline process 處理中的檔案不會被動到。
+    已重試 PIPELINE_MAX_ATTEMPTS 次的檔案 (可能每次都讓 process 掛掉) 移到 error
+    """
+    max_attempts = int(os.getenv("PIPELINE_MAX_ATTEMPTS", str(DEFAULT_MAX_ATTEMPTS)))
+    for filename in sorted(journal.in_flight):
+        claimed_path = os.path.join(PROCESSING_DIR, filename)
+        if not os.path.exists(claimed_path):
+            journal.forget(filename)
+            continue
+        if journal.attempts(filename) >= max_attempts:
+            shutil.move(claimed_path, os.path.join(ERROR_DIR, filename))
+            journal.finished(filename, ok=False)
+            logger.error(f"  檔案 {filename} 已嘗試 {max_attempts} 次仍未完成，移至錯誤區")
+            continue
+        shutil.move(claimed_path, os.path.join(INPUT_DIR, filename))
+        logger.warning(f"  重新排入未完成的檔案: {filename}")
+
+def run_claimed_file(claimed_path: str, filename: str, llm: LLMClient,
+                     journal: Optional[WorkJournal] = None) -> bool:
+    """
+    Worker: 處理已 claim 的檔案，成功移到 processed，失敗移到 error
+    """
+    ok = False
+    try:
+        process_single_file(claimed_path, filename, llm)
+
+        dest_path = os.path.join(PROCESSED_DIR, filename)
+        shutil.move(claimed_path, dest_path)
+        logger.info(f"  檔案已歸檔至: {dest_path}")
+        ok = True
+
+    except Exception as e:
+        logger.error(f"  處理檔案 {filename} 時發生錯誤: {str(e)}")
+        error_dest_path = os.path.join(ERROR_DIR, filename)
+        shutil.move(claimed_path, error_dest_path)
+        logger.warning(f"  檔案已移至錯誤區: {error_dest_path}")
+
+    if journal is not None:
+        journal.finished(filename, ok)
+    return ok
 
 def main() -> None:
     load_dotenv()
 
+    parser = argparse.ArgumentParser(description="CTI report -> STIX 2.1 pipeline")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("PIPELINE_CONCURRENCY", "4")),
+                        help="同時處理的報告數")
+    parser.add_argument("--reprocess", action="store_true",
+                        help="用 extraction cache 重建 data/processed 內所有報告的 STIX bundle 後結束")
+    args = parser.parse_args()
+    concurrency = max(1, args.concurrency)
+
     ensure_dir(INPUT_DIR)
+    ensure_dir(PROCESSING_DIR)
     ensure_dir(PROCESSED_DIR)
     ensure_dir(ERROR_DIR)
     ensure_dir(OUT_DIR)
 
     llm = LLMClient()
+    if args.reprocess:
+        reprocess_archived(llm, concurrency)
+        return
+
+    journal = WorkJournal(os.getenv("PIPELINE_JOURNAL_DIR", DEFAULT_JOURNAL_DIR))
+    recover_claimed_files(journal)
+    watcher = create_watcher(INPUT_DIR, is_supported, poll_interval=5.0)
     
     logger.info("  CTI Pipeline 監控服務已啟動...")
-    logger.info(f"  監控資料夾: {INPUT_DIR}")
+    logger.info(f"  監控資料夾: {INPUT_DIR} (watcher={type(watcher).__name__}, concurrency={concurrency})")
     logger.info("按 Ctrl+C 可停止服務")
 
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    in_flight: Set[Future] = set()
+    # 已寫入完成、等待 worker 的檔案
+    pending: Deque[str] = deque()
+    queued: Set[str] = set()
+
     try:
         while True:
-            # 取得 input 資料夾內的所有 .txt
-            files = [f for f in os.listdir(INPUT_DIR) if f.endswith(".txt")]
-            
-            if not files:
-                time.sleep(5)
-                continue
-            
-            for filename in files:
-                src_path = os.path.join(INPUT_DIR, filename)
-                
-                try:
-                    process_single_file(src_path, filename, llm)
-                    
-                    dest_path = os.path.join(PROCESSED_DIR, filename)
-                    shutil.move(src_path, dest_path)
-                    logger.info(f"  檔案已歸檔至: {dest_path}")
-                    
-                except Exception as e:
-                    logger.error(f"  處理檔案 {filename} 時發生錯誤: {str(e)}")
-                    error_dest_path = os.path.join(ERROR_DIR, filename)
-                    shutil.move(src_path, error_dest_path)
-                    logger.warning(f"  檔案已移至錯誤區: {error_dest_path}")
-
-            time.sleep(1)
+            in_flight = {f for f in in_flight if not f.done()}
+
+            # 只 claim worker 處理得完的數量，其餘留在 input 給其他 pipeline process
+            while pending and len(in_flight) < concurrency:
+                filename = pending.popleft()
+                queued.discard(filename)
+                claimed_path = claim_file(filename, journal)
+                if claimed_path is None:
+                    continue
+                in_flight.add(pool.submit(run_claimed_file, claimed_path, os.path.basename(claimed_path),
+                                          llm, journal))
+
+            # 有工作在跑時最多等 1 秒，才能及時補上空出來的 worker
+            for filename in watcher.poll(1.0 if in_flight else 5.0):
+                if filename not in queued:
+                    queued.add(filename)
+                    pending.append(filename)
 
     except KeyboardInterrupt:
-        logger.info("\n  服務已手動停止 (KeyboardInterrupt)")
+        logger.info("\n  服務已手動停止 (KeyboardInterrupt)，等待進行中的檔案完成...")
     except Exception as e:
         logger.critical(f"  系統發生未預期錯誤: {e}")
+    finally:
+        pool.shutdown(wait=True)
+        watcher.close()
+        journal.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,6 +2,8 @@ import os
 from dotenv import load_dotenv
 from opensearchpy import OpenSearch
 
+from .stix_index import create_stix_indices
+
 load_dotenv()
 
 def get_opensearch_client():
@@ -41,7 +43,10 @@ def create_index():
                     }
                 },
                 "log_text": {"type": "text"},
-                "log_source": {"type": "keyword"} # 新增 filter 欄位
+                "log_source": {"type": "keyword"}, # 新增 filter 欄位
+                # Log template (Drain) 的 ID，可當便宜的 filter 欄位
+                "template_id": {"type": "keyword"},
+                "log_template": {"type": "keyword", "ignore_above": 1024}
             }
         }
     }
@@ -54,4 +59,7 @@ def create_index():
         print(f"  Index '{index_name}' 已經存在，跳過建立步驟。")
 
 if __name__ == "__main__":
-    create_index()
\ No newline at end of file
+    create_index()
+    # STIX 物件的 index (Layer 3)
+    for name in create_stix_indices(get_opensearch_client()):
+        print(f"  Index '{name}' 建立成功！")
\ No newline at end of file
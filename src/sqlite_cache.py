@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+# SQLite 一個 statement 的參數上限是 999 (舊版)，分批查詢
+_QUERY_BATCH = 900
+
+
+class SQLiteLRUCache:
+    """
+    embedding / extraction / validation cache 共用的 SQLite key-value 表
+
+    - WAL 模式，多個 process (ingest、detect、pipeline) 可同時共用同一個檔案
+    - 子類別以 TABLE 與 COLUMNS (key、last_used 以外的欄位定義) 描述資料表
+    - 超過 max_entries 時依 last_used 做 LRU 淘汰
+    - 讀取命中時只在記憶體記下 last_used，累積 TOUCH_FLUSH 筆、下次寫入或 close 時才批次寫回，
+      讀取路徑不必每次 UPDATE + commit
+    """
+
+    TABLE = ""
+    COLUMNS: Tuple[str, ...] = ()
+    TOUCH_FLUSH = 1000
+
+    def __init__(self, path: str, max_entries: int) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._touched: Dict[str, float] = {}
+        self._names = [c.split()[0] for c in self.COLUMNS]
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({self.TABLE})")}
+        if columns:
+            self._migrate(columns)
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.TABLE} "
+            f"(key TEXT PRIMARY KEY, {', '.join(self.COLUMNS)}, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.TABLE}_last_used ON {self.TABLE}(last_used)")
+        self._conn.commit()
+
+    def _migrate(self, columns: set) -> None:
+        """
+        資料表已存在時呼叫；預設替沒有 last_used 的舊表補上欄位 (舊資料最先被淘汰)
+        """
+        if "last_used" not in columns:
+            self._conn.execute(f"ALTER TABLE {self.TABLE} ADD COLUMN last_used REAL NOT NULL DEFAULT 0")
+
+    def _get_rows(self, keys: Iterable[str]) -> Dict[str, Tuple]:
+        """
+        key -> COLUMNS 順序的值
+        """
+        keys = list(dict.fromkeys(keys))
+        found: Dict[str, Tuple] = {}
+        with self._lock:
+            for start in range(0, len(keys), _QUERY_BATCH):
+                batch = keys[start:start + _QUERY_BATCH]
+                rows = self._conn.execute(
+                    f"SELECT key, {', '.join(self._names)} FROM {self.TABLE} "
+                    f"WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for row in rows:
+                    found[row[0]] = row[1:]
+
+            if found:
+                now = time.time()
+                self._touched.update((k, now) for k in found)
+                if len(self._touched) >= self.TOUCH_FLUSH:
+                    self._flush_touched()
+                    self._conn.commit()
+        return found
+
+    def _put_rows(self, rows: Dict[str, Sequence]) -> None:
+        if not rows:
+            return
+        now = time.time()
+        placeholders = ", ".join("?" * (len(self._names) + 2))
+        with self._lock:
+            self._flush_touched()
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {self.TABLE} (key, {', '.join(self._names)}, last_used) "
+                f"VALUES ({placeholders})",
+                [(key, *values, now) for key, values in rows.items()],
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _flush_touched(self) -> None:
+        if not self._touched:
+            return
+        touched: List[Tuple[float, str]] = [(t, k) for k, t in self._touched.items()]
+        self._touched.clear()
+        self._conn.executemany(f"UPDATE {self.TABLE} SET last_used = ? WHERE key = ?", touched)
+
+    def _evict(self) -> None:
+        # 超過上限時，一次多刪 1% 避免每次寫入都觸發淘汰
+        count = self._conn.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow <= 0:
+            return
+        overflow += max(1, self.max_entries // 100)
+        self._conn.execute(
+            f"DELETE FROM {self.TABLE} WHERE key IN "
+            f"(SELECT key FROM {self.TABLE} ORDER BY last_used ASC LIMIT ?)",
+            (overflow,),
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+            self._conn.close()
@@ -0,0 +1,431 @@
+"""
+Layer 3: 把 STIX bundle 匯入 OpenSearch，讓 Layer 4/5 直接查詢而不必掃 out/ 的檔案
+
+    python -m src.stix_index --setup            # 建立 index
+    python -m src.stix_index                    # 匯入 out/ 下所有 *_bundle.json
+    python -m src.stix_index --lookup 1.2.3.4   # 查 IOC
+
+- 每種物件一個 index。STIX id 每次產生 bundle 都不同 (uuid4)，所以 _id 改用 (報告, 類型, pattern / 名稱) 的 hash：
+  重新匯入或 --reprocess 後的新 bundle 只會覆寫同一份報告的文件 (idempotent)，新 bundle 已經沒有的物件會被刪掉
+- indicator 的值 / 類型、MITRE technique ID 都是 keyword 欄位，可做精確查詢與跨報告去重 (terms aggregation)
+- attack-pattern 額外存 name + description 的 embedding，供語意搜尋 TTP
+- cti-ttp-vectors: attack-pattern 與報告的 log_suggestions 的向量，給 detect_anomaly 把異常 Log 對應到 MITRE technique
+"""
+from __future__ import annotations
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+from typing import Any, Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+from opensearchpy import OpenSearch
+
+from .bulk_index import bulk_index, print_bulk_stats
+from .cti_indices import (
+    ATTACK_PATTERN_INDEX,
+    INDICATOR_INDEX,
+    MALWARE_TOOL_INDEX,
+    RELATIONSHIP_INDEX,
+    TTP_VECTOR_INDEX,
+)
+from .stix_pattern import compile_indicators
+from .validate_stix import iter_bundle_objects
+
+DEFAULT_BUNDLE_DIR = "out"
+BUNDLE_GLOB = "*_bundle.json"
+EMBEDDING_DIM = 1536
+
+_KNN_VECTOR = {
+    "type": "knn_vector",
+    "dimension": EMBEDDING_DIM,
+    "method": {
+        "name": "hnsw",
+        "space_type": "cosinesimil",
+        "engine": "nmslib",
+        "parameters": {"ef_construction": 128, "m": 24},
+    },
+}
+
+# 所有 STIX index 共用的欄位
+_COMMON_PROPERTIES: Dict[str, Any] = {
+    "stix_id": {"type": "keyword"},
+    "stix_type": {"type": "keyword"},
+    "created": {"type": "date"},
+    "modified": {"type": "date"},
+    "created_by_ref": {"type": "keyword"},
+    "confidence": {"type": "integer"},
+    "labels": {"type": "keyword"},
+    "object_marking_refs": {"type": "keyword"},
+    "report": {"type": "keyword"},
+    "bundle": {"type": "keyword"},  # 產生這筆文件的 bundle 檔名，用來刪掉舊 bundle 留下的文件
+    "doc_id": {"type": "keyword"},
+}
+
+INDEX_PROPERTIES: Dict[str, Dict[str, Any]] = {
+    INDICATOR_INDEX: {
+        "name": {"type": "text"},
+        "pattern": {"type": "keyword", "ignore_above": 4096},
+        "pattern_type": {"type": "keyword"},
+        "valid_from": {"type": "date"},
+        # 一個 pattern 可能有多個值 (OR)，都存成 keyword 陣列
+        "ioc_values": {"type": "keyword"},
+        "ioc_types": {"type": "keyword"},
+        "hash_algos": {"type": "keyword"},
+    },
+    ATTACK_PATTERN_INDEX: {
+        "name": {"type": "text", "fields": {"raw": {"type": "keyword"}}},
+        "description": {"type": "text"},
+        "mitre_id": {"type": "keyword"},
+        "embedding_text": {"type": "text", "index": False},
+        "ttp_vector": _KNN_VECTOR,
+    },
+    MALWARE_TOOL_INDEX: {
+        "name": {"type": "text", "fields": {"raw": {"type": "keyword"}}},
+        "is_family": {"type": "boolean"},
+    },
+    RELATIONSHIP_INDEX: {
+        "relationship_type": {"type": "keyword"},
+        "source_ref": {"type": "keyword"},
+        "target_ref": {"type": "keyword"},
+    },
+    TTP_VECTOR_INDEX: {
+        # _id 是內容 hash，不同報告抽出同樣的 TTP / log 建議只會有一筆
+        "doc_id": {"type": "keyword"},
+        "kind": {"type": "keyword"},  # attack-pattern / log-suggestion
+        "name": {"type": "text", "fields": {"raw": {"type": "keyword"}}},
+        "text": {"type": "text"},
+        "mitre_ids": {"type": "keyword"},
+        "mitre_names": {"type": "keyword"},  # 與 mitre_ids 同順序
+        "log_type": {"type": "keyword"},
+        "ttp_vector": _KNN_VECTOR,
+    },
+}
+
+_VECTOR_INDICES = {ATTACK_PATTERN_INDEX, TTP_VECTOR_INDEX}
+
+# STIX type -> index
+TYPE_TO_INDEX = {
+    "indicator": INDICATOR_INDEX,
+    "attack-pattern": ATTACK_PATTERN_INDEX,
+    "malware": MALWARE_TOOL_INDEX,
+    "tool": MALWARE_TOOL_INDEX,
+    "relationship": RELATIONSHIP_INDEX,
+}
+
+
+def get_opensearch_client() -> OpenSearch:
+    return OpenSearch(
+        hosts=[{'host': 'localhost', 'port': 9200}],
+        http_compress=True,
+        use_ssl=False,
+    )
+
+
+def create_stix_indices(client: OpenSearch) -> List[str]:
+    """
+    建立尚未存在的 STIX index，回傳新建立的 index 名稱
+    """
+    created = []
+    for index, properties in INDEX_PROPERTIES.items():
+        if client.indices.exists(index=index):
+            continue
+        if index == TTP_VECTOR_INDEX:
+            body: Dict[str, Any] = {"mappings": {"properties": {**properties, "stix_id": {"type": "keyword"},
+                                                                "report": {"type": "keyword"}}}}
+        else:
+            body = {"mappings": {"properties": {**_COMMON_PROPERTIES, **properties}}}
+        if index in _VECTOR_INDICES:
+            body["settings"] = {"index": {"knn": True, "knn.algo_param.ef_search": 100}}
+        client.indices.create(index=index, body=body)
+        created.append(index)
+    return created
+
+
+def mitre_technique_id(obj: Dict[str, Any]) -> Optional[str]:
+    for ref in obj.get("external_references", []) or []:
+        if ref.get("source_name") == "mitre-attack" and ref.get("external_id"):
+            return ref["external_id"]
+    return None
+
+
+def ttp_embedding_text(name: str, description: str = "") -> str:
+    # attack-pattern 與之後要比對的文字都用同一個格式
+    return f"{name}: {description}" if description else name
+
+
+_BUNDLE_NAME_RE = re.compile(r"^(.+?)(?:_\d{8}_\d{6})?_bundle\.json$")
+
+
+def report_name(bundle_path: str) -> str:
+    """
+    <report>_<YYYYMMDD_HHMMSS>_bundle.json -> <report>：同一份報告重新產生的 bundle 得到同一個名稱
+    """
+    name = os.path.basename(bundle_path)
+    m = _BUNDLE_NAME_RE.match(name)
+    return m.group(1) if m else name
+
+
+def latest_bundles(paths: List[str]) -> List[str]:
+    """
+    每份報告只留最新的 bundle (檔名內的時間戳記最大者)
+    """
+    latest: Dict[str, str] = {}
+    for path in sorted(paths, key=os.path.basename):
+        latest[report_name(path)] = path
+    return sorted(latest.values())
+
+
+def _natural_key(obj: Dict[str, Any]) -> Optional[str]:
+    # 同一份報告內不會因重新產生而改變的識別內容；relationship 由兩端的 key 組成
+    stix_type = obj.get("type")
+    if stix_type == "indicator":
+        return obj.get("pattern")
+    if stix_type == "attack-pattern":
+        return mitre_technique_id(obj) or obj.get("name")
+    if stix_type in ("malware", "tool"):
+        return obj.get("name")
+    return None
+
+
+def _doc_id(report: str, stix_type: str, *parts: Optional[str]) -> str:
+    h = hashlib.sha256("\0".join([report, stix_type, *(p or "" for p in parts)]).encode("utf-8")).hexdigest()
+    return f"{stix_type}--{h[:32]}"
+
+
+def _doc_ids(bundle_path: str, report: str) -> Dict[str, str]:
+    """
+    STIX id -> 文件 _id (relationship 以外的物件)
+    """
+    ids: Dict[str, str] = {}
+    for obj in iter_bundle_objects(bundle_path):
+        if isinstance(obj, dict) and obj.get("type") in TYPE_TO_INDEX and obj.get("type") != "relationship":
+            ids[obj["id"]] = _doc_id(report, obj["type"], _natural_key(obj))
+    return ids
+
+
+def _base_doc(obj: Dict[str, Any], report: Optional[str]) -> Dict[str, Any]:
+    doc = {
+        "stix_id": obj["id"],
+        "stix_type": obj["type"],
+        "report": report,
+    }
+    for field in ("created", "modified", "created_by_ref", "confidence", "labels", "object_marking_refs"):
+        if field in obj:
+            doc[field] = obj[field]
+    return doc
+
+
+def indicator_doc(obj: Dict[str, Any], report: Optional[str] = None) -> Dict[str, Any]:
+    doc = _base_doc(obj, report)
+    doc.update(name=obj.get("name"), pattern=obj.get("pattern"), pattern_type=obj.get("pattern_type"),
+               valid_from=obj.get("valid_from"))
+    iocs = compile_indicators([obj])
+    doc["ioc_values"] = [i["value"] for i in iocs]
+    doc["ioc_types"] = sorted({i["type"] for i in iocs})
+    doc["hash_algos"] = sorted({i["hash_algo"] for i in iocs if i.get("hash_algo")})
+    return doc
+
+
+def attack_pattern_doc(obj: Dict[str, Any], report: Optional[str] = None) -> Dict[str, Any]:
+    doc = _base_doc(obj, report)
+    name = obj.get("name") or ""
+    description = obj.get("description") or ""
+    doc.update(name=name, description=description, mitre_id=mitre_technique_id(obj),
+               embedding_text=ttp_embedding_text(name, description))
+    return doc
+
+
+def malware_tool_doc(obj: Dict[str, Any], report: Optional[str] = None) -> Dict[str, Any]:
+    doc = _base_doc(obj, report)
+    doc.update(name=obj.get("name"), is_family=obj.get("is_family"))
+    return doc
+
+
+def relationship_doc(obj: Dict[str, Any], report: Optional[str] = None) -> Dict[str, Any]:
+    doc = _base_doc(obj, report)
+    doc.update(relationship_type=obj.get("relationship_type"), source_ref=obj.get("source_ref"),
+               target_ref=obj.get("target_ref"))
+    return doc
+
+
+_DOC_BUILDERS = {
+    INDICATOR_INDEX: indicator_doc,
+    ATTACK_PATTERN_INDEX: attack_pattern_doc,
+    MALWARE_TOOL_INDEX: malware_tool_doc,
+    RELATIONSHIP_INDEX: relationship_doc,
+}
+
+
+def _iter_docs(bundle_path: str, index: str, report: str, doc_ids: Dict[str, str]) -> Iterator[Dict[str, Any]]:
+    build = _DOC_BUILDERS[index]
+    bundle = os.path.basename(bundle_path)
+    for obj in iter_bundle_objects(bundle_path):
+        if isinstance(obj, dict) and TYPE_TO_INDEX.get(obj.get("type")) == index:
+            doc = build(obj, report)
+            doc["bundle"] = bundle
+            if obj["type"] == "relationship":
+                source, target = obj.get("source_ref"), obj.get("target_ref")
+                doc["doc_id"] = _doc_id(report, "relationship", obj.get("relationship_type"),
+                                        doc_ids.get(source, source), doc_ids.get(target, target))
+            else:
+                doc["doc_id"] = doc_ids[obj["id"]]
+            yield doc
+
+
+def _delete_superseded(client: OpenSearch, report: str, bundle: str) -> None:
+    """
+    刪掉同一份報告由舊 bundle 寫入、這次沒有被覆寫的文件 (例如修正 IOC 抽取後消失的 indicator)
+    cti-ttp-vectors 的文件是跨報告共用的，不在這裡刪
+    """
+    indices = [INDICATOR_INDEX, ATTACK_PATTERN_INDEX, MALWARE_TOOL_INDEX, RELATIONSHIP_INDEX]
+    client.indices.refresh(index=",".join(indices))
+    client.delete_by_query(
+        index=",".join(indices),
+        body={"query": {"bool": {"filter": [{"term": {"report": report}}],
+                                 "must_not": [{"term": {"bundle": bundle}}]}}},
+        conflicts="proceed",
+    )
+
+
+def log_suggestion_text(suggestion: Dict[str, Any]) -> str:
+    log_type = suggestion.get("log_type") or "log"
+    text = f"{log_type}: {suggestion.get('rationale') or ''}".strip()
+    fields = [f for f in suggestion.get("fields", []) or [] if isinstance(f, str)]
+    if fields:
+        text += f" ({', '.join(fields)})"
+    return text
+
+
+def _link_doc_id(kind: str, text: str, mitre_ids: List[str]) -> str:
+    h = hashlib.sha256(f"{text}\0{','.join(sorted(mitre_ids))}".encode("utf-8")).hexdigest()
+    return f"{kind}--{h[:32]}"
+
+
+def ttp_link_docs(ttp_docs: List[Dict[str, Any]], extracted: Optional[Dict[str, Any]] = None,
+                  report: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    cti-ttp-vectors 的文件 (尚未含向量)：每個 attack-pattern 一筆，每個 log_suggestion 一筆
+    log_suggestion 沒有指定 technique，對應到同一份報告的所有 TTP
+    """
+    docs = []
+    for d in ttp_docs:
+        mitre_ids = [d["mitre_id"]] if d.get("mitre_id") else []
+        docs.append({
+            "doc_id": _link_doc_id("attack-pattern", d["embedding_text"], mitre_ids),
+            "kind": "attack-pattern",
+            "name": d["name"],
+            "text": d["embedding_text"],
+            "mitre_ids": mitre_ids,
+            "mitre_names": [d["name"]] if mitre_ids else [],
+            "stix_id": d["stix_id"],
+            "report": report,
+        })
+
+    names_by_id = {d["mitre_id"]: d["name"] for d in ttp_docs if d.get("mitre_id")}
+    report_ids = sorted(names_by_id)
+    for suggestion in (extracted or {}).get("log_suggestions", []) or []:
+        if not isinstance(suggestion, dict):
+            continue
+        text = log_suggestion_text(suggestion)
+        docs.append({
+            "doc_id": _link_doc_id("log-suggestion", text, report_ids),
+            "kind": "log-suggestion",
+            "name": text,
+            "text": text,
+            "mitre_ids": report_ids,
+            "mitre_names": [names_by_id[m] for m in report_ids],
+            "log_type": suggestion.get("log_type"),
+            "report": report,
+        })
+    return docs
+
+
+def index_stix_bundle(client: OpenSearch, bundle_path: str, llm=None, report: Optional[str] = None,
+                      extracted: Optional[Dict[str, Any]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    把一個 bundle 檔案匯入各 STIX index，回傳每個 index 的 bulk 統計
+
+    report 預設是 bundle 檔名去掉時間戳記，_id 由 (report, 類型, 內容) 決定；全部成功後才刪掉同一份報告舊 bundle 的文件
+    每個 index 各串流讀一次檔案 (記憶體只跟單一物件與 id 對照表有關)；attack-pattern 數量少，
+    一次收齊後用 llm.get_embeddings 批次向量化 (走 embedding cache)。llm 為 None 時不存向量
+    有 llm 時同時把 attack-pattern 與 extracted 的 log_suggestions 向量寫進 cti-ttp-vectors，
+    偵測時不必再計算 TTP 的 embedding
+    """
+    report = report or report_name(bundle_path)
+    doc_ids = _doc_ids(bundle_path, report)
+    stats: Dict[str, Dict[str, Any]] = {}
+    for index in (INDICATOR_INDEX, MALWARE_TOOL_INDEX, RELATIONSHIP_INDEX):
+        stats[index] = bulk_index(client, index, _iter_docs(bundle_path, index, report, doc_ids), id_field="doc_id")
+
+    ttp_docs = list(_iter_docs(bundle_path, ATTACK_PATTERN_INDEX, report, doc_ids))
+    link_docs = ttp_link_docs(ttp_docs, extracted, report) if llm is not None else []
+    if llm is not None and (ttp_docs or link_docs):
+        # attack-pattern 與 link 文件的文字相同的部分由 get_embeddings 去重，只算一次
+        vectors = llm.get_embeddings([d["embedding_text"] for d in ttp_docs] + [d["text"] for d in link_docs])
+        for doc, vec in zip(ttp_docs + link_docs, vectors):
+            doc["ttp_vector"] = vec
+    stats[ATTACK_PATTERN_INDEX] = bulk_index(client, ATTACK_PATTERN_INDEX, ttp_docs, id_field="doc_id")
+    if link_docs:
+        stats[TTP_VECTOR_INDEX] = bulk_index(client, TTP_VECTOR_INDEX, link_docs, id_field="doc_id")
+    if not any(s["failed"] for s in stats.values()):
+        _delete_superseded(client, report, os.path.basename(bundle_path))
+    return stats
+
+
+def lookup_ioc(client: OpenSearch, value: str, size: int = 20) -> List[Dict[str, Any]]:
+    """
+    以 keyword 精確比對 IOC 值，回傳命中的 indicator 文件
+    """
+    resp = client.search(
+        index=INDICATOR_INDEX,
+        body={"size": size, "query": {"term": {"ioc_values": value}}},
+    )
+    return [h["_source"] for h in resp["hits"]["hits"]]
+
+
+def main() -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Index STIX bundles into OpenSearch")
+    parser.add_argument("bundles", nargs="*", help="bundle 檔案 (預設為 out/ 下每份報告最新的 *_bundle.json)")
+    parser.add_argument("--setup", action="store_true", help="只建立 index")
+    parser.add_argument("--lookup", help="查詢某個 IOC 值")
+    parser.add_argument("--no-embeddings", action="store_true", help="attack-pattern 不計算向量")
+    args = parser.parse_args()
+
+    client = get_opensearch_client()
+    created = create_stix_indices(client)
+    if created:
+        print(f"  已建立 index: {', '.join(created)}")
+    if args.setup:
+        return
+
+    if args.lookup:
+        print(json.dumps(lookup_ioc(client, args.lookup), ensure_ascii=False, indent=2))
+        return
+
+    llm = None
+    if not args.no_embeddings:
+        from .llm_client import LLMClient
+        llm = LLMClient()
+
+    # 同一份報告重新處理過會有多個 bundle，舊的已被取代，只匯入最新的
+    paths = args.bundles or latest_bundles(glob.glob(os.path.join(DEFAULT_BUNDLE_DIR, BUNDLE_GLOB)))
+    print(f"  匯入 {len(paths)} 個 STIX bundle...")
+    for path in paths:
+        print(f"  {path}")
+        # run_pipeline 在 bundle 旁邊留有抽取結果，log_suggestions 從這裡取
+        extracted = None
+        extracted_path = path[:-len("_bundle.json")] + "_extracted.json" if path.endswith("_bundle.json") else None
+        if extracted_path and os.path.exists(extracted_path):
+            with open(extracted_path, encoding="utf-8") as f:
+                extracted = json.load(f)
+        for index_stats in index_stix_bundle(client, path, llm, extracted=extracted).values():
+            print_bulk_stats(index_stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+"""
+STIX 2.1 pattern compiler
+
+把 indicator 的 pattern 解析一次，轉成有型別、可建索引的 predicate：
+
+    [ipv4-addr:value = '198.51.100.1' OR ipv4-addr:value ISSUBSET '10.0.0.0/8']
+    [file:hashes.'SHA-256' = 'aec0...']
+
+- compile_pattern(pattern) -> CompiledPattern (AND / OR 樹 + predicates)
+- CompiledPattern.evaluate(observed) 以結構化 Log 欄位評估整個 pattern
+- CompiledPattern.indexable() 取出可以放進 hash set / CIDR 表的 predicate
+- CompiledPattern.standalone() 只取單獨成立就代表命中的 predicate (上層只有 OR)；
+  AND 內的 predicate 只能當候選，命中後要再以 evaluate 確認整個 pattern
+"""
+from __future__ import annotations
+
+import ipaddress
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+# ---- Tokenizer ----
+
+_TOKEN_RE = re.compile(
+    r"""
+    (?P<ws>\s+)
+  | (?P<string>[hbt]?'(?:\\.|[^'\\])*')
+  | (?P<number>[-+]?\d+(?:\.\d+)?)
+  | (?P<op><=|>=|!=|=|<|>)
+  | (?P<punct>[\[\]():.,*])
+  | (?P<ident>[A-Za-z_][A-Za-z0-9_-]*)
+    """,
+    re.VERBOSE,
+)
+
+_KEYWORD_OPS = {"IN", "LIKE", "MATCHES", "ISSUBSET", "ISSUPERSET"}
+_QUALIFIERS = {"WITHIN", "REPEATS", "START"}
+
+_HASH_ALGOS = {
+    "MD5": "md5",
+    "SHA-1": "sha1",
+    "SHA1": "sha1",
+    "SHA-256": "sha256",
+    "SHA256": "sha256",
+    "SHA-512": "sha512",
+    "SHA512": "sha512",
+}
+
+
+class PatternError(ValueError):
+    pass
+
+
+def _tokenize(pattern: str) -> List[Tuple[str, str]]:
+    tokens: List[Tuple[str, str]] = []
+    pos = 0
+    while pos < len(pattern):
+        m = _TOKEN_RE.match(pattern, pos)
+        if not m:
+            raise PatternError(f"Unexpected character at {pos}: {pattern[pos:pos + 20]!r}")
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == "ws":
+            continue
+        tokens.append((kind, m.group()))
+    return tokens
+
+
+def _unquote(raw: str) -> str:
+    if raw[0] in "hbt":
+        raw = raw[1:]
+    return re.sub(r"\\(.)", r"\1", raw[1:-1])
+
+
+# ---- Predicates ----
+
+@dataclass
+class Predicate:
+    object_type: str
+    path: Tuple[str, ...]
+    op: str
+    values: List[Any]
+    negated: bool = False
+    kind: str = "other"          # ipv4 / ipv6 / domain / url / hash / other
+    hash_algo: Optional[str] = None
+    _networks: List[Any] = field(default_factory=list, repr=False)
+
+    @property
+    def key(self) -> str:
+        """
+        正規化後的欄位名稱，例如 ipv4-addr:value、file:hashes.SHA-256
+        """
+        return f"{self.object_type}:{'.'.join(self.path)}"
+
+    @property
+    def indexable(self) -> bool:
+        return not self.negated and self.op in ("=", "IN", "ISSUBSET") and self.kind != "other"
+
+    def _compile(self) -> None:
+        if self.object_type in ("ipv4-addr", "ipv6-addr") and self.path == ("value",):
+            self.kind = "ipv4" if self.object_type == "ipv4-addr" else "ipv6"
+            for v in self.values:
+                try:
+                    self._networks.append(ipaddress.ip_network(str(v), strict=False))
+                except ValueError:
+                    pass
+        elif self.object_type == "domain-name" and self.path == ("value",):
+            self.kind = "domain"
+            self.values = [str(v).lower().rstrip(".") for v in self.values]
+        elif self.object_type == "url" and self.path == ("value",):
+            self.kind = "url"
+        elif self.object_type == "file" and len(self.path) == 2 and self.path[0] == "hashes":
+            algo = _HASH_ALGOS.get(self.path[1].upper())
+            if algo:
+                self.kind = "hash"
+                self.hash_algo = algo
+                self.values = [str(v).lower() for v in self.values]
+
+    def _match_value(self, observed: Any) -> bool:
+        if self.kind in ("ipv4", "ipv6") and self.op in ("=", "IN", "ISSUBSET"):
+            try:
+                ip = ipaddress.ip_network(str(observed), strict=False)
+            except ValueError:
+                return False
+            return any(ip.version == n.version and ip.subnet_of(n) for n in self._networks)
+
+        if self.kind in ("domain", "hash"):
+            observed = str(observed).lower().rstrip(".")
+
+        if self.op in ("=", "IN"):
+            return observed in self.values
+        if self.op == "!=":
+            return observed not in self.values
+        if self.op == "LIKE":
+            regex = "^" + re.escape(str(self.values[0])).replace("%", ".*").replace("_", ".") + "$"
+            return re.match(regex, str(observed), re.DOTALL) is not None
+        if self.op == "MATCHES":
+            return re.search(str(self.values[0]), str(observed)) is not None
+        if self.op in ("<", ">", "<=", ">="):
+            try:
+                a, b = float(observed), float(self.values[0])
+            except (TypeError, ValueError):
+                a, b = str(observed), str(self.values[0])
+            return {"<": a < b, ">": a > b, "<=": a <= b, ">=": a >= b}[self.op]
+        return False
+
+    def matches(self, observed: Any) -> bool:
+        result = self._match_value(observed)
+        return not result if self.negated else result
+
+
+Node = Union[Tuple[str, List[Any]], Predicate]
+
+
+@dataclass
+class CompiledPattern:
+    pattern: str
+    tree: Node
+    predicates: List[Predicate]
+
+    def indexable(self) -> List[Predicate]:
+        return [p for p in self.predicates if p.indexable]
+
+    def standalone(self) -> List[Predicate]:
+        """
+        可索引、且單獨成立就滿足整個 pattern 的 predicate (從 root 到它之間只有 OR)
+        """
+        out: List[Predicate] = []
+
+        def _walk(node: Node) -> None:
+            if isinstance(node, Predicate):
+                if node.indexable:
+                    out.append(node)
+                return
+            op, children = node
+            if op == "or":
+                for c in children:
+                    _walk(c)
+
+        _walk(self.tree)
+        return out
+
+    def evaluate(self, observed: Dict[str, Iterable[Any]]) -> bool:
+        """
+        observed: {"ipv4-addr:value": ["1.2.3.4"], "file:hashes.SHA-256": [...]}
+        同一個 observation 內 AND / OR 依 pattern 語意計算；跨 observation 的 FOLLOWEDBY 視為 AND
+        """
+        return self._eval(self.tree, observed)
+
+    def _eval(self, node: Node, observed: Dict[str, Iterable[Any]]) -> bool:
+        if isinstance(node, Predicate):
+            return any(node.matches(v) for v in observed.get(node.key, ()))
+        op, children = node
+        if op == "and":
+            return all(self._eval(c, observed) for c in children)
+        return any(self._eval(c, observed) for c in children)
+
+
+# ---- Parser ----
+
+class _Parser:
+    def __init__(self, pattern: str) -> None:
+        self.tokens = _tokenize(pattern)
+        self.pos = 0
+        self.predicates: List[Predicate] = []
+
+    def _peek(self, offset: int = 0) -> Optional[Tuple[str, str]]:
+        i = self.pos + offset
+        return self.tokens[i] if i < len(self.tokens) else None
+
+    def _next(self) -> Tuple[str, str]:
+        tok = self._peek()
+        if tok is None:
+            raise PatternError("Unexpected end of pattern")
+        self.pos += 1
+        return tok
+
+    def _expect(self, value: str) -> None:
+        tok = self._next()
+        if tok[1] != value:
+            raise PatternError(f"Expected {value!r}, got {tok[1]!r}")
+
+    def _is_keyword(self, *words: str) -> bool:
+        tok = self._peek()
+        return tok is not None and tok[0] == "ident" and tok[1].upper() in words
+
+    def parse(self) -> Node:
+        node = self._observation_expr()
+        if self._peek() is not None:
+            raise PatternError(f"Unexpected token {self._peek()[1]!r}")
+        return node
+
+    # observation: FOLLOWEDBY < OR < AND
+    def _observation_expr(self) -> Node:
+        parts = [self._observation_or()]
+        while self._is_keyword("FOLLOWEDBY"):
+            self._next()
+            parts.append(self._observation_or())
+        return parts[0] if len(parts) == 1 else ("and", parts)
+
+    def _observation_or(self) -> Node:
+        parts = [self._observation_and()]
+        while self._is_keyword("OR"):
+            self._next()
+            parts.append(self._observation_and())
+        return parts[0] if len(parts) == 1 else ("or", parts)
+
+    def _observation_and(self) -> Node:
+        parts = [self._observation_primary()]
+        while self._is_keyword("AND"):
+            self._next()
+            parts.append(self._observation_primary())
+        return parts[0] if len(parts) == 1 else ("and", parts)
+
+    def _observation_primary(self) -> Node:
+        tok = self._next()
+        if tok[1] == "[":
+            node = self._comparison_or()
+            self._expect("]")
+        elif tok[1] == "(":
+            node = self._observation_expr()
+            self._expect(")")
+        else:
+            raise PatternError(f"Expected '[' or '(', got {tok[1]!r}")
+        self._skip_qualifiers()
+        return node
+
+    def _skip_qualifiers(self) -> None:
+        # WITHIN n SECONDS / REPEATS n TIMES / START t'..' STOP t'..' 不影響 IOC 比對
+        while self._is_keyword(*_QUALIFIERS):
+            word = self._next()[1].upper()
+            if word == "START":
+                self._next()
+                self._expect_keyword("STOP")
+                self._next()
+            else:
+                self._next()
+                self._next()
+
+    def _expect_keyword(self, word: str) -> None:
+        tok = self._next()
+        if tok[1].upper() != word:
+            raise PatternError(f"Expected {word}, got {tok[1]!r}")
+
+    def _comparison_or(self) -> Node:
+        parts = [self._comparison_and()]
+        while self._is_keyword("OR"):
+            self._next()
+            parts.append(self._comparison_and())
+        return parts[0] if len(parts) == 1 else ("or", parts)
+
+    def _comparison_and(self) -> Node:
+        parts = [self._comparison_primary()]
+        while self._is_keyword("AND"):
+            self._next()
+            parts.append(self._comparison_primary())
+        return parts[0] if len(parts) == 1 else ("and", parts)
+
+    def _comparison_primary(self) -> Node:
+        tok = self._peek()
+        if tok is not None and tok[1] == "(":
+            self._next()
+            node = self._comparison_or()
+            self._expect(")")
+            return node
+        return self._comparison()
+
+    def _object_path(self) -> Tuple[str, Tuple[str, ...]]:
+        kind, object_type = self._next()
+        if kind != "ident":
+            raise PatternError(f"Expected object type, got {object_type!r}")
+        self._expect(":")
+
+        path: List[str] = []
+        while True:
+            kind, value = self._next()
+            if kind == "ident":
+                path.append(value)
+            elif kind == "string":
+                path.append(_unquote(value))
+            else:
+                raise PatternError(f"Bad object path component {value!r}")
+
+            # list index: [*] 或 [n]
+            while self._peek() is not None and self._peek()[1] == "[":
+                self._next()
+                self._next()
+                self._expect("]")
+
+            if self._peek() is not None and self._peek()[1] == ".":
+                self._next()
+                continue
+            break
+        return object_type, tuple(path)
+
+    def _value(self) -> Any:
+        kind, raw = self._next()
+        if kind == "string":
+            return _unquote(raw)
+        if kind == "number":
+            return float(raw) if "." in raw else int(raw)
+        if kind == "ident" and raw.lower() in ("true", "false"):
+            return raw.lower() == "true"
+        raise PatternError(f"Bad literal {raw!r}")
+
+    def _comparison(self) -> Predicate:
+        object_type, path = self._object_path()
+
+        negated = False
+        if self._is_keyword("NOT"):
+            self._next()
+            negated = True
+
+        kind, op = self._next()
+        if kind == "ident":
+            op = op.upper()
+            if op not in _KEYWORD_OPS:
+                raise PatternError(f"Unknown operator {op!r}")
+        elif kind != "op":
+            raise PatternError(f"Expected operator, got {op!r}")
+
+        if op == "IN":
+            self._expect("(")
+            values = [self._value()]
+            while self._peek() is not None and self._peek()[1] == ",":
+                self._next()
+                values.append(self._value())
+            self._expect(")")
+        else:
+            values = [self._value()]
+
+        pred = Predicate(object_type=object_type, path=path, op=op, values=values, negated=negated)
+        pred._compile()
+        self.predicates.append(pred)
+        return pred
+
+
+def compile_pattern(pattern: str) -> CompiledPattern:
+    """
+    解析 STIX 2.1 pattern；語法錯誤時丟出 PatternError
+    """
+    parser = _Parser(pattern)
+    tree = parser.parse()
+    return CompiledPattern(pattern=pattern, tree=tree, predicates=parser.predicates)
+
+
+def predicate_iocs(pred: Predicate) -> List[Dict[str, Any]]:
+    """
+    把可索引的 predicate 展開成 IOC 條目 (value / type / hash_algo)
+    """
+    out = []
+    for v in pred.values:
+        entry = {"value": str(v), "type": pred.kind}
+        if pred.hash_algo:
+            entry["hash_algo"] = pred.hash_algo
+        out.append(entry)
+    return out
+
+
+def compile_indicators(objects: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    從 STIX objects 中的 indicator 取出所有可索引的 IOC (每個值一筆，帶 indicator id / name)
+    無法解析的 pattern 會被略過
+
+    AND 條件內的值單獨出現不代表命中，這類 IOC 帶 conjunction=True 與 pattern，
+    比對端 (IOCMatcher) 只把它當候選，命中後再 evaluate 整個 pattern
+    """
+    iocs: List[Dict[str, Any]] = []
+    for obj in objects:
+        if obj.get("type") != "indicator" or obj.get("pattern_type", "stix") != "stix":
+            continue
+        try:
+            compiled = compile_pattern(obj.get("pattern", ""))
+        except PatternError:
+            continue
+        standalone = {id(p) for p in compiled.standalone()}
+        for pred in compiled.indexable():
+            for entry in predicate_iocs(pred):
+                entry.update({"name": obj.get("name"), "id": obj.get("id")})
+                if id(pred) not in standalone:
+                    entry.update({"conjunction": True, "pattern": compiled.pattern})
+                iocs.append(entry)
+    return iocs
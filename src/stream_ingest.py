@@ -0,0 +1,334 @@
+"""
+串流 Log 匯入: tail 檔案 (支援 rotation、offset 持久化) 或讀 stdin (純文字 / JSON lines)
+
+    python -m src.stream_ingest --file /var/log/auth.log --follow
+    cat logs.jsonl | python -m src.stream_ingest --stdin --format json
+
+Pipeline: reader threads -> bounded queue -> normalize (template) -> embed (batch) -> bulk index
+Queue 滿時 reader 會 block (backpressure)，記憶體用量與輸入大小無關。
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .bulk_index import bulk_index
+from .ingest_logs import build_log_docs, client, index_name
+from .log_template import TemplateMiner, template_state_path, templates_enabled
+
+DEFAULT_OFFSETS_PATH = ".cache/ingest_offsets.json"
+
+_EOF = object()
+
+logger = logging.getLogger(__name__)
+
+
+class OffsetStore:
+    """
+    每個檔案記錄 (inode, offset)，只在該批資料成功寫入 OpenSearch 後才更新
+    """
+
+    def __init__(self, path: str = DEFAULT_OFFSETS_PATH) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._offsets: Dict[str, Dict[str, int]] = {}
+        if os.path.exists(path):
+            self._offsets = json.loads(Path(path).read_text(encoding="utf-8"))
+
+    def get(self, file_path: str) -> Optional[Dict[str, int]]:
+        with self._lock:
+            return self._offsets.get(os.path.abspath(file_path))
+
+    def commit(self, positions: Dict[str, Tuple[int, int]]) -> None:
+        if not positions:
+            return
+        with self._lock:
+            for file_path, (inode, offset) in positions.items():
+                self._offsets[file_path] = {"inode": inode, "offset": offset}
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            Path(tmp).write_text(json.dumps(self._offsets, indent=2), encoding="utf-8")
+            os.replace(tmp, self.path)
+
+
+def tail_file(path: str, offsets: OffsetStore, stop: threading.Event,
+              follow: bool = True, poll_interval: float = 0.5) -> Iterator[Tuple[str, str, int, int]]:
+    """
+    逐行讀檔，yield (line, abs_path, inode, offset_after_line)
+
+    - 從上次 commit 的 offset 繼續 (inode 不同或檔案變小就從頭開始)
+    - rotation: inode 改變時先讀完舊檔，再開新檔從頭讀
+    - truncate: 檔案變小時回到開頭
+    - rotation / truncate 前舊檔最後一行沒有換行時，仍當成一行送出
+    """
+    abs_path = os.path.abspath(path)
+    while not os.path.exists(abs_path):
+        if not follow or stop.is_set():
+            return
+        time.sleep(poll_interval)
+
+    f = open(abs_path, "rb")
+    inode = os.fstat(f.fileno()).st_ino
+    saved = offsets.get(abs_path)
+    if saved and saved.get("inode") == inode and saved.get("offset", 0) <= os.fstat(f.fileno()).st_size:
+        f.seek(saved["offset"])
+
+    partial = b""
+    try:
+        while not stop.is_set():
+            chunk = f.readline()
+            if chunk:
+                partial += chunk
+                if partial.endswith(b"\n"):
+                    yield partial.decode("utf-8", errors="ignore").rstrip("\r\n"), abs_path, inode, f.tell()
+                    partial = b""
+                continue
+
+            # 到 EOF
+            if not follow:
+                if partial:
+                    yield partial.decode("utf-8", errors="ignore"), abs_path, inode, f.tell()
+                return
+
+            try:
+                st = os.stat(abs_path)
+            except FileNotFoundError:
+                time.sleep(poll_interval)
+                continue
+
+            if (st.st_ino != inode or st.st_size < f.tell()) and partial:
+                # 舊檔 / 被截斷前的最後一行沒有換行，不會再被寫完，先送出
+                yield partial.decode("utf-8", errors="ignore"), abs_path, inode, f.tell()
+                partial = b""
+
+            if st.st_ino != inode:
+                # 舊檔已讀完 (readline 回傳空)，切到新檔
+                f.close()
+                f = open(abs_path, "rb")
+                inode = os.fstat(f.fileno()).st_ino
+            elif st.st_size < f.tell():
+                f.seek(0)
+            else:
+                time.sleep(poll_interval)
+    finally:
+        f.close()
+
+
+def _parse_line(line: str, fmt: str) -> Optional[Dict[str, Any]]:
+    line = line.strip()
+    if not line:
+        return None
+    if fmt == "json":
+        try:
+            obj = json.loads(line)
+        except json.JSONDecodeError:
+            return {"log_text": line}
+        if isinstance(obj, dict):
+            text = obj.get("log_text") or obj.get("message") or obj.get("msg")
+            if text:
+                record = {"log_text": str(text)}
+                for key in ("timestamp", "log_source"):
+                    if obj.get(key):
+                        record[key] = obj[key]
+                return record
+        return {"log_text": line}
+    return {"log_text": line}
+
+
+def _file_reader(path: str, fmt: str, q: queue.Queue, offsets: OffsetStore,
+                 stop: threading.Event, follow: bool, source: Optional[str] = None) -> None:
+    try:
+        for line, abs_path, inode, offset in tail_file(path, offsets, stop, follow=follow):
+            record = _parse_line(line, fmt)
+            if record is None:
+                continue
+            if source:
+                record.setdefault("log_source", source)
+            record["_pos"] = (abs_path, inode, offset)
+            q.put(record)  # queue 滿時在這裡 block
+    except Exception as e:
+        logger.error(f"  讀取 {path} 失敗: {e}")
+    finally:
+        q.put(_EOF)
+
+
+def _stdin_reader(fmt: str, q: queue.Queue, stop: threading.Event, source: Optional[str] = None) -> None:
+    try:
+        for line in sys.stdin:
+            if stop.is_set():
+                break
+            record = _parse_line(line, fmt)
+            if record is not None:
+                if source:
+                    record.setdefault("log_source", source)
+                q.put(record)
+    finally:
+        q.put(_EOF)
+
+
+def _next_batch(q: queue.Queue, batch_size: int, flush_interval: float) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    收集一批資料；滿 batch_size 或超過 flush_interval 就送出。回傳 (batch, 收到的 EOF 數)
+    """
+    batch: List[Dict[str, Any]] = []
+    eofs = 0
+    deadline = time.monotonic() + flush_interval
+    while len(batch) < batch_size:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            item = q.get(timeout=timeout)
+        except queue.Empty:
+            break
+        if item is _EOF:
+            eofs += 1
+            break
+        batch.append(item)
+    return batch, eofs
+
+
+def _doc_id(pos: Tuple[str, int, int]) -> str:
+    # 同一個檔案位置永遠得到同一個 _id，重試時覆寫而不是重複寫入
+    path, inode, offset = pos
+    return hashlib.sha1(f"{path}\0{inode}\0{offset}".encode("utf-8")).hexdigest()
+
+
+def _index_batch(batch: List[Dict[str, Any]], miner: Optional[TemplateMiner]) -> Tuple[Dict[str, Any], Optional[str]]:
+    """
+    向量化並匯入一批資料，回傳 (bulk 統計, 錯誤訊息)；有任何一筆失敗都算這批失敗
+    """
+    texts = [r["log_text"] for r in batch]
+    extra = [{k: v for k, v in r.items() if k in ("timestamp", "log_source")} for r in batch]
+    try:
+        docs = build_log_docs(texts, miner, extra)
+    except Exception as e:
+        return {"indexed": 0, "failed": len(batch), "chunk_failures": []}, f"Embedding 失敗: {e}"
+
+    actions = [
+        {"_id": _doc_id(r["_pos"]), "_source": doc} if "_pos" in r else doc
+        for r, doc in zip(batch, docs)
+    ]
+    # 每批都強制 refresh 在高流量下會每秒 refresh 好幾次，交給 index 的 refresh_interval
+    stats = bulk_index(client, index_name, actions, refresh=False)
+    if stats["failed"]:
+        return stats, f"Bulk 匯入失敗 {stats['failed']} 筆"
+    return stats, None
+
+
+def run_stream(files: List[str], use_stdin: bool, fmt: str = "text", follow: bool = False,
+               batch_size: int = 256, queue_size: int = 10000, flush_interval: float = 2.0,
+               offsets_path: str = DEFAULT_OFFSETS_PATH, source: Optional[str] = None,
+               max_retries: int = 3, retry_backoff: float = 2.0) -> Dict[str, int]:
+    """
+    一批資料失敗 (embedding 或 bulk) 時以 backoff 重試 max_retries 次；仍失敗就停止串流，
+    offset 停在最後一個成功的批次，下次啟動從那裡重讀 (檔案來源的文件 _id 由位置決定，重讀不會重複)
+    """
+    q: queue.Queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    offsets = OffsetStore(offsets_path)
+    miner = TemplateMiner.load(template_state_path()) if templates_enabled() else None
+
+    readers = [
+        threading.Thread(target=_file_reader, args=(p, fmt, q, offsets, stop, follow, source), daemon=True)
+        for p in files
+    ]
+    if use_stdin:
+        readers.append(threading.Thread(target=_stdin_reader, args=(fmt, q, stop, source), daemon=True))
+    for t in readers:
+        t.start()
+
+    totals = {"lines": 0, "indexed": 0, "failed": 0}
+    active = len(readers)
+    start = time.perf_counter()
+
+    try:
+        while active > 0 or not q.empty():
+            batch, eofs = _next_batch(q, batch_size, flush_interval)
+            active -= eofs
+            if not batch:
+                continue
+
+            for attempt in range(max_retries + 1):
+                stats, error = _index_batch(batch, miner)
+                if error is None:
+                    break
+                for failure in stats["chunk_failures"]:
+                    logger.warning(f"    chunk #{failure['chunk']} 失敗: {failure['errors'][:3]}")
+                logger.warning(f"  {error} ({len(batch)} 筆, 第 {attempt + 1} 次)")
+                if attempt < max_retries:
+                    time.sleep(retry_backoff * (2 ** attempt))
+
+            if error is not None:
+                # 不 commit offset 並停止：之後的批次若成功會把 offset 推過這批，這批就永遠漏掉了
+                totals["failed"] += len(batch)
+                logger.error("  重試後仍失敗，停止串流匯入；offset 保留在最後一個成功的批次")
+                break
+
+            totals["lines"] += len(batch)
+            totals["indexed"] += stats["indexed"]
+
+            positions: Dict[str, Tuple[int, int]] = {}
+            for r in batch:
+                if "_pos" in r:
+                    path, inode, offset = r["_pos"]
+                    positions[path] = (inode, offset)
+            offsets.commit(positions)
+            if miner is not None:
+                miner.save(template_state_path())
+
+            elapsed = time.perf_counter() - start
+            logger.info(f"  已匯入 {totals['indexed']} 筆 ({totals['indexed'] / max(elapsed, 1e-6):.1f} lines/sec)")
+    except KeyboardInterrupt:
+        logger.info("  串流匯入已手動停止")
+    finally:
+        stop.set()
+
+    return totals
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Streaming log ingestion into OpenSearch k-NN index")
+    parser.add_argument("--file", action="append", default=[], help="要 tail 的 log 檔 (可重複指定)")
+    parser.add_argument("--stdin", action="store_true", help="從 stdin 讀取")
+    parser.add_argument("--format", choices=["text", "json"], default="text", help="輸入格式")
+    parser.add_argument("--follow", action="store_true", help="持續追蹤檔案新增內容 (tail -F)")
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("STREAM_BATCH_SIZE", "256")))
+    parser.add_argument("--queue-size", type=int, default=int(os.getenv("STREAM_QUEUE_SIZE", "10000")))
+    parser.add_argument("--flush-interval", type=float, default=2.0, help="未滿 batch 時最多等待秒數")
+    parser.add_argument("--offsets", default=os.getenv("STREAM_OFFSETS_PATH", DEFAULT_OFFSETS_PATH))
+    parser.add_argument("--source", help="指定 log_source (不指定則依內容自動判斷)")
+    parser.add_argument("--max-retries", type=int, default=int(os.getenv("STREAM_MAX_RETRIES", "3")),
+                        help="一批失敗時的重試次數，仍失敗就停止並保留最後成功的 offset")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if not args.file and not args.stdin:
+        parser.error("請指定 --file 或 --stdin")
+
+    totals = run_stream(
+        files=args.file,
+        use_stdin=args.stdin,
+        fmt=args.format,
+        follow=args.follow,
+        batch_size=args.batch_size,
+        queue_size=args.queue_size,
+        flush_interval=args.flush_interval,
+        offsets_path=args.offsets,
+        source=args.source,
+        max_retries=args.max_retries,
+    )
+    print(f"  串流匯入結束: {totals}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+DEFAULT_THRESHOLD_PATH = ".cache/thresholds.json"
+
+
+class TDigest:
+    """
+    精簡版 merging t-digest，用來對 anomaly score 做串流分位數估計
+
+    centroid 數量上限約為 compression，任意數量的分數合併後仍可估計 P95/P99。
+    """
+
+    def __init__(self, compression: float = 100.0) -> None:
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+
+    @property
+    def count(self) -> float:
+        return float(self.weights.sum())
+
+    def update(self, values: Iterable[float], weight: float = 1.0) -> None:
+        """
+        weight: 每個值代表幾筆資料 (例如抽樣 n 筆代表 N 筆時為 N / n)
+        """
+        values = np.asarray([v for v in values if v is not None and np.isfinite(v)], dtype=np.float64)
+        if values.size == 0:
+            return
+        means = np.concatenate([self.means, values])
+        weights = np.concatenate([self.weights, np.full(values.size, float(weight))])
+        self._compress(means, weights)
+
+    def scale(self, factor: float) -> None:
+        # 所有 centroid 的權重乘上 factor，分位數不變，只改變之後新資料的相對比重
+        self.weights = self.weights * float(factor)
+
+    def _compress(self, means: np.ndarray, weights: np.ndarray) -> None:
+        order = np.argsort(means, kind="mergesort")
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+
+        new_means: List[float] = []
+        new_weights: List[float] = []
+        cur_mean, cur_weight = means[0], weights[0]
+        seen = 0.0
+
+        for m, w in zip(means[1:], weights[1:]):
+            q = (seen + cur_weight + w / 2) / total
+            # 分布兩端 centroid 較小，中間可合併較多點
+            limit = 4 * total * q * (1 - q) / self.compression
+            if cur_weight + w <= max(1.0, limit):
+                cur_mean = (cur_mean * cur_weight + m * w) / (cur_weight + w)
+                cur_weight += w
+            else:
+                new_means.append(cur_mean)
+                new_weights.append(cur_weight)
+                seen += cur_weight
+                cur_mean, cur_weight = m, w
+
+        new_means.append(cur_mean)
+        new_weights.append(cur_weight)
+        self.means = np.asarray(new_means)
+        self.weights = np.asarray(new_weights)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.means.size == 0:
+            return None
+        if self.means.size == 1:
+            return float(self.means[0])
+        # 以 centroid 中心點的累積權重做線性內插
+        centers = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(q * self.count, centers, self.means))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "compression": self.compression,
+            "means": self.means.tolist(),
+            "weights": self.weights.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "TDigest":
+        digest = cls(compression=data.get("compression", 100.0))
+        digest.means = np.asarray(data.get("means", []), dtype=np.float64)
+        digest.weights = np.asarray(data.get("weights", []), dtype=np.float64)
+        return digest
+
+
+def threshold_key(index: str, filters: Optional[Dict[str, Any]], k: int, score_method: str,
+                  quantile: float, model: str) -> str:
+    raw = json.dumps(
+        {
+            "index": index,
+            "filters": filters or {},
+            "k": k,
+            "score_method": score_method,
+            "quantile": quantile,
+            "model": model,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class ThresholdStore:
+    """
+    以 (index, filters, k, score_method, quantile, embedding model) 為 key 持久化 threshold
+    與分數分布 (t-digest)，detect 啟動時直接讀檔即可
+    """
+
+    def __init__(self, path: str = DEFAULT_THRESHOLD_PATH) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self) -> Dict[str, Any]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            return json.loads(Path(self.path).read_text(encoding="utf-8"))
+        except json.JSONDecodeError:
+            return {}
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._read().get(key)
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            data = self._read()
+            entry = dict(entry)
+            entry["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+            data[key] = entry
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            Path(tmp).write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(tmp, self.path)
@@ -1,157 +1,210 @@
+import json
+import os
+import uuid
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import stix2
+
+try:
+    import orjson
+except ImportError:  # orjson 為選用，沒有時退回標準 json
+    orjson = None
 
 # STIX 2.1 的類別
-from stix2.v21 import (
-    Bundle,
-    Identity,
-    Indicator,
-    Malware,
-    Tool,
-    AttackPattern,
-    Relationship,
-    MarkingDefinition,
-    ExternalReference,
-    TLP_AMBER,
-)
-
-def _now() -> str:
-    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-
-def _make_tlp_marking(tlp: str = "TLP:AMBER") -> MarkingDefinition:
-    return TLP_AMBER
-
-def _mitre_external_ref(technique_id: str) -> ExternalReference:
+from stix2.v21 import TLP_AMBER
+
+_LABELS = ["cti", "llm-generated"]
+_TTP_LABELS = ["ttp", "cti", "llm-generated"]
+_HASH_KEYS = {"md5": "MD5", "sha1": "SHA-1", "sha256": "SHA-256"}
+
+# TLP marking 是固定的物件，只需要轉一次 dict
+_TLP_AMBER_DICT = json.loads(TLP_AMBER.serialize())
+
+def _now_ms() -> str:
+    # 與 stix2 產生的 created / modified 相同的毫秒精度
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + "Z"
+
+def _stix_id(stix_type: str) -> str:
+    return f"{stix_type}--{uuid.uuid4()}"
+
+def _mitre_external_ref(technique_id: str) -> Dict[str, str]:
     # MITRE ATT&CK technique standards
-    return ExternalReference(
-        source_name="mitre-attack",
-        external_id=technique_id,
-        url=f"https://attack.mitre.org/techniques/{technique_id}/",
-    )
-
-def _stix_indicators(ind: Dict[str, Any], created_by_ref: str, marking_id: str, confidence: Optional[int]) -> List[Indicator]:
-    indicators: List[Indicator] = []
-
-    def _add_indicator(name: str, pattern: str) -> None:
-        indicators.append(
-            Indicator(
-                name=name,
-                pattern_type="stix",
-                pattern=pattern,
-                valid_from=_now(),
-                created_by_ref=created_by_ref,
-                object_marking_refs=[marking_id],
-                confidence=confidence,
-                labels=["cti", "llm-generated"],
-            )
-        )
+    return {
+        "source_name": "mitre-attack",
+        "url": f"https://attack.mitre.org/techniques/{technique_id}/",
+        "external_id": technique_id,
+    }
+
+def _escape_pattern_value(value: str) -> str:
+    # STIX pattern 字串內的 \ 與 ' 需要跳脫
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+def _indicator_specs(ind: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """
+    indicators 區塊 -> [(name, pattern)]
+    """
+    specs: List[Tuple[str, str]] = []
 
     # IPs
     for ip in (ind.get("ipv4", []) or []) + (ind.get("ipv6", []) or []):
         if ":" in ip:
-            _add_indicator(f"IP indicator {ip}", f"[ipv6-addr:value = '{ip}']")
+            specs.append((f"IP indicator {ip}", f"[ipv6-addr:value = '{_escape_pattern_value(ip)}']"))
         else:
-            _add_indicator(f"IP indicator {ip}", f"[ipv4-addr:value = '{ip}']")
+            specs.append((f"IP indicator {ip}", f"[ipv4-addr:value = '{_escape_pattern_value(ip)}']"))
 
     # Domains
     for d in ind.get("domains", []) or []:
-        _add_indicator(f"Domain indicator {d}", f"[domain-name:value = '{d}']")
+        specs.append((f"Domain indicator {d}", f"[domain-name:value = '{_escape_pattern_value(d)}']"))
 
     # URLs
     for u in ind.get("urls", []) or []:
-        _add_indicator(f"URL indicator {u}", f"[url:value = '{u}']")
+        specs.append((f"URL indicator {u}", f"[url:value = '{_escape_pattern_value(u)}']"))
 
     # Hashes
     hashes = ind.get("hashes", {}) or {}
     for algo in ["md5", "sha1", "sha256"]:
         for h in hashes.get(algo, []) or []:
-            key = {"md5": "MD5", "sha1": "SHA-1", "sha256": "SHA-256"}[algo]
-            _add_indicator(f"File hash {key} {h[:12]}...", f"[file:hashes.'{key}' = '{h}']")
-
-    return indicators
-
-def build_stix_bundle(extracted: Dict[str, Any]) -> str:
+            key = _HASH_KEYS[algo]
+            specs.append((f"File hash {key} {h[:12]}...", f"[file:hashes.'{key}' = '{_escape_pattern_value(h)}']"))
+
+    return specs
+
+def _common(stix_type: str, ts: str, producer_id: str) -> Dict[str, Any]:
+    return {
+        "type": stix_type,
+        "spec_version": "2.1",
+        "id": _stix_id(stix_type),
+        "created_by_ref": producer_id,
+        "created": ts,
+        "modified": ts,
+    }
+
+def _finish(obj: Dict[str, Any], confidence: Optional[int], marking_id: str,
+            external_references: Optional[List[Dict[str, str]]] = None) -> Dict[str, Any]:
+    # 欄位順序與 stix2 serialize 的結果相同 (confidence 在 external_references 之前)；None 的欄位不輸出
+    if confidence is not None:
+        obj["confidence"] = confidence
+    if external_references:
+        obj["external_references"] = external_references
+    obj["object_marking_refs"] = [marking_id]
+    return obj
+
+def iter_stix_objects(extracted: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    依序產生 bundle 內的 STIX 2.1 物件 (dict，不經過 stix2 的逐物件驗證)，整個 bundle 共用一個時間戳
+    relationship 放在最後，過程中只保留 indicator 的 id，不必把所有物件留在記憶體
+    """
     conf = extracted.get("confidence")
     confidence = int(conf) if isinstance(conf, int) else None
-
-    producer = Identity(
-        name="LLM CTI-to-STIX PoC",
-        identity_class="organization",
-        created=_now(),
-        modified=_now(),
-    )
-    marking = _make_tlp_marking("TLP:AMBER")
-
-    objects: List[Any] = [producer, marking]
+    ts = _now_ms()
+
+    producer = {
+        "type": "identity",
+        "spec_version": "2.1",
+        "id": _stix_id("identity"),
+        "created": ts,
+        "modified": ts,
+        "name": "LLM CTI-to-STIX PoC",
+        "identity_class": "organization",
+    }
+    producer_id = producer["id"]
+    marking_id = _TLP_AMBER_DICT["id"]
+
+    yield producer
+    yield dict(_TLP_AMBER_DICT)
 
     # Indicators
-    indicators_block = extracted.get("indicators", {}) or {}
-    indicators = _stix_indicators(
-        indicators_block,
-        created_by_ref=producer.id,
-        marking_id=marking.id,
-        confidence=confidence,
-    )
-    objects.extend(indicators)
+    indicator_ids: List[str] = []
+    for name, pattern in _indicator_specs(extracted.get("indicators", {}) or {}):
+        obj = _common("indicator", ts, producer_id)
+        obj.update(name=name, pattern=pattern, pattern_type="stix", pattern_version="2.1",
+                   valid_from=ts, labels=list(_LABELS))
+        indicator_ids.append(obj["id"])
+        yield _finish(obj, confidence, marking_id)
 
     # Malware/Tools
     for name in extracted.get("malware_or_tool", []) or []:
-        lower = name.lower()
-        if "malware" in lower:
-            objects.append(
-                Malware(
-                    name=name,
-                    is_family=False,
-                    created_by_ref=producer.id,
-                    object_marking_refs=[marking.id],
-                    confidence=confidence,
-                    labels=["cti", "llm-generated"],
-                )
-            )
+        if "malware" in name.lower():
+            obj = _common("malware", ts, producer_id)
+            obj.update(name=name, is_family=False, labels=list(_LABELS))
         else:
-            objects.append(
-                Tool(
-                    name=name,
-                    created_by_ref=producer.id,
-                    object_marking_refs=[marking.id],
-                    confidence=confidence,
-                    labels=["cti", "llm-generated"],
-                )
-            )
+            obj = _common("tool", ts, producer_id)
+            obj.update(name=name, labels=list(_LABELS))
+        yield _finish(obj, confidence, marking_id)
 
     # Attack Patterns（TTPs）
-    ttp_objs: List[AttackPattern] = []
+    ttp_ids: List[str] = []
     for t in extracted.get("ttps", []) or []:
+        obj = _common("attack-pattern", ts, producer_id)
+        obj.update(name=t.get("name") or "Attack Pattern", description=t.get("description") or "",
+                   labels=list(_TTP_LABELS))
         tech_id = t.get("mitre_technique_id")
-        ext_refs = []
-        if isinstance(tech_id, str) and tech_id.strip():
-            ext_refs.append(_mitre_external_ref(tech_id.strip()))
-
-        ap = AttackPattern(
-            name=t.get("name") or "Attack Pattern",
-            description=t.get("description") or "",
-            created_by_ref=producer.id,
-            object_marking_refs=[marking.id],
-            confidence=confidence,
-            labels=["ttp", "cti", "llm-generated"],
-            external_references=ext_refs if ext_refs else None,
-        )
-        ttp_objs.append(ap)
-        objects.append(ap)
+        ext_refs = [_mitre_external_ref(tech_id.strip())] if isinstance(tech_id, str) and tech_id.strip() else None
+        ttp_ids.append(obj["id"])
+        yield _finish(obj, confidence, marking_id, ext_refs)
 
     # Relationships
-    for ind_obj in indicators:
-        for ap in ttp_objs[:3]:
-            objects.append(
-                Relationship(
-                    relationship_type="indicates",
-                    source_ref=ind_obj.id,
-                    target_ref=ap.id,
-                    created_by_ref=producer.id,
-                    object_marking_refs=[marking.id],
-                    confidence=confidence,
-                )
-            )
-
-    bundle = Bundle(objects=objects, allow_custom=False)
-    return bundle.serialize(pretty=True)
+    for ind_id in indicator_ids:
+        for ap_id in ttp_ids[:3]:
+            obj = _common("relationship", ts, producer_id)
+            obj.update(relationship_type="indicates", source_ref=ind_id, target_ref=ap_id)
+            yield _finish(obj, confidence, marking_id)
+
+def build_stix_objects(extracted: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return list(iter_stix_objects(extracted))
+
+def _dumps_compact(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def serialize_bundle(objects: List[Dict[str, Any]], pretty: bool = False) -> str:
+    bundle = {"type": "bundle", "id": _stix_id("bundle"), "objects": objects}
+    if pretty:
+        return json.dumps(bundle, ensure_ascii=False, indent=4)
+    return _dumps_compact(bundle)
+
+def _strict_default(strict: Optional[bool]) -> bool:
+    if strict is None:
+        return os.getenv("STIX_STRICT", "0") == "1"
+    return strict
+
+def build_stix_bundle(extracted: Dict[str, Any], strict: Optional[bool] = None, pretty: bool = False) -> str:
+    """
+    產生 STIX 2.1 bundle 字串 (預設 compact)
+
+    strict=True (或 STIX_STRICT=1) 時另外用 stix2 把整個 bundle 解析一次，
+    任何不符合規格的物件都會 raise，行為等同舊版逐物件建構
+    """
+    objects = build_stix_objects(extracted)
+    bundle_str = serialize_bundle(objects, pretty=pretty)
+    if _strict_default(strict):
+        stix2.parse(bundle_str, allow_custom=False)
+    return bundle_str
+
+def write_stix_bundle(extracted: Dict[str, Any], path: str, strict: Optional[bool] = None) -> int:
+    """
+    邊產生邊把 bundle 寫進檔案 (每個物件一行)，回傳物件數量
+    記憶體用量只跟單一物件大小有關；strict 時逐物件用 stix2 解析
+    先寫到暫存檔再 rename，讀檔的人不會看到寫到一半的 bundle
+    """
+    strict = _strict_default(strict)
+    tmp_path = f"{path}.tmp"
+    count = 0
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(f'{{"type":"bundle","id":"{_stix_id("bundle")}","objects":[')
+            for obj in iter_stix_objects(extracted):
+                if strict:
+                    stix2.parse(obj, allow_custom=False)
+                f.write(",\n" if count else "\n")
+                f.write(_dumps_compact(obj))
+                count += 1
+            f.write("\n]}\n")
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
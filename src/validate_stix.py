@@ -1,41 +1,234 @@
 #這邊是參考open source 修改的 https://github.com/oasis-open/cti-stix-validator
 from __future__ import annotations
-from collections import Counter
-from typing import Any, Dict, List, Tuple
+import json
+import multiprocessing
+import os
+import re
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple
 
-from stix2validator import ValidationOptions, validate_string
+import stix2validator
+from stix2validator import ValidationOptions, validate_parsed_json
 
+from .validation_cache import ObjectResult, ValidationCache, fill_issues, object_cache_key, template_issues
 
-def _issue_to_dict(issue: Any) -> Dict[str, Any]:
+try:
+    import ijson
+except ImportError:  # ijson 為選用，沒有時用內建的增量解析
+    ijson = None
+
+
+def _issue_to_dict(issue: Any, severity: str, object_id: Optional[str]) -> Dict[str, Any]:
     return {
-        "severity": getattr(issue, "severity", None),
+        "severity": severity,
         "code": getattr(issue, "code", None),
-        "message": getattr(issue, "message", None),
+        "message": getattr(issue, "message", None) or str(issue),
         "path": getattr(issue, "path", None),
-        "id": getattr(issue, "id", None),    
+        "id": object_id,
     }
 
-def validate_stix_json(stix_json_string: str) -> Tuple[bool, Dict[str, Any]]:
+def _result_issues(result: Any) -> List[Dict[str, Any]]:
     """
-    payload 包含 errors + warnings
+    ObjectValidationResults -> issue dict (errors / warnings 兩個 list)
+    """
+    object_id = getattr(result, "object_id", None)
+    issues = [_issue_to_dict(e, "error", object_id) for e in (getattr(result, "errors", None) or [])]
+    issues.extend(_issue_to_dict(w, "warning", object_id) for w in (getattr(result, "warnings", None) or []))
+    return issues
+
+_BUNDLE_ID_RE = re.compile(r"^bundle--[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$")
+
+def _bundle_issue(code: str, message: str, object_id: Optional[str] = None) -> Dict[str, Any]:
+    return {"severity": "error", "code": code, "message": message, "path": None, "id": object_id}
+
+
+class _BundleChecker:
+    """
+    逐物件驗證看不到整個 bundle，這裡補上 bundle 層級的檢查 (只記 id 字串，不保留物件):
+    - envelope: type 必須是 bundle、id 格式為 bundle--<uuid>、objects 必須是 array
+    - relationship 的 source_ref / target_ref 必須指向同一個 bundle 內的物件
+    """
+
+    def __init__(self) -> None:
+        self.ids: Set[str] = set()
+        self.refs: List[Tuple[str, str, str]] = []
+
+    def observe(self, objects: Iterable[Any]) -> Iterator[Any]:
+        for obj in objects:
+            if isinstance(obj, dict):
+                if isinstance(obj.get("id"), str):
+                    self.ids.add(obj["id"])
+                if obj.get("type") == "relationship":
+                    for field in ("source_ref", "target_ref"):
+                        self.refs.append((obj.get("id"), field, obj.get(field)))
+            yield obj
+
+    @staticmethod
+    def envelope_issues(envelope: Dict[str, Any]) -> List[Dict[str, Any]]:
+        issues = []
+        if envelope.get("type") != "bundle":
+            issues.append(_bundle_issue("bundle-type", f"Bundle 'type' must be 'bundle', got {envelope.get('type')!r}"))
+        bundle_id = envelope.get("id")
+        if not isinstance(bundle_id, str) or not _BUNDLE_ID_RE.match(bundle_id):
+            issues.append(_bundle_issue("bundle-id", f"Bundle 'id' must be 'bundle--<uuid>', got {bundle_id!r}"))
+        if "objects" in envelope and not isinstance(envelope["objects"], list):
+            issues.append(_bundle_issue("bundle-objects", "Bundle 'objects' must be an array"))
+        return issues
+
+    def ref_issues(self) -> List[Dict[str, Any]]:
+        return [
+            _bundle_issue("unresolved-ref", f"Relationship {field} {ref!r} does not point to an object in the bundle",
+                          rel_id)
+            for rel_id, field, ref in self.refs if ref not in self.ids
+        ]
+
+
+def _options() -> ValidationOptions:
+    return ValidationOptions(strict=True, version="2.1")
+
+# cache key 的 salt：validator 版本或選項改變時舊的結果自動失效
+_CACHE_SALT = f"stix2validator-{getattr(stix2validator, '__version__', '?')}|strict|2.1|v2"
+
+_NOT_AN_OBJECT: ObjectResult = (False, [{"severity": "error", "code": None,
+                                         "message": "Bundle entry is not a JSON object",
+                                         "path": None, "id": None}])
+
+def _validate_one(obj: Any, options: ValidationOptions) -> ObjectResult:
+    if not isinstance(obj, dict):
+        return _NOT_AN_OBJECT
+    result = validate_parsed_json(obj, options)
+    return bool(getattr(result, "is_valid", False)), _result_issues(result)
+
+def _validate_chunk(objects: List[Any]) -> List[ObjectResult]:
+    """
+    ProcessPool worker：驗證一批物件 (module 層級函式才能 pickle)
+    """
+    options = _options()
+    return [_validate_one(obj, options) for obj in objects]
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
     """
-    options = ValidationOptions(strict=True, version="2.1")
-    results = validate_string(stix_json_string, options)
+    process 內共用的驗證 pool (多個 pipeline worker thread 共用)
+    用 spawn 建立子行程，避免在有其他 thread 的 process 裡 fork
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = workers
+        return _pool
+
+_cache: Optional[ValidationCache] = None
+_cache_loaded = False
+_cache_lock = threading.Lock()
 
-    issues: List[Dict[str, Any]] = [_issue_to_dict(i) for i in getattr(results, "results", [])]
+def _get_cache() -> Optional[ValidationCache]:
+    global _cache, _cache_loaded
+    with _cache_lock:
+        if not _cache_loaded:
+            _cache = ValidationCache.from_env()
+            _cache_loaded = True
+        return _cache
 
-    errors = [i for i in issues if (i.get("severity") or "").lower() == "error"]
-    warnings = [i for i in issues if (i.get("severity") or "").lower() == "warning"]
-    unknown = [i for i in issues if i not in errors and i not in warnings]
+def _batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    batch: List[Any] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _validate_objects(objects: Iterable[Any], workers: Optional[int] = None, chunk_size: Optional[int] = None,
+                      use_cache: bool = True) -> Tuple[bool, List[Dict[str, Any]]]:
+    """
+    逐物件驗證，回傳 (是否全部通過, issues)
+
+    - 物件以 chunk_size 為一批，先用內容 hash (不含 id / 時間戳記) 查 cache，只有 miss 的物件才需要驗證
+    - miss 的物件超過一批時丟到 process pool 平行驗證；同時在途的批次有上限，記憶體不會隨 bundle 變大
+    - issues 的順序與物件順序相同
+    """
+    if workers is None:
+        workers = int(os.getenv("STIX_VALIDATION_WORKERS", "0")) or (os.cpu_count() or 1)
+    if chunk_size is None:
+        chunk_size = int(os.getenv("STIX_VALIDATION_CHUNK", "256"))
+    chunk_size = max(1, chunk_size)
+    cache = _get_cache() if use_cache else None
+    options = _options()
 
-    # 這邊會統計最常出現的 issue 類型
-    key_list = [(i.get("code") or i.get("message") or "UNKNOWN") for i in issues]
-    top_types = Counter(key_list).most_common(15)
+    is_valid = True
+    issues: List[Dict[str, Any]] = []
+    pending: Deque[Tuple[List[str], List[Dict[str, str]], Dict[str, ObjectResult], List[int], Any]] = deque()
 
-    payload: Dict[str, Any] = {
+    def _drain_one() -> None:
+        nonlocal is_valid
+        keys, subs, known, miss_idx, fut = pending.popleft()
+        if miss_idx:
+            fresh = fut.result() if isinstance(fut, Future) else fut
+            # cache 內存的是 placeholder 版本，取出時再換回各物件自己的 id / 時間戳記
+            new_results = {keys[i]: (ok, template_issues(r, subs[i])) for i, (ok, r) in zip(miss_idx, fresh)}
+            if cache is not None:
+                cache.put_many(new_results)
+            known.update(new_results)
+        for key, obj_subs in zip(keys, subs):
+            ok, obj_issues = known[key]
+            is_valid = is_valid and ok
+            issues.extend(fill_issues(obj_issues, obj_subs))
+
+    for batch in _batched(objects, chunk_size):
+        keyed = [object_cache_key(obj, _CACHE_SALT) for obj in batch]
+        keys = [k for k, _ in keyed]
+        subs = [s for _, s in keyed]
+        known = cache.get_many(keys) if cache is not None else {}
+        miss_idx: List[int] = []
+        seen: Set[str] = set()
+        for i, key in enumerate(keys):
+            if key not in known and key not in seen:
+                seen.add(key)
+                miss_idx.append(i)
+
+        misses = [batch[i] for i in miss_idx]
+        if not misses:
+            fut: Any = []
+        elif workers > 1 and len(misses) >= chunk_size:
+            fut = _get_pool(workers).submit(_validate_chunk, misses)
+        else:
+            fut = [_validate_one(obj, options) for obj in misses]
+        pending.append((keys, subs, known, miss_idx, fut))
+
+        while len(pending) > workers * 2:
+            _drain_one()
+
+    while pending:
+        _drain_one()
+    return is_valid, issues
+
+def _build_payload(is_valid: bool, issues: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # 一次走完所有 issue：依 severity 分類，同時統計最常出現的 issue 類型
+    errors: List[Dict[str, Any]] = []
+    warnings: List[Dict[str, Any]] = []
+    unknown: List[Dict[str, Any]] = []
+    buckets = {"error": errors, "warning": warnings}
+    top_counter: Counter = Counter()
+    for i in issues:
+        buckets.get((i.get("severity") or "").lower(), unknown).append(i)
+        top_counter[i.get("code") or i.get("message") or "UNKNOWN"] += 1
+    top_types = top_counter.most_common(15)
+
+    return {
         "stix_version": "2.1",
         "strict": True,
-        "is_valid": bool(getattr(results, "is_valid", False)),
+        "is_valid": is_valid,
         "counts": {
             "total": len(issues),
             "errors": len(errors),
@@ -43,11 +236,159 @@ def validate_stix_json(stix_json_string: str) -> Tuple[bool, Dict[str, Any]]:
             "unknown_severity": len(unknown),
         },
         "top_issue_types": top_types,
-        "issues": issues,        
-        "errors": errors,        
-        "warnings": warnings,      
+        "issues": issues,
+        "errors": errors,
+        "warnings": warnings,
         "unknown": unknown,
     }
 
+def validate_stix_json(stix_json_string: str) -> Tuple[bool, Dict[str, Any]]:
+    """
+    payload 包含 errors + warnings
+    """
+    bundle = json.loads(stix_json_string)
+    if not (isinstance(bundle, dict) and bundle.get("type") == "bundle"):
+        is_valid, issues = _validate_objects([bundle])
+        payload = _build_payload(is_valid, issues)
+        return payload["is_valid"], payload
+
+    objects = bundle.get("objects", []) or []
+    envelope = {k: ([] if k == "objects" and isinstance(v, list) else v) for k, v in bundle.items()}
+    checker = _BundleChecker()
+    is_valid, issues = _validate_objects(checker.observe(objects if isinstance(objects, list) else []))
+    bundle_issues = checker.envelope_issues(envelope) + checker.ref_issues()
+    payload = _build_payload(is_valid and not bundle_issues, bundle_issues + issues)
     return payload["is_valid"], payload
 
+
+class _ObjectStream:
+    """
+    不依賴 ijson 的增量解析：只認得 bundle 最外層的結構，objects 陣列內每個元素用
+    json.JSONDecoder.raw_decode 解出來，buffer 只保留尚未解析的部分
+    """
+
+    def __init__(self, fp: TextIO, chunk_size: int = 1 << 16) -> None:
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        # 最外層除了 objects 以外的欄位 (objects 只記錄是不是 array)
+        self.envelope: Dict[str, Any] = {}
+
+    def _fill(self, size: Optional[int] = None) -> bool:
+        if self.eof:
+            return False
+        chunk = self.fp.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of STIX bundle")
+
+    def _expect(self, chars: str) -> str:
+        ch = self._peek()
+        if ch not in chars:
+            raise ValueError(f"Expected one of {chars!r} at offset {self.pos}, got {ch!r}")
+        self.pos += 1
+        return ch
+
+    def _value(self) -> Any:
+        self._peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # 物件被 chunk 切斷：讀更多再試，同一個物件每次多讀一倍，避免大物件重複解析太多次
+                if not self._fill(size):
+                    raise
+                size = min(size * 2, 1 << 24)
+                continue
+            # 數字剛好停在 buffer 結尾時可能還沒讀完
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def objects(self) -> Iterator[Any]:
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == "objects" and self._peek() != "[":
+                self.envelope[key] = self._value()
+            elif key == "objects":
+                self.envelope[key] = []
+                self._expect("[")
+                if self._peek() == "]":
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(",]") == "]":
+                            break
+            else:
+                self.envelope[key] = self._value()
+            if self._expect(",}") == "}":
+                return
+
+
+def _envelope_events(events: Iterator[Tuple[str, str, Any]], envelope: Dict[str, Any]) -> Iterator[Tuple[str, str, Any]]:
+    # ijson: 把最外層的純量欄位記到 envelope，事件原樣交給 ijson.items
+    for prefix, event, value in events:
+        if prefix and "." not in prefix:
+            if prefix == "objects":
+                if event == "start_array":
+                    envelope["objects"] = []
+                elif event not in ("end_array",) and "objects" not in envelope:
+                    envelope["objects"] = value
+            elif event not in ("start_map", "end_map", "start_array", "end_array", "map_key"):
+                envelope[prefix] = value
+        yield prefix, event, value
+
+
+def iter_bundle_objects(path: str, envelope: Optional[Dict[str, Any]] = None) -> Iterator[Any]:
+    """
+    從檔案逐一讀出 bundle.objects 內的物件，不需要把整個 bundle 載入記憶體
+    有傳 envelope 時順便記錄 bundle 最外層的欄位 (type / id ...)，讀完所有物件後才完整
+    """
+    if ijson is not None:
+        with open(path, "rb") as f:
+            if envelope is None:
+                yield from ijson.items(f, "objects.item", use_float=True)
+            else:
+                events = _envelope_events(ijson.parse(f, use_float=True), envelope)
+                yield from ijson.items(events, "objects.item")
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        stream = _ObjectStream(f)
+        yield from stream.objects()
+        if envelope is not None:
+            envelope.update(stream.envelope)
+
+def validate_stix_file(path: str) -> Tuple[bool, Dict[str, Any]]:
+    """
+    逐物件串流驗證 bundle 檔案，payload 格式與 validate_stix_json 相同
+    峰值記憶體取決於最大的單一物件 (以及 issue 數量)，而不是整個 bundle；
+    bundle envelope 與 relationship 參照在同一次讀取中檢查 (只保留物件 id)
+    """
+    envelope: Dict[str, Any] = {}
+    checker = _BundleChecker()
+    is_valid, issues = _validate_objects(checker.observe(iter_bundle_objects(path, envelope)))
+    bundle_issues = checker.envelope_issues(envelope) + checker.ref_issues()
+    payload = _build_payload(is_valid and not bundle_issues, bundle_issues + issues)
+    return payload["is_valid"], payload
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .sqlite_cache import SQLiteLRUCache
+
+try:
+    import orjson
+except ImportError:  # orjson 為選用，沒有時退回標準 json
+    orjson = None
+
+DEFAULT_CACHE_PATH = ".cache/stix_validation.sqlite3"
+DEFAULT_MAX_ENTRIES = 200_000
+
+# 驗證結果: (is_valid, issues)
+ObjectResult = Tuple[bool, List[Dict[str, Any]]]
+
+
+def content_hash(obj: Any, salt: str = "") -> str:
+    """
+    物件內容的 hash (key 排序後的 compact JSON)，同樣內容的物件不論欄位順序都得到同一個 key
+    """
+    if orjson is not None:
+        try:
+            data = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            data = json.dumps(obj, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+    else:
+        data = json.dumps(obj, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+    h = hashlib.sha256(salt.encode("utf-8"))
+    h.update(b"\0")
+    h.update(data)
+    return h.hexdigest()
+
+
+_ID_RE = re.compile(r"^([a-z0-9][a-z0-9-]*)--([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})$")
+_TIMESTAMP_RE = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?Z$")
+
+
+def _id_placeholder(value: Any) -> Optional[str]:
+    # 格式正確的 STIX id 只保留 type 與 UUID 的 version / variant (validator 會檢查這兩個)
+    if not isinstance(value, str):
+        return None
+    m = _ID_RE.match(value)
+    if not m:
+        return None
+    u = uuid.UUID(m.group(2))
+    return f"{m.group(1)}--<uuid v{u.version} {u.variant}>"
+
+
+def _parse_timestamp(value: Any) -> Optional[datetime]:
+    if not isinstance(value, str) or not _TIMESTAMP_RE.match(value):
+        return None
+    try:
+        return datetime.fromisoformat(value[:-1])
+    except ValueError:
+        return None
+
+
+def object_cache_key(obj: Any, salt: str = "") -> Tuple[str, Dict[str, str]]:
+    """
+    驗證結果的 cache key：每次產生 bundle 都會變的 id / *_ref / 時間戳記換成 placeholder 後再 hash，
+    內容相同的物件 (例如重跑同一份報告) 才能命中
+
+    - 只有格式正確的值才換掉，格式錯誤的值保留原樣，validator 對它的錯誤不會被共用
+    - 時間戳記保留小數位數與彼此的先後順序 (modified >= created、valid_until > valid_from 等檢查)
+    - 回傳 (key, {placeholder: 原始值})，用來把 cache 內 issue 的 id / 訊息換回這個物件的值
+    """
+    if not isinstance(obj, dict):
+        return content_hash(obj, salt), {}
+
+    normalized: Dict[str, Any] = {}
+    subs: Dict[str, str] = {}
+    stamps: Dict[str, datetime] = {}
+    for field, value in obj.items():
+        if field == "id" or field.endswith("_ref"):
+            placeholder = _id_placeholder(value)
+            if placeholder is not None:
+                subs[f"<{field}>"] = value
+                value = f"<{field}> {placeholder}"
+        elif field.endswith("_refs") and isinstance(value, list):
+            items = []
+            for j, item in enumerate(value):
+                placeholder = _id_placeholder(item)
+                if placeholder is not None:
+                    subs[f"<{field}[{j}]>"] = item
+                    item = f"<{field}[{j}]> {placeholder}"
+                items.append(item)
+            value = items
+        else:
+            ts = _parse_timestamp(value)
+            if ts is not None:
+                stamps[field] = ts
+                subs[f"<{field}>"] = value
+                value = f"<timestamp {len(value)}>"
+        normalized[field] = value
+
+    if stamps:
+        ranks = {ts: r for r, ts in enumerate(sorted(set(stamps.values())))}
+        normalized["\0timestamp_order"] = {field: ranks[ts] for field, ts in stamps.items()}
+    return content_hash(normalized, salt), subs
+
+
+def _replace_all(text: Any, pairs: Iterable[Tuple[str, str]]) -> Any:
+    if not isinstance(text, str):
+        return text
+    for old, new in pairs:
+        text = text.replace(old, new)
+    return text
+
+
+def template_issues(issues: List[Dict[str, Any]], subs: Dict[str, str]) -> List[Dict[str, Any]]:
+    """
+    存進 cache 前把 issue 裡這個物件特有的值換成 placeholder (長的值先換，避免部分重疊)
+    """
+    pairs = sorted(((v, k) for k, v in subs.items()), key=lambda p: -len(p[0]))
+    return [{k: _replace_all(v, pairs) for k, v in issue.items()} for issue in issues]
+
+
+def fill_issues(issues: List[Dict[str, Any]], subs: Dict[str, str]) -> List[Dict[str, Any]]:
+    """
+    template_issues 的反向：從 cache 取出的 issue 換回目前物件的 id / 時間戳記
+    """
+    pairs = list(subs.items())
+    return [{k: _replace_all(v, pairs) for k, v in issue.items()} for issue in issues]
+
+
+class ValidationCache(SQLiteLRUCache):
+    """
+    STIX 逐物件驗證結果的持久化 cache，key 是 (validator 版本 + 選項, 去掉 id / 時間戳記的物件內容) 的 hash
+
+    - 重新驗證內容大多沒變的 bundle 時 (例如 --reprocess 或重跑同一份報告) 只需要驗證新的物件
+    - 超過 max_entries 時依 last_used 做 LRU 淘汰
+    """
+
+    TABLE = "object_results"
+    COLUMNS = ("is_valid INTEGER NOT NULL", "issues TEXT NOT NULL")
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        super().__init__(path, max_entries)
+
+    def _migrate(self, columns: set) -> None:
+        if "last_used" not in columns:
+            # 舊格式 (key 含 id / 時間戳記，不會命中) 直接丟掉
+            self._conn.execute(f"DROP TABLE {self.TABLE}")
+
+    @classmethod
+    def from_env(cls) -> Optional["ValidationCache"]:
+        """
+        STIX_VALIDATION_CACHE_PATH 設為空字串即可關閉 cache
+        """
+        path = os.getenv("STIX_VALIDATION_CACHE_PATH", DEFAULT_CACHE_PATH)
+        if not path:
+            return None
+        return cls(path, max_entries=int(os.getenv("STIX_VALIDATION_CACHE_MAX_ENTRIES", str(DEFAULT_MAX_ENTRIES))))
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, ObjectResult]:
+        return {key: (bool(is_valid), json.loads(issues)) for key, (is_valid, issues) in self._get_rows(keys).items()}
+
+    def put_many(self, results: Dict[str, ObjectResult]) -> None:
+        self._put_rows({key: (int(ok), json.dumps(issues, ensure_ascii=False)) for key, (ok, issues) in results.items()})
@@ -0,0 +1,59 @@
+import pytest
+
+from src import bulk_index as bi
+
+
+class _Indices:
+    def __init__(self):
+        self.settings = {"refresh_interval": "5s", "number_of_replicas": "2"}
+        self.calls = []
+
+    def get_settings(self, index):
+        return {index: {"settings": {"index": dict(self.settings)}}}
+
+    def put_settings(self, index, body):
+        self.calls.append(("put", body["index"]))
+        self.settings.update(body["index"])
+
+    def refresh(self, index):
+        self.calls.append(("refresh", None))
+
+
+class _Client:
+    def __init__(self):
+        self.indices = _Indices()
+
+
+def test_backfill_restores_settings_after_failed_chunks(monkeypatch):
+    def _fail(client, chunk):
+        assert client.indices.settings["refresh_interval"] == "-1"
+        raise ConnectionError("bulk down")
+
+    monkeypatch.setattr(bi, "_send_chunk", _fail)
+    client = _Client()
+    stats = bi.bulk_index(client, "logs", ({"n": i} for i in range(5)), chunk_size=2, backfill=True)
+
+    assert stats["failed"] == 5 and stats["indexed"] == 0 and len(stats["chunk_failures"]) == 3
+    assert client.indices.settings == {"refresh_interval": "5s", "number_of_replicas": "2"}
+    assert client.indices.calls[-1] == ("refresh", None)
+
+
+def test_backfill_restores_settings_when_docs_raise(monkeypatch):
+    monkeypatch.setattr(bi, "_send_chunk", lambda client, chunk: {"success": len(chunk), "errors": []})
+
+    def _docs():
+        yield {"n": 1}
+        raise RuntimeError("embedding failed")
+
+    client = _Client()
+    with pytest.raises(RuntimeError):
+        bi.bulk_index(client, "logs", _docs(), chunk_size=1, backfill=True)
+    assert client.indices.settings == {"refresh_interval": "5s", "number_of_replicas": "2"}
+
+
+def test_no_refresh_option_skips_forced_refresh(monkeypatch):
+    monkeypatch.setattr(bi, "_send_chunk", lambda client, chunk: {"success": len(chunk), "errors": []})
+    client = _Client()
+    stats = bi.bulk_index(client, "logs", [{"n": 1}, {"_id": "x", "_source": {"n": 2}}], refresh=False)
+    assert stats["indexed"] == 2
+    assert client.indices.calls == []
@@ -0,0 +1,63 @@
+from src.chunked_extract import _estimate_tokens, extract_chunked, merge_extractions, split_report
+
+
+class _FakeLLM:
+    def __init__(self, respond):
+        self.respond = respond
+        self.prompts = []
+
+    def extract_json(self, system_prompt, user_prompt):
+        self.prompts.append(user_prompt)
+        return self.respond(user_prompt)
+
+
+def _report(sections=6, paras=4):
+    return "\n\n".join(
+        f"# Section {s}\n\n" + "\n\n".join(f"Paragraph {s}.{p} " + "word " * 40 for p in range(paras))
+        for s in range(sections)
+    )
+
+
+def test_split_report_respects_budget_and_keeps_every_paragraph():
+    text = _report()
+    chunks = split_report(text, max_tokens=200)
+    assert len(chunks) > 1
+    assert all(_estimate_tokens(c) <= 200 for c in chunks)
+    assert "\n\n".join(chunks).split("\n\n") == [p.strip() for p in text.split("\n\n")]
+    assert split_report("short report", max_tokens=200) == ["short report"]
+
+
+def test_single_chunk_returns_raw_llm_output():
+    raw = {"summary": "s", "unexpected_field": 1}
+    llm = _FakeLLM(lambda prompt: raw)
+    assert extract_chunked(llm, "short", "sys", lambda t: t, max_tokens=200) is raw
+    assert llm.prompts == ["short"]
+
+
+def test_chunks_are_extracted_and_merged():
+    def respond(prompt):
+        n = len(prompt)
+        return {
+            "summary": f"part {prompt.split()[1]}",
+            "indicators": {"ipv4": ["1.2.3.4"], "domains": ["Evil.COM"], "urls": [],
+                           "hashes": {"md5": ["AB" * 16]}},
+            "ttps": [{"name": "PowerShell", "mitre_technique_id": "t1059.001", "description": "x" * (n % 7)}],
+            "actor": "APT-X",
+            "confidence": 80,
+        }
+
+    llm = _FakeLLM(respond)
+    merged = extract_chunked(llm, _report(), "sys", lambda t: t, max_tokens=200, concurrency=2)
+
+    assert len(llm.prompts) > 1
+    assert merged["indicators"]["ipv4"] == ["1.2.3.4"]
+    assert merged["indicators"]["domains"] == ["evil.com"]
+    assert merged["indicators"]["hashes"]["md5"] == ["ab" * 16]
+    assert [t["mitre_technique_id"] for t in merged["ttps"]] == ["T1059.001"]
+    assert merged["actor"] == "APT-X"
+    assert merged["confidence"] == 80
+
+
+def test_confidence_is_weighted_by_chunk_length():
+    merged = merge_extractions([{"confidence": 90}, {"confidence": 30}], weights=[3, 1])
+    assert merged["confidence"] == 75
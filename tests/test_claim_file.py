@@ -0,0 +1,38 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from src import run_pipeline
+from src.input_watcher import WorkJournal
+
+
+@pytest.fixture
+def dirs(tmp_path, monkeypatch):
+    for name in ("input", "processing"):
+        (tmp_path / name).mkdir()
+    monkeypatch.setattr(run_pipeline, "INPUT_DIR", str(tmp_path / "input"))
+    monkeypatch.setattr(run_pipeline, "PROCESSING_DIR", str(tmp_path / "processing"))
+    return tmp_path
+
+
+def test_only_one_claimer_wins(dirs):
+    (dirs / "input" / "r.txt").write_text("report")
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: run_pipeline.claim_file("r.txt"), range(8)))
+    assert len([r for r in results if r]) == 1
+    assert os.listdir(dirs / "input") == []
+    assert (dirs / "processing" / "r.txt").read_text() == "report"
+
+
+def test_name_collision_is_claimed_under_new_name(dirs):
+    (dirs / "processing" / "r.txt").write_text("old")
+    (dirs / "input" / "r.txt").write_text("new")
+    journal = WorkJournal(str(dirs / "journal"))
+    claimed = run_pipeline.claim_file("r.txt", journal)
+    name = os.path.basename(claimed)
+    assert name != "r.txt" and name.startswith("r_") and name.endswith(".txt")
+    assert open(claimed).read() == "new"
+    assert (dirs / "processing" / "r.txt").read_text() == "old"
+    assert set(journal.in_flight) == {name}
+    journal.close()
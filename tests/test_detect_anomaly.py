@@ -0,0 +1,50 @@
+import importlib
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def detect_anomaly(monkeypatch):
+    # module 載入時會建立 LLMClient，需要 API key (不會真的連線)
+    monkeypatch.setenv("AZURE_OPENAI_API_KEY", "test")
+    monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", "http://127.0.0.1:9")
+    monkeypatch.setenv("EMBEDDING_CACHE_PATH", "")
+    return importlib.import_module("src.detect_anomaly")
+
+
+@pytest.mark.parametrize("method", ["kth", "avg", "max"])
+def test_vectorized_scores_match_per_hit_scores(detect_anomaly, method):
+    k = 3
+    rows = [[0.9, 0.7, 0.8], [0.5, 0.95], [0.6], []]
+    sims = np.full((len(rows), k), np.nan)
+    for i, row in enumerate(rows):
+        sims[i, :len(row)] = row
+
+    scores = detect_anomaly._anomaly_scores_from_sims(sims, k=k, method=method)
+
+    for row, score in zip(rows, scores):
+        expected = detect_anomaly._anomaly_score_from_hits([{"_score": s} for s in row], k=k, method=method)
+        if expected is None:
+            assert np.isnan(score)
+        else:
+            assert score == pytest.approx(expected)
+
+
+def test_detect_batch_verdicts(detect_anomaly, monkeypatch):
+    monkeypatch.setattr(detect_anomaly.llm, "get_embeddings", lambda texts: [[float(i)] for i, _ in enumerate(texts)])
+    responses = [
+        [{"_id": "a", "_score": 0.95, "_source": {"log_text": "x"}}],
+        [{"_id": "b", "_score": 0.2, "_source": {"log_text": "y"}}],
+        None,
+        [],
+    ]
+    monkeypatch.setattr(detect_anomaly, "_knn_search_batch", lambda vectors, **kw: responses[:len(vectors)])
+
+    results = detect_anomaly.detect_batch(["ok", "odd", "fail", "empty"], threshold=0.5, k=1, link_ttps=False)
+
+    assert [r["verdict"] for r in results] == ["benign", "anomaly", "unknown", "unknown"]
+    assert results[0]["score"] == pytest.approx(0.05)
+    assert results[0]["neighbors"] == [{"id": "a", "sim": 0.95, "log_text": "x"}]
+    assert results[2]["error"] == "search failed"
+    assert results[3]["error"] == "no baseline data"
@@ -0,0 +1,21 @@
+from src.ioc_extract import extract_iocs
+
+
+def test_namespaces_and_unknown_tlds_are_not_domains():
+    iocs = extract_iocs("Add-Type System.Management.Automation; System.IO.File; beacon to evil[.]com and cdn.bad.ru")
+    assert iocs["domains"] == ["evil.com", "cdn.bad.ru"]
+
+
+def test_version_strings_are_not_ipv4():
+    iocs = extract_iocs("Agent version 1.2.3.4 (v10.0.19041.1) connected to 203.0.113.5")
+    assert iocs["ipv4"] == ["203.0.113.5"]
+
+
+def test_code_scope_operators_are_not_ipv6():
+    assert extract_iocs("[Convert]::FromBase64String($a); [Reflection.Assembly]::Load($b)")["ipv6"] == []
+    assert extract_iocs("std::vector Foo::Bar a::b dead::beef ::1 ::")["ipv6"] == []
+
+
+def test_real_ipv6_is_kept():
+    iocs = extract_iocs("beacon to 2001:db8::85a3:7334 and fe80:0:0:0:0:0:0:1")
+    assert iocs["ipv6"] == ["2001:db8::85a3:7334", "fe80::1"]
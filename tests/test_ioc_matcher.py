@@ -0,0 +1,58 @@
+from src.ioc_matcher import IOCMatcher
+from src.stix_pattern import compile_indicators
+
+SHA512 = "ab" * 64
+
+
+def _indicator(name, pattern):
+    return {"type": "indicator", "id": f"indicator--{name}", "name": name, "pattern": pattern}
+
+
+def _names(matcher, line):
+    return sorted({h["name"] for h in matcher.match(line)})
+
+
+def test_and_pattern_needs_every_condition():
+    iocs = compile_indicators([
+        _indicator("both", "[ipv4-addr:value = '1.2.3.4' AND domain-name:value = 'evil.com']"),
+        _indicator("either", "[ipv4-addr:value = '5.6.7.8' OR ipv4-addr:value = '9.9.9.9']"),
+    ])
+    assert all(i.get("conjunction") for i in iocs if i["name"] == "both")
+    assert not any(i.get("conjunction") for i in iocs if i["name"] == "either")
+
+    matcher = IOCMatcher(iocs)
+    assert _names(matcher, "connect 1.2.3.4:443") == []
+    assert _names(matcher, "connect 1.2.3.4 resolved from cdn.evil.com") == ["both"]
+    assert _names(matcher, "connect 9.9.9.9") == ["either"]
+
+
+def test_sha512_tokens_are_matched():
+    matcher = IOCMatcher(compile_indicators([_indicator("h", f"[file:hashes.'SHA-512' = '{SHA512}']")]))
+    assert _names(matcher, f"dropped file sha512={SHA512.upper()}") == ["h"]
+
+
+def test_to_dict_round_trip_through_json():
+    import json
+
+    iocs = compile_indicators([
+        _indicator("net", "[ipv4-addr:value = '10.1.0.0/16']"),
+        _indicator("url", "[url:value = 'http://evil.com/a.php']"),
+        _indicator("both", "[ipv4-addr:value = '1.2.3.4' AND domain-name:value = 'evil.com']"),
+    ])
+    restored = IOCMatcher.from_dict(json.loads(json.dumps(IOCMatcher(iocs).to_dict())))
+    assert len(restored) == len(iocs)
+    assert _names(restored, "src 10.1.2.3") == ["net"]
+    assert _names(restored, "GET http://evil.com/a.php") == ["url"]
+    assert _names(restored, "connect 1.2.3.4") == []
+    assert _names(restored, "connect 1.2.3.4 evil.com") == ["both"]
+
+
+def test_rule_check_compiles_a_list_once():
+    from src import detect_rules
+
+    iocs = compile_indicators([_indicator("ip", "[ipv4-addr:value = '1.2.3.4']")])
+    first = detect_rules.compile_matcher(iocs)
+    assert detect_rules.compile_matcher(iocs) is first
+    assert [h["name"] for h in detect_rules.check_logs_against_rules("from 1.2.3.4", iocs)] == ["ip"]
+    iocs.extend(compile_indicators([_indicator("ip2", "[ipv4-addr:value = '5.6.7.8']")]))
+    assert detect_rules.compile_matcher(iocs) is not first
@@ -0,0 +1,37 @@
+import pytest
+
+from src.llm_client import LLMClient
+from src.mock_llm_server import MockConfig, mock_embedding, start_server
+
+
+@pytest.fixture
+def mock_llm(monkeypatch, tmp_path):
+    server, base_url = start_server(config=MockConfig(dim=8))
+    monkeypatch.delenv("AZURE_OPENAI_ENDPOINT", raising=False)
+    monkeypatch.delenv("AZURE_OPENAI_API_KEY", raising=False)
+    monkeypatch.setenv("OPENAI_BASE_URL", base_url)
+    monkeypatch.setenv("OPENAI_API_KEY", "mock")
+    monkeypatch.setenv("EMBEDDING_CACHE_PATH", str(tmp_path / "emb.sqlite3"))
+    monkeypatch.setenv("EMBEDDING_BATCH_SIZE", "3")
+    monkeypatch.setenv("EMBEDDING_CONCURRENCY", "2")
+    yield server.config.stats
+    server.shutdown()
+
+
+def test_get_embeddings_batches_dedups_and_keeps_order(mock_llm):
+    client = LLMClient()
+    texts = ["a", "b", "a", "c  d", "c d", "e", "f", "g", "h"]
+    vectors = client.get_embeddings(texts)
+
+    # 重複 (含只差空白) 的文字只送一次，回傳順序與輸入相同
+    assert mock_llm["embedding_inputs"] == 7
+    assert mock_llm["embeddings"] == 3  # 7 筆 / batch 3
+    assert vectors[0] == vectors[2]
+    assert vectors[3] == vectors[4]
+    for text, vec in zip(["a", "b", "c  d", "e", "f", "g", "h"], [vectors[i] for i in (0, 1, 3, 5, 6, 7, 8)]):
+        assert vec == pytest.approx(mock_embedding(text, 8), abs=1e-6)
+
+    # 第二次全部走 cache
+    assert client.get_embeddings(["h", "a"]) == [vectors[8], vectors[0]]
+    assert mock_llm["embedding_inputs"] == 7
+    client.embedding_cache.close()
@@ -0,0 +1,19 @@
+import numpy as np
+
+from src.local_knn import LocalKNNIndex, cosinesimil_score, score_to_cosine
+
+
+def test_local_score_matches_opensearch_cosinesimil(tmp_path):
+    base = np.array([[1.0, 0.0], [0.6, 0.8], [-1.0, 0.0]], dtype=np.float32)
+    index = LocalKNNIndex.build(str(tmp_path), base, ["a", "b", "c"], [{}, {}, {}])
+
+    hits = index.search_batch([[1.0, 0.0]], k=3)[0]
+    scores = {h["_id"]: h["_score"] for h in hits}
+
+    # OpenSearch nmslib cosinesimil: _score = 1 / (1 + (1 - cos))
+    for doc_id, cos in (("a", 1.0), ("b", 0.6), ("c", -1.0)):
+        assert np.isclose(scores[doc_id], 1.0 / (2.0 - cos), atol=1e-6)
+        assert np.isclose(score_to_cosine(scores[doc_id]), cos, atol=1e-6)
+
+    assert [h["_id"] for h in hits] == ["a", "b", "c"]
+    assert np.isclose(cosinesimil_score(0.0), 0.5)
@@ -0,0 +1,40 @@
+import sqlite3
+import time
+
+from src.embedding_cache import EmbeddingCache
+from src.extraction_cache import ExtractionCache
+
+
+def test_reads_touch_last_used_in_batches(tmp_path):
+    path = str(tmp_path / "emb.sqlite3")
+    cache = EmbeddingCache(path, max_entries=10)
+    cache.put_many("m", ["old", "new"], [[1.0], [2.0]])
+    time.sleep(0.01)
+    cache.put_many("m", [f"t{i}" for i in range(8)], [[0.0]] * 8)
+    time.sleep(0.01)
+    assert cache.get("m", "old") == [1.0]
+    # 讀取不寫回資料庫，下一次寫入前才一起更新
+    assert not cache._conn.in_transaction
+    cache.put_many("m", ["x"], [[3.0]])
+    # "new" 最久沒被讀，先被淘汰；剛讀過的 "old" 留下
+    assert cache.get("m", "new") is None
+    assert cache.get("m", "old") == [1.0]
+    cache.close()
+
+
+def test_extraction_cache_is_capped_and_keeps_old_rows(tmp_path):
+    path = str(tmp_path / "ext.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE extractions (key TEXT PRIMARY KEY, model TEXT NOT NULL, report_sha256 TEXT NOT NULL, "
+                 "extracted TEXT NOT NULL, created_at REAL NOT NULL)")
+    conn.execute("INSERT INTO extractions VALUES ('legacy', 'm', 'h', '{\"summary\": \"s\"}', 0)")
+    conn.commit()
+    conn.close()
+
+    cache = ExtractionCache(path, max_entries=20)
+    assert cache.get("legacy") == {"summary": "s"}
+    for i in range(30):
+        cache.put(f"k{i}", "m", f"report {i}", {"i": i})
+    assert len(cache) <= 20
+    assert cache.get("k29") == {"i": 29}
+    cache.close()
@@ -0,0 +1,156 @@
+import json
+
+import src.stix_index as si
+from src.cti_indices import ATTACK_PATTERN_INDEX, INDICATOR_INDEX, RELATIONSHIP_INDEX, TTP_VECTOR_INDEX
+from src.stix_index import (
+    _doc_id,
+    _doc_ids,
+    _iter_docs,
+    attack_pattern_doc,
+    latest_bundles,
+    report_name,
+    ttp_link_docs,
+)
+from src.to_stix import write_stix_bundle
+
+EXTRACTED = {
+    "indicators": {"ipv4": ["203.0.113.7"], "domains": ["evil.example"]},
+    "malware_or_tool": ["Mimikatz"],
+    "ttps": [{"name": "PowerShell", "mitre_technique_id": "T1059.001", "description": "runs scripts"}],
+    "confidence": 70,
+}
+
+
+def _docs(bundle_path, index):
+    report = report_name(str(bundle_path))
+    return list(_iter_docs(str(bundle_path), index, report, _doc_ids(str(bundle_path), report)))
+
+
+def test_doc_id_is_deterministic():
+    assert _doc_id("r", "indicator", "[ipv4-addr:value = '1.2.3.4']") == \
+        _doc_id("r", "indicator", "[ipv4-addr:value = '1.2.3.4']")
+    assert _doc_id("r", "indicator", "a") != _doc_id("other", "indicator", "a")
+    assert _doc_id("r", "tool", None) == _doc_id("r", "tool", "")
+    assert _doc_id("r", "tool", "x").startswith("tool--")
+
+
+def test_doc_ids_are_stable_across_regenerated_bundles(tmp_path):
+    first = tmp_path / "report.pdf_20260101_000000_bundle.json"
+    second = tmp_path / "report.pdf_20260102_000000_bundle.json"
+    write_stix_bundle(EXTRACTED, str(first))
+    write_stix_bundle(EXTRACTED, str(second))
+
+    # STIX id (uuid4) 每次都不同，文件 _id 不變
+    stix_ids = [{o["id"] for o in json.loads(p.read_text())["objects"]} for p in (first, second)]
+    assert {i.split("--")[0] for i in stix_ids[0] & stix_ids[1]} == {"marking-definition"}
+
+    for index in (INDICATOR_INDEX, ATTACK_PATTERN_INDEX, RELATIONSHIP_INDEX):
+        old, new = _docs(first, index), _docs(second, index)
+        assert old
+        assert sorted(d["doc_id"] for d in old) == sorted(d["doc_id"] for d in new)
+        assert {d["report"] for d in old + new} == {"report.pdf"}
+        assert {d["bundle"] for d in new} == {second.name}
+
+
+def test_report_name_strips_timestamp_and_suffix():
+    assert report_name("out/report.pdf_20260101_000000_bundle.json") == "report.pdf"
+    assert report_name("out/report_20260101_000000_bundle.json") == "report"
+    assert report_name("out/report.txt_bundle.json") == "report.txt"
+    assert report_name("out/notes.json") == "notes.json"
+
+
+def test_latest_bundles_keeps_newest_per_report():
+    paths = [
+        "out/b/report.pdf_20260102_000000_bundle.json",
+        "out/a/report.pdf_20260101_000000_bundle.json",
+        "out/report.txt_20260101_000000_bundle.json",
+        "out/other_20251231_235959_bundle.json",
+    ]
+    assert latest_bundles(paths) == [
+        "out/b/report.pdf_20260102_000000_bundle.json",
+        "out/other_20251231_235959_bundle.json",
+        "out/report.txt_20260101_000000_bundle.json",
+    ]
+
+
+def _ttp_doc(name, mitre_id, description="d"):
+    return attack_pattern_doc({
+        "type": "attack-pattern", "id": f"attack-pattern--{name}", "name": name, "description": description,
+        "external_references": [{"source_name": "mitre-attack", "external_id": mitre_id}] if mitre_id else [],
+    }, "report.pdf")
+
+
+def test_ttp_link_docs_maps_suggestions_to_report_techniques():
+    ttp_docs = [_ttp_doc("PowerShell", "T1059.001"), _ttp_doc("Phishing", "T1566"), _ttp_doc("Custom", None)]
+    extracted = {"log_suggestions": [
+        {"log_type": "sysmon", "rationale": "process creation", "fields": ["CommandLine", 3]},
+        "not a dict",
+    ]}
+    docs = ttp_link_docs(ttp_docs, extracted, "report.pdf")
+
+    assert [d["kind"] for d in docs] == ["attack-pattern"] * 3 + ["log-suggestion"]
+    assert docs[0]["mitre_ids"] == ["T1059.001"] and docs[0]["mitre_names"] == ["PowerShell"]
+    assert docs[2]["mitre_ids"] == [] and docs[2]["mitre_names"] == []
+    assert docs[0]["text"] == "PowerShell: d"
+
+    suggestion = docs[3]
+    assert suggestion["text"] == "sysmon: process creation (CommandLine)"
+    assert suggestion["mitre_ids"] == ["T1059.001", "T1566"]
+    assert suggestion["mitre_names"] == ["PowerShell", "Phishing"]
+    assert suggestion["log_type"] == "sysmon"
+
+    # 同樣的文字與 technique 在其他報告得到同一個 _id (cti-ttp-vectors 跨報告共用)
+    again = ttp_link_docs(list(reversed(ttp_docs)), extracted, "other.pdf")
+    assert sorted(d["doc_id"] for d in again) == sorted(d["doc_id"] for d in docs)
+    assert [d["doc_id"] for d in ttp_link_docs(ttp_docs)] == [d["doc_id"] for d in docs[:3]]
+
+
+class _FakeLLM:
+    def __init__(self):
+        self.calls = []
+
+    def get_embeddings(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(t))] for t in texts]
+
+
+def test_index_stix_bundle_writes_ttp_vectors(tmp_path, monkeypatch):
+    path = tmp_path / "report.pdf_20260101_000000_bundle.json"
+    write_stix_bundle(EXTRACTED, str(path))
+    written = {}
+
+    def fake_bulk_index(client, index, docs, **kwargs):
+        written[index] = list(docs)
+        return {"failed": 0}
+
+    monkeypatch.setattr(si, "bulk_index", fake_bulk_index)
+    monkeypatch.setattr(si, "_delete_superseded", lambda *a: None)
+    llm = _FakeLLM()
+    extracted = {**EXTRACTED, "log_suggestions": [{"log_type": "proxy", "rationale": "beaconing"}]}
+    si.index_stix_bundle(object(), str(path), llm=llm, extracted=extracted)
+
+    # attack-pattern 與 link 文件一次送去向量化
+    assert llm.calls == [["PowerShell: runs scripts", "PowerShell: runs scripts", "proxy: beaconing"]]
+    (ttp,) = written[ATTACK_PATTERN_INDEX]
+    assert ttp["ttp_vector"] == [24.0]
+    links = written[TTP_VECTOR_INDEX]
+    assert [d["kind"] for d in links] == ["attack-pattern", "log-suggestion"]
+    assert all("ttp_vector" in d for d in links)
+    assert links[1]["mitre_ids"] == ["T1059.001"]
+
+
+def test_index_stix_bundle_without_llm_skips_ttp_vectors(tmp_path, monkeypatch):
+    path = tmp_path / "report.pdf_20260101_000000_bundle.json"
+    write_stix_bundle(EXTRACTED, str(path))
+    written = {}
+
+    def fake_bulk_index(client, index, docs, **kwargs):
+        written[index] = list(docs)
+        return {"failed": 0}
+
+    monkeypatch.setattr(si, "bulk_index", fake_bulk_index)
+    monkeypatch.setattr(si, "_delete_superseded", lambda *a: None)
+    si.index_stix_bundle(object(), str(path))
+
+    assert TTP_VECTOR_INDEX not in written
+    assert "ttp_vector" not in written[ATTACK_PATTERN_INDEX][0]
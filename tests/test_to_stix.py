@@ -0,0 +1,116 @@
+import json
+import re
+
+import stix2
+from stix2.v21 import TLP_AMBER, AttackPattern, ExternalReference, Identity, Indicator, Malware, Relationship, Tool
+
+from src.to_stix import build_stix_bundle, write_stix_bundle
+
+_ID_RE = re.compile(r"^([a-z0-9-]+)--[0-9a-f-]{36}$")
+_TS_FIELDS = {"created", "modified", "valid_from"}
+
+EXTRACTED = {
+    "indicators": {
+        "ipv4": ["203.0.113.7"],
+        "ipv6": ["2001:db8::1"],
+        "domains": ["evil.example"],
+        "urls": ["http://evil.example/a"],
+        "hashes": {"md5": ["d41d8cd98f00b204e9800998ecf8427e"], "sha256": ["a" * 64]},
+    },
+    "malware_or_tool": ["BadMalware", "Mimikatz"],
+    "ttps": [
+        {"name": "PowerShell", "mitre_technique_id": "T1059.001", "description": "runs scripts"},
+        {"name": "Phishing", "mitre_technique_id": "", "description": None},
+    ],
+    "confidence": 70,
+}
+
+
+def _legacy_objects(extracted):
+    # 舊版逐物件用 stix2 類別建構的輸出，作為比對基準
+    conf = extracted.get("confidence")
+    confidence = int(conf) if isinstance(conf, int) else None
+    common = {"object_marking_refs": [TLP_AMBER.id], "confidence": confidence}
+    producer = Identity(name="LLM CTI-to-STIX PoC", identity_class="organization")
+    common["created_by_ref"] = producer.id
+
+    indicators = []
+    ind = extracted["indicators"]
+    specs = [(f"IP indicator {ip}", f"[ipv4-addr:value = '{ip}']") for ip in ind["ipv4"]]
+    specs += [(f"IP indicator {ip}", f"[ipv6-addr:value = '{ip}']") for ip in ind["ipv6"]]
+    specs += [(f"Domain indicator {d}", f"[domain-name:value = '{d}']") for d in ind["domains"]]
+    specs += [(f"URL indicator {u}", f"[url:value = '{u}']") for u in ind["urls"]]
+    for algo, key in (("md5", "MD5"), ("sha1", "SHA-1"), ("sha256", "SHA-256")):
+        specs += [(f"File hash {key} {h[:12]}...", f"[file:hashes.'{key}' = '{h}']") for h in ind["hashes"].get(algo, [])]
+    for name, pattern in specs:
+        indicators.append(Indicator(name=name, pattern_type="stix", pattern=pattern, valid_from="2020-01-01T00:00:00Z",
+                                    labels=["cti", "llm-generated"], **common))
+
+    others = []
+    for name in extracted["malware_or_tool"]:
+        if "malware" in name.lower():
+            others.append(Malware(name=name, is_family=False, labels=["cti", "llm-generated"], **common))
+        else:
+            others.append(Tool(name=name, labels=["cti", "llm-generated"], **common))
+
+    ttps = []
+    for t in extracted["ttps"]:
+        refs = None
+        if t["mitre_technique_id"]:
+            refs = [ExternalReference(source_name="mitre-attack", external_id=t["mitre_technique_id"],
+                                      url=f"https://attack.mitre.org/techniques/{t['mitre_technique_id']}/")]
+        ttps.append(AttackPattern(name=t["name"], description=t["description"] or "",
+                                  labels=["ttp", "cti", "llm-generated"], external_references=refs, **common))
+
+    rels = [Relationship(relationship_type="indicates", source_ref=i.id, target_ref=ap.id, **common)
+            for i in indicators for ap in ttps[:3]]
+    bundle = stix2.v21.Bundle(objects=[producer, TLP_AMBER, *indicators, *others, *ttps, *rels], allow_custom=False)
+    return json.loads(bundle.serialize())["objects"]
+
+
+def _normalize(objects):
+    """
+    id 換成依出現順序編號、時間戳換成固定值，只比較結構與內容
+    """
+    ids = {}
+
+    def walk(value, key=None):
+        if isinstance(value, dict):
+            return {k: walk(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [walk(v) for v in value]
+        if isinstance(value, str):
+            m = _ID_RE.match(value)
+            if m:
+                return ids.setdefault(value, f"{m.group(1)}--{len(ids)}")
+            if key in _TS_FIELDS:
+                return "<ts>"
+        return value
+
+    return [walk(obj) for obj in objects]
+
+
+def test_dict_output_matches_stix2_objects():
+    new = json.loads(build_stix_bundle(EXTRACTED))["objects"]
+    old = _legacy_objects(EXTRACTED)
+
+    assert _normalize(new) == _normalize(old)
+    # 欄位順序也與 stix2 serialize 相同
+    assert [list(o) for o in new] == [list(o) for o in old]
+
+
+def test_strict_and_streamed_bundles_parse_with_stix2(tmp_path):
+    bundle = stix2.parse(build_stix_bundle(EXTRACTED, strict=True), allow_custom=False)
+    assert len(bundle.objects) == 2 + 6 + 2 + 2 + 6 * 2
+
+    path = tmp_path / "bundle.json"
+    count = write_stix_bundle(EXTRACTED, str(path), strict=True)
+    streamed = stix2.parse(path.read_text(encoding="utf-8"), allow_custom=False)
+    assert count == len(streamed.objects) == len(bundle.objects)
+
+
+def test_pattern_values_are_escaped():
+    extracted = {"indicators": {"urls": ["http://x.example/it's\\here"]}}
+    bundle = json.loads(build_stix_bundle(extracted, strict=True))
+    (indicator,) = [o for o in bundle["objects"] if o["type"] == "indicator"]
+    assert indicator["pattern"] == "[url:value = 'http://x.example/it\\'s\\\\here']"
@@ -0,0 +1,34 @@
+import json
+
+from src.validate_stix import _BundleChecker, iter_bundle_objects
+
+BUNDLE_ID = "bundle--6f0f5a3e-2f8a-4a4c-9d5e-0b8f7f1f2d11"
+
+
+def _check(tmp_path, bundle):
+    path = tmp_path / "b.json"
+    path.write_text(json.dumps(bundle), encoding="utf-8")
+    envelope = {}
+    checker = _BundleChecker()
+    objects = list(checker.observe(iter_bundle_objects(str(path), envelope)))
+    return objects, [i["code"] for i in checker.envelope_issues(envelope) + checker.ref_issues()]
+
+
+def test_valid_bundle_has_no_bundle_issues(tmp_path):
+    objects, codes = _check(tmp_path, {"type": "bundle", "id": BUNDLE_ID, "objects": [
+        {"type": "indicator", "id": "indicator--a"},
+        {"type": "attack-pattern", "id": "attack-pattern--b"},
+        {"type": "relationship", "id": "relationship--c",
+         "source_ref": "indicator--a", "target_ref": "attack-pattern--b"},
+    ]})
+    assert len(objects) == 3
+    assert codes == []
+
+
+def test_envelope_and_dangling_refs_are_reported(tmp_path):
+    # id 放在 objects 之後，envelope 要等全部讀完才完整
+    _, codes = _check(tmp_path, {"type": "report", "objects": [
+        {"type": "relationship", "id": "relationship--c",
+         "source_ref": "indicator--missing", "target_ref": "relationship--c"},
+    ], "id": "bundle-x"})
+    assert codes == ["bundle-type", "bundle-id", "unresolved-ref"]
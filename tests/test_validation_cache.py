@@ -0,0 +1,43 @@
+from src.validation_cache import ValidationCache, fill_issues, object_cache_key, template_issues
+
+IND_A = {
+    "type": "indicator", "spec_version": "2.1",
+    "id": "indicator--8e2e2d2b-17d4-4cbf-938f-98ee46b3cd3f",
+    "created": "2024-01-01T00:00:00.000Z", "modified": "2024-01-01T00:00:00.000Z",
+    "valid_from": "2024-01-01T00:00:00.000Z", "pattern": "[ipv4-addr:value = '1.2.3.4']",
+    "pattern_type": "stix",
+}
+IND_B = dict(IND_A, id="indicator--1f0d5c4a-8a6e-4f57-9b1e-2b7c2f0f5a11",
+             created="2025-06-01T12:30:00.123Z", modified="2025-06-01T12:30:00.123Z",
+             valid_from="2025-06-01T12:30:00.123Z")
+
+
+def test_key_ignores_fresh_ids_and_timestamps():
+    key_a, _ = object_cache_key(IND_A)
+    key_b, subs_b = object_cache_key(IND_B)
+    assert key_a == key_b
+    assert subs_b["<id>"] == IND_B["id"]
+
+
+def test_key_keeps_what_the_validator_checks():
+    base, _ = object_cache_key(IND_A)
+    # 時間先後順序、UUID 版本、格式錯誤的值、內容不同都要 miss
+    assert object_cache_key(dict(IND_A, modified="2023-01-01T00:00:00.000Z"))[0] != base
+    assert object_cache_key(dict(IND_A, id="indicator--8e2e2d2b-17d4-1cbf-938f-98ee46b3cd3f"))[0] != base
+    assert object_cache_key(dict(IND_A, created="2024-13-01T00:00:00.000Z"))[0] != base
+    assert object_cache_key(dict(IND_A, pattern="[ipv4-addr:value = '5.6.7.8']"))[0] != base
+
+
+def test_cached_issues_get_the_current_id():
+    _, subs_a = object_cache_key(IND_A)
+    _, subs_b = object_cache_key(IND_B)
+    issues = [{"severity": "error", "message": f"{IND_A['id']}: bad", "id": IND_A["id"]}]
+    restored = fill_issues(template_issues(issues, subs_a), subs_b)
+    assert restored == [{"severity": "error", "message": f"{IND_B['id']}: bad", "id": IND_B["id"]}]
+
+
+def test_lru_cap(tmp_path):
+    cache = ValidationCache(str(tmp_path / "cache.sqlite3"), max_entries=100)
+    cache.put_many({f"k{i}": (True, []) for i in range(150)})
+    assert len(cache) < 100
+    cache.close()
@@ -0,0 +1,58 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+from src.input_watcher import WorkJournal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _spawn_owner(journal_dir, name, crash):
+    # 另一個 pipeline process：claim 一個檔案後 crash (os._exit) 或停住等 stdin
+    code = textwrap.dedent(f"""
+        import os, sys
+        from src.input_watcher import WorkJournal
+        j = WorkJournal({journal_dir!r})
+        j.claimed({name!r})
+        print("ready", flush=True)
+        if {crash!r}:
+            os._exit(1)
+        sys.stdin.readline()
+    """)
+    proc = subprocess.Popen([sys.executable, "-c", code], cwd=ROOT, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, text=True)
+    assert proc.stdout.readline().strip() == "ready"
+    return proc
+
+
+def test_only_dead_owners_are_adopted(tmp_path):
+    journal_dir = str(tmp_path / "journal")
+    live = _spawn_owner(journal_dir, "live.pdf", crash=False)
+    dead = _spawn_owner(journal_dir, "dead.pdf", crash=True)
+    dead.wait()
+    try:
+        journal = WorkJournal(journal_dir)
+        assert journal.in_flight == {"dead.pdf": 1}
+
+        # 死掉的 journal 已併入自己的 journal 後刪除，活著的保持不動
+        files = sorted(os.listdir(journal_dir))
+        assert len(files) == 2 and os.path.basename(journal.path) in files
+        journal.claimed("dead.pdf")
+        journal.close()
+        with open(journal.path, encoding="utf-8") as f:
+            entries = [json.loads(line) for line in f]
+        assert entries[-1]["attempt"] == 2
+    finally:
+        live.stdin.write("\n")
+        live.stdin.flush()
+        live.wait()
+
+
+def test_clean_close_removes_empty_journal(tmp_path):
+    journal = WorkJournal(str(tmp_path))
+    journal.claimed("a.pdf")
+    journal.finished("a.pdf", ok=True)
+    journal.close()
+    assert os.listdir(tmp_path) == []